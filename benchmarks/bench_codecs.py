@@ -0,0 +1,108 @@
+''' Write/read speed and compression ratio of the raw_data storage options (raw_data_storage of the bench config)
+
+    Uses the raw data of a recorded file (first --words words) or simulated data. The data are written in readout
+    sized chunks and read in analysis sized chunks; the file is read right after writing, thus from the page cache.
+    The last line is the uncompressed sidecar file read memory mapped (raw_data_sidecar, Analysis(mmap=True)):
+        python bench_codecs.py [raw_data_file.h5] [--words 20000000] [--chunkshapes 0 16384 262144] [--output codecs.json]
+'''
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tables as tb
+
+from bench_suite import simulated_raw_data, version_info
+from tjmonopix.scan_base import create_raw_data_earray
+
+CODECS = [
+    ('none', {'complib': 'none'}),
+    ('zlib-1', {'complib': 'zlib', 'complevel': 1}),
+    ('blosc-5', {'complib': 'blosc', 'complevel': 5}),  # Default
+    ('blosc:lz4-5', {'complib': 'blosc:lz4', 'complevel': 5}),
+    ('blosc:lz4-5-bitshuffle', {'complib': 'blosc:lz4', 'complevel': 5, 'bitshuffle': True}),
+    ('blosc:zstd-3-bitshuffle', {'complib': 'blosc:zstd', 'complevel': 3, 'bitshuffle': True}),
+    ('blosc:zstd-5', {'complib': 'blosc:zstd', 'complevel': 5}),
+]
+
+
+def run(raw_data, filename, storage, write_chunk_size, read_chunk_size):
+    start_time = time.time()
+    with tb.open_file(filename, mode='w') as out_file:
+        raw_data_earray = create_raw_data_earray(out_file, **storage)
+        for start in range(0, raw_data.shape[0], write_chunk_size):
+            raw_data_earray.append(raw_data[start:start + write_chunk_size])
+        chunkshape = int(raw_data_earray.chunkshape[0])
+    write_time = time.time() - start_time
+
+    start_time = time.time()
+    with tb.open_file(filename) as in_file:
+        for start in range(0, in_file.root.raw_data.shape[0], read_chunk_size):
+            in_file.root.raw_data[start:start + read_chunk_size]
+    read_time = time.time() - start_time
+    return write_time, read_time, os.path.getsize(filename), chunkshape
+
+
+def run_sidecar(raw_data, filename, write_chunk_size, read_chunk_size):
+    start_time = time.time()
+    with open(filename, 'wb') as out_file:
+        for start in range(0, raw_data.shape[0], write_chunk_size):
+            raw_data[start:start + write_chunk_size].tofile(out_file)
+    write_time = time.time() - start_time
+
+    start_time = time.time()
+    sidecar = np.memmap(filename, dtype='<u4', mode='r')
+    for start in range(0, sidecar.shape[0], read_chunk_size):
+        sidecar[start:start + read_chunk_size].max()  # Views, touch the data to read it
+    read_time = time.time() - start_time
+    del sidecar
+    return write_time, read_time, os.path.getsize(filename)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('raw_data_file', nargs='?', default=None)
+    parser.add_argument('--words', type=int, default=20000000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chunkshapes', type=int, nargs='+', default=[0, 16384, 262144], help='HDF5 chunk sizes in words, 0 for default')
+    parser.add_argument('--write_chunk_size', type=int, default=50000, help='Words per append (readout chunk)')
+    parser.add_argument('--read_chunk_size', type=int, default=200000, help='Words per read (Analysis chunk_size)')
+    parser.add_argument('--output', default=None, help='JSON file for the results')
+    args = parser.parse_args()
+
+    if args.raw_data_file:
+        with tb.open_file(args.raw_data_file) as in_file:
+            raw_data = in_file.root.raw_data[:args.words]
+    else:
+        raw_data = simulated_raw_data(args.words, seed=args.seed)
+    mbytes = raw_data.nbytes / 1e6
+
+    results = []
+    working_dir = tempfile.mkdtemp()
+    try:
+        print('{:<25s} {:>10s} {:>10s} {:>10s} {:>8s}'.format('codec', 'chunkshape', 'write MB/s', 'read MB/s', 'ratio'))
+        for name, storage in CODECS:
+            for chunkshape in args.chunkshapes:
+                storage = dict(storage, chunkshape=chunkshape or None)
+                write_time, read_time, file_size, used_chunkshape = run(raw_data, os.path.join(working_dir, 'raw_data.h5'), storage,
+                                                                        args.write_chunk_size, args.read_chunk_size)
+                result = {'codec': name, 'storage': storage, 'chunkshape': used_chunkshape, 'write_mb_per_s': mbytes / write_time,
+                          'read_mb_per_s': mbytes / read_time, 'ratio': raw_data.nbytes / float(file_size)}
+                results.append(result)
+                print('{:<25s} {:>10d} {:>10.1f} {:>10.1f} {:>8.2f}'.format(name, used_chunkshape, result['write_mb_per_s'],
+                                                                           result['read_mb_per_s'], result['ratio']))
+        write_time, read_time, file_size = run_sidecar(raw_data, os.path.join(working_dir, 'raw_data.raw'), args.write_chunk_size, args.read_chunk_size)
+        result = {'codec': 'sidecar (mmap)', 'storage': None, 'chunkshape': 0, 'write_mb_per_s': mbytes / write_time,
+                  'read_mb_per_s': mbytes / read_time, 'ratio': raw_data.nbytes / float(file_size)}
+        results.append(result)
+        print('{:<25s} {:>10s} {:>10.1f} {:>10.1f} {:>8.2f}'.format(result['codec'], '-', result['write_mb_per_s'],
+                                                                   result['read_mb_per_s'], result['ratio']))
+    finally:
+        shutil.rmtree(working_dir)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'version': version_info(), 'raw_data_file': args.raw_data_file, 'words': int(raw_data.shape[0]), 'results': results}, f, indent=2)
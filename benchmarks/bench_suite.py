@@ -0,0 +1,338 @@
+''' End-to-end benchmark of the readout and analysis chain
+
+    Measures the sustained rate of every stage on synthetic data with a fixed seed and stores the results
+    (and the software versions) as JSON, to compare the performance of different versions:
+        python bench_suite.py [--output bench_results.json] [--seed 0] [--words 5000000] [--stages readout fit_scurves ...]
+
+    Stages:
+        readout             FifoReadout + ScanBase._handle_data writing the data of a SimulatedDut, words/s
+        interpreter         RawDataInterpreter.interpret, words/s
+        interpreter_idx     interpreter_idx.RawIdxInterpreter (InterRawIdx), words/s
+        event_builder       EventBuilder.build_events, hits/s
+        build_inj           event_builder_inj._build_inj, hits/s
+        build_events        event_builder_basic.BuildEvents.run, hits/s
+        occ_hist2d          analysis_utils.occ_hist2d, hits/s
+        scurve_hist3d       analysis_utils.scurve_hist3d, hits/s
+        fit_scurves         analysis_utils.fit_scurves_multithread, pixels/s
+        fit_scurves_vectorized  analysis_utils.fit_scurves_vectorized, pixels/s
+        analysis            Analysis.analyze_data of a raw data file with every --n_processes, words/s (of the last)
+'''
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import tempfile
+import time
+
+import numba
+import numpy as np
+import tables as tb
+import yaml
+from scipy.special import erf
+
+from tjmonopix.sim_dut import SimulatedDut
+from tjmonopix.analysis import analysis_utils as au
+from tjmonopix.analysis import interpreter
+from tjmonopix.analysis import interpreter_idx
+from tjmonopix.analysis import event_builder_inj
+from tjmonopix.analysis.event_builder import EventBuilder, WINDOW_START, WINDOW_STOP
+from tjmonopix.analysis.event_builder_basic import BuildEvents
+from tjmonopix.analysis.analysis import Analysis
+from tjmonopix.scan_base import MetaTable
+
+hit_dtype = [('col', 'u1'), ('row', '<u2'), ('le', 'u1'), ('te', 'u1'), ('cnt', '<u4'), ('timestamp', '<i8'), ('scan_param_id', '<i8')]
+meta_dtype = [('index_start', '<u4'), ('index_stop', '<u4'), ('scan_param_id', '<u2')]
+event_dtype = [('event_number', '<i8'), ('frame', 'u1'), ('column', 'u1'), ('row', 'u1'), ('charge', 'u1')]
+
+STAGES = ['readout', 'interpreter', 'interpreter_idx', 'event_builder', 'build_inj', 'build_events',
+          'occ_hist2d', 'scurve_hist3d', 'fit_scurves', 'fit_scurves_vectorized', 'analysis']
+
+
+def simulated_raw_data(n_words, seed=0):
+    ''' Raw data of a SimulatedDut with TJ hits, HitOr and external timestamps and TLU words
+    '''
+    dut = SimulatedDut(hit_rate=1e6, cluster_size=1.5, noisy_pixels=10, seed=seed)
+    dut.set_monoread()
+    dut.set_timestamp('mon')
+    dut.set_timestamp('rx1')
+    dut.set_tlu()
+    raw_data, n, start = [], 0, 0.
+    while n < n_words:
+        words, _, _ = dut.generate(start, 0.01)
+        raw_data.append(words)
+        n += words.shape[0]
+        start += 0.01
+    return np.concatenate(raw_data)[:n_words]
+
+
+def interpreted_hits(raw_data, n_scan_params=64):
+    ''' Hits of the raw data with scan parameter ids increasing along the data
+    '''
+    meta_data = np.zeros(shape=n_scan_params, dtype=meta_dtype)
+    index_stop = np.linspace(0, raw_data.shape[0], n_scan_params + 1).astype(np.int64)
+    meta_data['index_start'], meta_data['index_stop'] = index_stop[:-1], index_stop[1:]
+    meta_data['scan_param_id'] = np.arange(n_scan_params)
+    hits = interpreter.RawDataInterpreter().interpret(raw_data, meta_data, np.zeros(shape=raw_data.shape[0], dtype=hit_dtype))
+    return hits.copy()
+
+
+def synthetic_injection_hits(n_hits, seed=0, n_injections=100, inj_period=1000):
+    ''' Hits of an injection scan as read by build_inj_h5: INJ timestamp, HitOr rising/falling edge and TJ hits
+        for every injection.
+    '''
+    rng = np.random.RandomState(seed)
+    n_inj = n_hits // 2
+    injlist = np.arange(n_inj // n_injections + 1, dtype=np.float64)
+    n_inj = (injlist.shape[0]) * n_injections
+    hits_per_inj = rng.poisson(2., n_inj)
+    block_size = 3 + hits_per_inj
+    dat = np.zeros(shape=block_size.sum(), dtype=[('index', '<i4'), ('col', 'u1'), ('row', '<u2'), ('le', 'u1'), ('te', 'u1'),
+                                                  ('cnt', '<u4'), ('timestamp', '<u8')])
+    block_start = np.cumsum(block_size) - block_size
+    ts_inj = (np.arange(n_inj, dtype=np.uint64) * inj_period) << 4
+    dat['timestamp'] = np.repeat(ts_inj, block_size)
+    dat['col'] = rng.randint(0, event_builder_inj.COL_SIZE, dat.shape[0])
+    dat['row'] = rng.randint(0, event_builder_inj.ROW_SIZE, dat.shape[0])
+    dat['le'] = rng.randint(0, 64, dat.shape[0])
+    dat['te'] = rng.randint(0, 64, dat.shape[0])
+    dat['col'][block_start] = event_builder_inj.TS_INJ
+    dat['col'][block_start + 1] = event_builder_inj.TS_MON
+    dat['col'][block_start + 2] = event_builder_inj.TS_MON
+    dat['row'][block_start + 1] = 0
+    dat['row'][block_start + 2] = 1
+    return dat, injlist, inj_period, n_injections
+
+
+def synthetic_tlu_hits(n_hits, seed=0, wait_cycles=20):
+    ''' Hits of interpreter_idx as used by BuildEvents: TLU word, trigger timestamp and TJ hits in the matching window
+        for every trigger
+    '''
+    rng = np.random.RandomState(seed)
+    n_triggers = n_hits // 2
+    hits_per_trigger = 1 + rng.poisson(1., n_triggers)
+    block_size = 2 + hits_per_trigger
+    block_start = np.cumsum(block_size) - block_size
+    hits = np.zeros(shape=block_size.sum(), dtype=interpreter_idx.hit_idx_dtype)
+    ts_trigger = np.cumsum(rng.randint(0x400, 0x10000, n_triggers)).astype(np.uint64)
+    hits['timestamp'] = np.repeat(ts_trigger, block_size) + rng.randint(0, 0x100, hits.shape[0]).astype(np.uint64)
+    hits['col'] = rng.randint(0, 112, hits.shape[0])
+    hits['row'] = rng.randint(0, 224, hits.shape[0])
+    hits['col'][block_start] = 255
+    hits['timestamp'][block_start] = ts_trigger + np.uint64((wait_cycles + 1) * 16)
+    hits['cnt'][block_start] = np.arange(n_triggers) & 0x7FFF
+    hits['col'][block_start + 1] = 252
+    hits['timestamp'][block_start + 1] = ts_trigger
+    return hits
+
+
+def synthetic_scurves(n_pixels, n_injections=100, seed=0):
+    ''' S-curves of n_pixels pixels (threshold around 30, noise 1 to 3 DAC) of the full matrix
+    '''
+    rng = np.random.RandomState(seed)
+    scan_param_range = np.arange(0, 64)
+    mu = rng.normal(30, 5, n_pixels)
+    sigma = rng.uniform(1., 3., n_pixels)
+    probability = 0.5 * (1. + erf((scan_param_range - mu[:, np.newaxis]) / (np.sqrt(2.) * sigma[:, np.newaxis])))
+    scurves = np.zeros(shape=(112 * 224, scan_param_range.shape[0]), dtype=np.uint16)
+    scurves[:n_pixels] = rng.binomial(n_injections, probability)
+    return scurves, scan_param_range, n_injections
+
+
+def bench_readout(args):
+    from tjmonopix.scan_base import ScanBase
+
+    class ReadoutScan(ScanBase):
+        scan_id = 'bench_readout'
+
+        def scan(self, readout_time=10.):
+            start_time = time.time()
+            with self.readout(scan_param_id=0, clear_buffer=True):
+                self.dut.set_monoread()
+                self.dut.set_timestamp('mon')
+                self.dut.set_tlu()
+                time.sleep(readout_time)
+                self.dut.stop_all()
+            self.duration = time.time() - start_time
+            self.n_words = self.raw_data_earray.nrows
+
+    working_dir = tempfile.mkdtemp()
+    try:
+        bench_config = os.path.join(working_dir, 'testbench.yaml')
+        with open(bench_config, 'w') as f:
+            yaml.dump({'general': {'output_directory': working_dir},
+                       'dut': {'send_data': None,
+                               'simulation': {'hit_rate': args.hit_rate, 'cluster_size': 1.5, 'seed': args.seed}}}, f)
+        scan = ReadoutScan(bench_config=bench_config)
+        scan.start(readout_time=args.readout_time)
+        lost_words = scan.dut.n_lost_words
+    finally:
+        shutil.rmtree(working_dir)
+    return scan.n_words, scan.duration, 'words', {'lost_words': lost_words}
+
+
+def bench_interpreter(args, raw_data):
+    meta_data = np.zeros(shape=1, dtype=meta_dtype)
+    meta_data['index_stop'] = raw_data.shape[0]
+    hit_buffer = np.zeros(shape=args.chunk_size, dtype=hit_dtype)
+    interpreter.RawDataInterpreter().interpret(raw_data[:1000], meta_data, hit_buffer)  # Compile
+    data_interpreter = interpreter.RawDataInterpreter()
+    start_time = time.time()
+    for start in range(0, raw_data.shape[0], args.chunk_size):
+        data_interpreter.interpret(raw_data[start:start + args.chunk_size], meta_data, hit_buffer)
+    return raw_data.shape[0], time.time() - start_time, 'words', {'errors': int(data_interpreter.get_error_count())}
+
+
+def bench_interpreter_idx(args, raw_data):
+    data_interpreter = interpreter_idx.InterRawIdx(chunk=1000)
+    for start in range(0, 10000, 1000):  # Compile, also for the types of the state returned by the previous chunk
+        data_interpreter.run(raw_data[start:start + 1000])
+    data_interpreter = interpreter_idx.InterRawIdx(chunk=args.chunk_size)
+    start_time = time.time()
+    for start in range(0, raw_data.shape[0], args.chunk_size):
+        data_interpreter.run(raw_data[start:start + args.chunk_size])
+    return raw_data.shape[0], time.time() - start_time, 'words', {}
+
+
+def bench_event_builder(args, hits):
+    def build(builder, hits):
+        n_events = 0
+        ev_buffer = np.zeros(args.chunk_size, dtype=event_dtype)
+        for start in range(0, hits.shape[0], args.chunk_size):
+            chunk = hits[start:start + args.chunk_size]
+            events = builder.build_events(chunk, ev_buffer, start + args.chunk_size >= hits.shape[0])
+            n_events += events.shape[0]
+        return n_events
+
+    build(EventBuilder(WINDOW_START, WINDOW_STOP), hits[:1000])  # Compile
+    start_time = time.time()
+    n_events = build(EventBuilder(WINDOW_START, WINDOW_STOP), hits)
+    return hits.shape[0], time.time() - start_time, 'hits', {'events': n_events}
+
+
+def bench_build_inj(args):
+    dat, injlist, inj_period, n_injections = synthetic_injection_hits(args.words // 4, seed=args.seed)
+    thlist = np.zeros_like(injlist)
+    phaselist = np.zeros(injlist.shape[0], dtype=np.uint8)
+
+    def build(dat):
+        buf = np.empty(dat.shape[0], dtype=event_builder_inj.buf_type)
+        return event_builder_inj._build_inj(dat, injlist, thlist, phaselist, inj_period, n_injections, 0, buf, 0, 0,
+                                            injlist.shape[0] - 1, n_injections - 1)
+
+    build(dat[:1000])  # Compile
+    start_time = time.time()
+    err, _, inj_hits, _, _, _, _ = build(dat)
+    return dat.shape[0], time.time() - start_time, 'hits', {'errors': int(err), 'injection_hits': inj_hits.shape[0]}
+
+
+def bench_build_events(args):
+    hits = synthetic_tlu_hits(args.words // 4, seed=args.seed)
+    BuildEvents().run(hits[:1000])  # Compile
+    builder = BuildEvents()
+    n_events = 0
+    start_time = time.time()
+    for start in range(0, hits.shape[0], args.chunk_size):
+        n_events += builder.run(hits[start:start + args.chunk_size]).shape[0]
+    return hits.shape[0], time.time() - start_time, 'hits', {'events': n_events, 'max_pending': max(status['max_fill'] for status in builder.get_status()['buffers'])}
+
+
+def bench_occ_hist2d(args, hits):
+    au.occ_hist2d(hits[:1000])  # Compile
+    start_time = time.time()
+    au.occ_hist2d(hits)
+    return hits.shape[0], time.time() - start_time, 'hits', {}
+
+
+def bench_scurve_hist3d(args, hits):
+    scan_param_range = np.arange(hits['scan_param_id'].max() + 1)
+    au.scurve_hist3d(hits[:1000], scan_param_range)  # Compile
+    start_time = time.time()
+    au.scurve_hist3d(hits, scan_param_range)
+    return hits.shape[0], time.time() - start_time, 'hits', {}
+
+
+def bench_fit_scurves(args, fit_function=au.fit_scurves_multithread):
+    scurves, scan_param_range, n_injections = synthetic_scurves(args.fit_pixels, seed=args.seed)
+    start_time = time.time()
+    thr = fit_function(scurves, scan_param_range, n_injections)[0]
+    return args.fit_pixels, time.time() - start_time, 'pixels', {'fitted_pixels': int(np.count_nonzero(thr))}
+
+
+def bench_analysis(args, raw_data):
+    working_dir = tempfile.mkdtemp()
+    try:
+        raw_data_file = os.path.join(working_dir, 'raw_data.h5')
+        with tb.open_file(raw_data_file, 'w') as out_file:
+            out_file.create_earray(out_file.root, name='raw_data', obj=raw_data)
+            meta_data_table = out_file.create_table(out_file.root, name='meta_data', description=MetaTable)
+            meta_data = np.zeros(shape=raw_data.shape[0] // 10000 + 1, dtype=meta_data_table.dtype)
+            meta_data['index_start'] = np.arange(meta_data.shape[0]) * 10000
+            meta_data['index_stop'] = np.minimum(meta_data['index_start'] + 10000, raw_data.shape[0])
+            meta_data_table.append(meta_data)
+            meta_data_table.attrs.scan_id = 'source_scan'
+        rates = {}
+        for n_processes in args.n_processes:
+            analysis = Analysis(raw_data_file, n_processes=n_processes)
+            analysis.chunk_size = args.chunk_size
+            start_time = time.time()
+            analysis.analyze_data()
+            duration = time.time() - start_time
+            rates[str(n_processes)] = raw_data.shape[0] / duration
+    finally:
+        shutil.rmtree(working_dir)
+    return raw_data.shape[0], duration, 'words', {'words_per_s_by_n_processes': rates}
+
+
+def version_info():
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=subprocess.STDOUT).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__,
+            'numba': numba.__version__, 'tables': tb.__version__, 'platform': platform.platform()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--words', type=int, default=5000000, help='Raw data words for the analysis stages')
+    parser.add_argument('--chunk_size', type=int, default=200000)
+    parser.add_argument('--readout_time', type=float, default=10., help='Readout time of the readout stage in s')
+    parser.add_argument('--hit_rate', type=float, default=1e5, help='Cluster rate of the simulated DUT in 1/s')
+    parser.add_argument('--fit_pixels', type=int, default=112 * 224, help='Number of pixels with S-curve')
+    parser.add_argument('--n_processes', type=int, nargs='+', default=[1, 2, 4], help='Processes of the analysis stage')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    raw_data = simulated_raw_data(args.words, seed=args.seed)
+    hits = interpreted_hits(raw_data)
+    stages = {
+        'readout': lambda: bench_readout(args),
+        'interpreter': lambda: bench_interpreter(args, raw_data),
+        'interpreter_idx': lambda: bench_interpreter_idx(args, raw_data),
+        'event_builder': lambda: bench_event_builder(args, hits),
+        'build_inj': lambda: bench_build_inj(args),
+        'build_events': lambda: bench_build_events(args),
+        'occ_hist2d': lambda: bench_occ_hist2d(args, hits),
+        'scurve_hist3d': lambda: bench_scurve_hist3d(args, hits),
+        'fit_scurves': lambda: bench_fit_scurves(args),
+        'fit_scurves_vectorized': lambda: bench_fit_scurves(args, au.fit_scurves_vectorized),
+        'analysis': lambda: bench_analysis(args, raw_data),
+    }
+
+    results = []
+    for stage in args.stages:
+        n, duration, unit, info = stages[stage]()
+        result = {'stage': stage, 'rate': n / duration, 'unit': unit + '/s', 'n': int(n), 'duration': duration}
+        result.update(info)
+        results.append(result)
+        print('{:<25s} {:12.4g} {:<9s} ({:d} {:s} in {:.2f} s)'.format(stage, result['rate'], result['unit'], n, unit, duration))
+
+    with open(args.output, 'w') as f:
+        json.dump({'version': version_info(), 'seed': args.seed, 'words': args.words, 'results': results}, f, indent=2)
@@ -1,9 +1,13 @@
+import os
 import sys
 import logging
 import datetime
+import tempfile
+
+import numpy as np
 
 from time import sleep, time, mktime
-from threading import Thread, Event, Lock
+from threading import Thread, Event, Lock, Condition
 from collections import deque
 from queue import Queue, Empty
 
@@ -30,21 +34,290 @@ class StopTimeout(Exception):
     pass
 
 
+class SpilledChunk(object):
+    ''' Data of a readout chunk that was moved to a temporary file
+    '''
+
+    def __init__(self, data, spill_dir=None):
+        fd, self.filename = tempfile.mkstemp(prefix='fifo_spill_', suffix='.raw', dir=spill_dir)
+        with os.fdopen(fd, 'wb') as f:
+            data.tofile(f)
+        self.dtype = data.dtype
+
+    def load(self):
+        data = np.fromfile(self.filename, dtype=self.dtype)
+        self.remove()
+        return data
+
+    def remove(self):
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+
+class ChunkQueue(object):
+    ''' Bounded FIFO queue for readout chunks (data, timestamp_start, timestamp_stop, error)
+
+        The queue is bounded by the number of data words it holds (high_water, None for an
+        unbounded queue). The policy defines what happens to a chunk that does not fit:
+            'block': wait until the consumer made room (back pressure on the producer)
+            'drop': discard the chunk for this queue only
+            'spill': move the chunk data to a temporary file until it is consumed
+        A single chunk is always accepted by an empty queue.
+    '''
+    policies = ('block', 'drop', 'spill')
+
+    def __init__(self, name, high_water=None, policy='block', spill_dir=None):
+        self.name = name
+        self._queue = deque()
+        self._cond = Condition()
+        self.words = 0
+        self.configure(high_water, policy, spill_dir)
+
+    def configure(self, high_water=None, policy='block', spill_dir=None):
+        ''' Set limit and policy and reset the statistics
+        '''
+        if policy not in self.policies:
+            raise ValueError("Unknown queue policy {}, use one of {}".format(policy, ", ".join(self.policies)))
+        with self._cond:
+            self.high_water = high_water
+            self.policy = policy
+            self.spill_dir = spill_dir
+            self._cancelled = False
+            self.reset_stats()
+
+    def __len__(self):
+        return len(self._queue)
+
+    def reset_stats(self):
+        self.max_words = 0
+        self.max_chunks = 0
+        self.dropped_chunks = 0
+        self.dropped_words = 0
+        self.spilled_chunks = 0
+        self.blocked_time = 0.
+
+    def put(self, item):
+        ''' Add chunk to the queue, returns False if the chunk was dropped
+        '''
+        words = item[0].shape[0]
+        with self._cond:
+            if self.high_water is not None and self._queue and self.words + words > self.high_water:
+                if self.policy == 'block':
+                    start = time()
+                    while not self._cancelled and self._queue and self.words + words > self.high_water:
+                        self._cond.wait(0.1)
+                    self.blocked_time += time() - start
+                if self.policy == 'drop' or self._cancelled:
+                    self.dropped_chunks += 1
+                    self.dropped_words += words
+                    return False
+                elif self.policy == 'spill':
+                    item = (SpilledChunk(item[0], self.spill_dir),) + tuple(item[1:])
+                    self.spilled_chunks += 1
+                    words = 0
+            self._queue.append(item)
+            self.words += words
+            self.max_words = max(self.max_words, self.words)
+            self.max_chunks = max(self.max_chunks, len(self._queue))
+            self._cond.notify_all()
+        return True
+
+    def get(self, timeout=None):
+        ''' Remove and return the oldest chunk, raises Empty if there is none within timeout
+        '''
+        with self._cond:
+            if not self._queue:
+                self._cond.wait(timeout)
+                if not self._queue:
+                    raise Empty
+            item = self._queue.popleft()
+            if item is not None and not isinstance(item[0], SpilledChunk):
+                self.words -= item[0].shape[0]
+            self._cond.notify_all()
+        if item is not None and isinstance(item[0], SpilledChunk):
+            item = (item[0].load(),) + tuple(item[1:])
+        return item
+
+    def close(self):
+        ''' Signal the end of data to the consumer (ignores the queue limit)
+        '''
+        with self._cond:
+            self._queue.append(None)
+            self._cond.notify_all()
+
+    def cancel(self):
+        ''' Stop blocking producers, chunks that do not fit are dropped from now on
+        '''
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
+
+    def clear(self):
+        with self._cond:
+            for item in self._queue:
+                if item is not None and isinstance(item[0], SpilledChunk):
+                    item[0].remove()
+            self._queue.clear()
+            self.words = 0
+            self._cancelled = False
+            self._cond.notify_all()
+
+    def get_status(self):
+        return {'name': self.name, 'chunks': len(self._queue), 'words': self.words, 'high_water': self.high_water,
+                'max_words': self.max_words, 'max_chunks': self.max_chunks,
+                'dropped_chunks': self.dropped_chunks, 'dropped_words': self.dropped_words,
+                'spilled_chunks': self.spilled_chunks, 'blocked_time': self.blocked_time}
+
+
+class RingStats(object):
+    ''' Last values of a quantity (e.g. a latency) for percentiles, with total count, sum and maximum
+
+        Written by one thread only, read without lock by any thread (a value being written
+        may be missed by a concurrent reader).
+    '''
+
+    def __init__(self, size=4096):
+        self._values = np.zeros(size, dtype=np.float64)
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, value):
+        self._values[self.count % self._values.shape[0]] = value
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def get_status(self, percentiles=(50, 90, 99)):
+        values = self._values[:min(self.count, self._values.shape[0])]
+        status = {'count': self.count, 'mean': self.total / self.count if self.count else 0., 'max': self.max}
+        for percentile, value in zip(percentiles, np.percentile(values, percentiles) if values.shape[0] else [0.] * len(percentiles)):
+            status['p{:d}'.format(percentile)] = float(value)
+        return status
+
+
+class ReadoutTelemetry(object):
+    ''' Readout statistics that can be polled while the readout is running
+
+        Every quantity is updated by one thread only (readout thread: get_data latency, words per read,
+        queue depths; worker/writer thread: callback time, dropped sends; watchdog thread: discard
+        counters), thus no lock is needed. get_status returns a JSON serializable snapshot,
+        start_publishing sends it periodically on a ZeroMQ PUB socket.
+    '''
+    n_history = 1000  # Queue depth samples kept
+
+    def __init__(self):
+        self.start_time = time()
+        self.read_latency = RingStats()
+        self.words_per_read = np.zeros(33, dtype=np.int64)  # Bin i: [2**(i - 1), 2**i) words, bin 0: no data
+        self.callback_time = {}
+        self.dropped_sends = 0
+        self.discard_counts = {}
+        self._queue_history = np.zeros((self.n_history, 3), dtype=np.float64)  # time, chunks, words of the worker queue
+        self._queue_samples = 0
+        self._last_queue_sample = 0.
+        self.queue_status = []
+        self._publisher = None
+        self._stop_publishing = Event()
+
+    def add_read(self, latency, words):
+        self.read_latency.add(latency)
+        self.words_per_read[int(words).bit_length()] += 1
+
+    def add_queue_status(self, queue_status, sample_interval=0.1):
+        self.queue_status = queue_status
+        now = time()
+        if now - self._last_queue_sample >= sample_interval:
+            self._last_queue_sample = now
+            self._queue_history[self._queue_samples % self.n_history] = (now - self.start_time, queue_status[0]['chunks'], queue_status[0]['words'])
+            self._queue_samples += 1
+
+    def add_callback(self, name, duration):
+        if name not in self.callback_time:
+            self.callback_time[name] = RingStats()
+        self.callback_time[name].add(duration)
+
+    def get_status(self):
+        filled_bins = np.nonzero(self.words_per_read)[0]
+        n_bins = filled_bins[-1] + 1 if filled_bins.shape[0] else 1
+        n_samples = min(self._queue_samples, self.n_history)
+        history = np.roll(self._queue_history, -(self._queue_samples % self.n_history), axis=0)[-n_samples:] if n_samples else self._queue_history[:0]
+        return {'time': time() - self.start_time,
+                'read_latency': self.read_latency.get_status(),
+                'words_per_read': {'bin_edges': [0] + [1 << i for i in range(n_bins)], 'counts': self.words_per_read[:n_bins].tolist()},
+                'queues': list(self.queue_status),
+                'queue_history': {'time': history[:, 0].tolist(), 'chunks': history[:, 1].astype(int).tolist(),
+                                  'words': history[:, 2].astype(int).tolist()},
+                'callback_time': dict((name, stats.get_status()) for name, stats in list(self.callback_time.items())),
+                'dropped_sends': self.dropped_sends,
+                'discard_counts': dict(self.discard_counts)}
+
+    def start_publishing(self, address, interval=1.):
+        ''' Send the status as JSON every interval seconds on a ZeroMQ PUB socket bound to address
+        '''
+        import zmq
+        context = zmq.Context.instance()
+        socket = context.socket(zmq.PUB)
+        socket.bind(address)
+        self._stop_publishing.clear()
+        self._publisher = Thread(target=self._publish, name='TelemetryThread', args=(socket, interval))
+        self._publisher.daemon = True
+        self._publisher.start()
+
+    def stop_publishing(self):
+        if self._publisher:
+            self._stop_publishing.set()
+            self._publisher.join()
+            self._publisher = None
+
+    def _publish(self, socket, interval):
+        import zmq
+        try:
+            while not self._stop_publishing.wait(interval):
+                try:
+                    socket.send_json(self.get_status(), flags=zmq.NOBLOCK)
+                except zmq.Again:
+                    pass
+        finally:
+            socket.close(linger=0)
+
+
 class FifoReadout(object):
+    ''' Threaded readout of the SRAM FIFO
+
+        The readout thread polls the FIFO and hands every chunk to the worker thread calling
+        callback (e.g. decoding and sending data to the online monitor). If a writer is given
+        (pipelined mode), chunks are also handed to a separate writer thread (e.g. writing data
+        to disk), so a slow consumer does not stall the other one or the readout.
+        The stages are connected by ChunkQueues, bounded by high_water words each.
+        The FIFO is polled every readout_interval or with an adaptive poll period (see configure_polling).
+        Statistics of all threads are collected in telemetry (ReadoutTelemetry) during the readout.
+        Additional consumers can subscribe to the chunks, each one is called from its own thread
+        with its own ChunkQueue and gets the same (read-only) data array.
+    '''
+
     def __init__(self, dut):
         self.dut = dut
         self.callback = None
         self.errback = None
+        self.writer = None
         self.readout_thread = None
         self.worker_thread = None
+        self.writer_thread = None
         self.watchdog_thread = None
         self.fill_buffer = False
         self.readout_interval = 0.003
+        self.configure_polling()
         self._moving_average_time_period = 10.0
-        self._words_per_read = deque(maxlen=int(self._moving_average_time_period / self.readout_interval))
-        self._data_deque = deque()
+        self._words_per_read = deque()  # (read time, words) of the last _moving_average_time_period
+        self._data_deque = ChunkQueue('worker')
+        self._writer_queue = ChunkQueue('writer')
+        self._subscribers = []  # (ChunkQueue, function) of every subscriber
+        self._subscriber_threads = []
         self._data_buffer = deque()
-        self._words_per_read = deque(maxlen=int(self._moving_average_time_period / self.readout_interval))
+        self.telemetry = ReadoutTelemetry()
         self._result = Queue(maxsize=1)
         self._calculate = Event()
         self.stop_readout = Event()
@@ -86,7 +359,77 @@ class FifoReadout(object):
             return None
         return result / float(self._moving_average_time_period)
 
-    def start(self, callback=None, errback=None, reset_rx=False, reset_sram_fifo=False, clear_buffer=False, fill_buffer=False, no_data_timeout=None):
+    def subscribe(self, name, function, high_water=1000000, policy='drop', spill_dir=None):
+        ''' Call function from a separate thread with every readout chunk (data, timestamp_start, timestamp_stop, error)
+
+            The data array is shared with the other consumers and read-only. The subscriber has its own
+            ChunkQueue (see ChunkQueue for high_water and policy), thus with the 'drop' or 'spill' policy
+            a slow subscriber neither stalls the readout nor the other consumers.
+            Subscriptions are kept for all following readouts, subscribe only while the readout is stopped.
+        '''
+        if self._is_running:
+            raise RuntimeError("Readout running: subscribe before start()")
+        if name in [queue.name for queue in self._get_queues()]:
+            raise ValueError("Consumer {} already exists".format(name))
+        self._subscribers.append((ChunkQueue(name, high_water=high_water, policy=policy, spill_dir=spill_dir), function))
+
+    def unsubscribe(self, name):
+        if self._is_running:
+            raise RuntimeError("Readout running: unsubscribe after stop()")
+        self._subscribers = [(queue, function) for queue, function in self._subscribers if queue.name != name]
+
+    def _get_queues(self):
+        return [self._data_deque, self._writer_queue] + [queue for queue, _ in self._subscribers]
+
+    def configure_polling(self, adaptive=False, min_interval=0.0005, max_interval=0.1, target_fill=0.25, fifo_depth=1 << 19):
+        ''' Set how the readout thread polls the FIFO
+
+            Parameters:
+            ----------
+            adaptive : boolean
+                    If False, the FIFO is read every readout_interval. If True, the fill level (FIFO_SIZE) is
+                    read every poll, data are only read if available and the poll period is set from the
+                    observed fill rate, so the fill level stays below target_fill.
+            min_interval, max_interval : float
+                    Bounds of the adaptive poll period in s
+            target_fill : float
+                    Maximum FIFO fill level as fraction of fifo_depth
+            fifo_depth : int
+                    FIFO depth in words (2 MB SRAM of the MIO)
+        '''
+        self.adaptive_polling = adaptive
+        self.min_readout_interval = min_interval
+        self.max_readout_interval = max_interval
+        self.target_fill = target_fill
+        self.fifo_depth = fifo_depth
+        self._reset_polling_stats()
+
+    def _reset_polling_stats(self):
+        self._poll_interval = self.min_readout_interval
+        self._fill_rate = None
+        self._last_poll = None
+        self._polling_stats = {'polls': 0, 'empty_polls': 0, 'interval_sum': 0., 'min_interval': None, 'max_interval': None,
+                               'fill_sum': 0., 'max_fill': 0., 'over_target': 0}
+
+    def start(self, callback=None, errback=None, reset_rx=False, reset_sram_fifo=False, clear_buffer=False, fill_buffer=False, no_data_timeout=None,
+              writer=None, high_water=None, policy='block', spill_dir=None):
+        ''' Start the readout threads
+
+            Parameters:
+            ----------
+            callback : function
+                    Called from the worker thread with every readout chunk
+            errback : function
+                    Called with sys.exc_info() on errors
+            writer : function
+                    Called from the writer thread with every readout chunk (pipelined mode)
+            high_water : int
+                    Maximum number of data words in each stage queue, None for unbounded queues
+            policy : str
+                    What to do if a stage queue is full: 'block', 'drop' or 'spill' (see ChunkQueue)
+            spill_dir : str
+                    Directory for spilled chunks, default is the system temp directory
+        '''
         if self._is_running:
             raise RuntimeError("Readout already running: use stop() before start()")
 
@@ -94,6 +437,7 @@ class FifoReadout(object):
         self._is_running = True
         self.callback = callback
         self.errback = errback
+        self.writer = writer
         self.fill_buffer = fill_buffer
         self._record_count = 0
         if reset_rx:
@@ -105,9 +449,16 @@ class FifoReadout(object):
             if fifo_size != 0:
                 logging.warning("SRAM FIFO not empty when starting FIFO readout: size = {}".format(fifo_size))
         self._words_per_read.clear()
+        self._reset_polling_stats()
         if clear_buffer:
             self._data_deque.clear()
+            self._writer_queue.clear()
             self._data_buffer.clear()
+        for queue in (self._data_deque, self._writer_queue):
+            queue.configure(high_water=high_water, policy=policy, spill_dir=spill_dir)
+        for queue, _ in self._subscribers:
+            queue.clear()
+            queue.reset_stats()
         self.stop_readout.clear()
         self.force_stop.clear()
         if self.errback:
@@ -118,6 +469,16 @@ class FifoReadout(object):
             self.worker_thread = Thread(target=self.worker, name='WorkerThread')
             self.worker_thread.daemon = True
             self.worker_thread.start()
+        if self.writer:
+            self.writer_thread = Thread(target=self.writer_worker, name='WriterThread')
+            self.writer_thread.daemon = True
+            self.writer_thread.start()
+        self._subscriber_threads = []
+        for queue, function in self._subscribers:
+            thread = Thread(target=self._consume, name='{}Thread'.format(queue.name), args=(queue, function))
+            thread.daemon = True
+            thread.start()
+            self._subscriber_threads.append(thread)
         self.readout_thread = Thread(target=self.readout, name="ReadoutThread", kwargs={'no_data_timeout': no_data_timeout})
         self.readout_thread.daemon = True
         self.readout_thread.start()
@@ -131,6 +492,8 @@ class FifoReadout(object):
             self.readout_thread.join(timeout=timeout)
             if self.readout_thread.is_alive():  # If still alive, join() call timed out
                 self.force_stop.set()
+                for queue in self._get_queues():
+                    queue.cancel()
                 if timeout:
                     raise StopTimeout("FIFO stopped due to timeout after {} second(s)".format(timeout))
                 else:
@@ -148,8 +511,13 @@ class FifoReadout(object):
             self.watchdog_thread.join()
         if self.callback:
             self.worker_thread.join()
+        if self.writer:
+            self.writer_thread.join()
+        for thread in self._subscriber_threads:
+            thread.join()
         self.callback = None
         self.errback = None
+        self.writer = None
         logging.info("Stopped FIFO readout")
 
     def print_readout_status(self):
@@ -160,13 +528,88 @@ class FifoReadout(object):
 
         logging.info('Recived words: %d', self._record_count)
         logging.info('Data queue size: %d', len(self._data_deque))
+        for queue in self._get_queues():
+            status = queue.get_status()
+            logging.info('%s queue: %d chunks, %d words (max. %d chunks, %d words), dropped %d chunks (%d words), spilled %d chunks, blocked %.2f s',
+                         status['name'].capitalize(), status['chunks'], status['words'], status['max_chunks'], status['max_words'],
+                         status['dropped_chunks'], status['dropped_words'], status['spilled_chunks'], status['blocked_time'])
         logging.info('SRAM FIFO size: %d', self.dut['fifo']['FIFO_SIZE'])
+        telemetry = self.telemetry.get_status()
+        if telemetry['read_latency']['count']:
+            logging.info('Read latency: median %.2f ms, 99%% %.2f ms, max. %.2f ms', 1e3 * telemetry['read_latency']['p50'],
+                         1e3 * telemetry['read_latency']['p99'], 1e3 * telemetry['read_latency']['max'])
+        for name, callback_time in telemetry['callback_time'].items():
+            logging.info('%s callback time: median %.2f ms, 99%% %.2f ms, max. %.2f ms', name.capitalize(), 1e3 * callback_time['p50'],
+                         1e3 * callback_time['p99'], 1e3 * callback_time['max'])
+        if telemetry['dropped_sends']:
+            logging.warning('%d chunks were not sent to the online monitor (socket busy)', telemetry['dropped_sends'])
+        status = self.get_polling_status()
+        if status['polls']:
+            logging.info('Polling: %d polls (%d without data), period mean %.2f ms (%.2f - %.2f ms), fill level mean %.2f%%, max. %.2f%%, %d polls above target',
+                         status['polls'], status['empty_polls'], 1e3 * status['mean_interval'], 1e3 * status['min_interval'],
+                         1e3 * status['max_interval'], 100. * status['mean_fill'], 100. * status['max_fill'], status['over_target'])
         logging.info('Channel:                     %s', " | ".join(['TDC', 'DATA_RX', 'TLU', 'TIMESTAMP']))
         logging.info('Discard counter:             %s', " | ".join([str(tdc_discard_count).rjust(3), str(data_rx_lost_count).rjust(7),
                                                                     str(tlu_lost_count).rjust(3), str(timestamp_lost_count).rjust(9)]))
 
         if tdc_discard_count or data_rx_lost_count:
             logging.warning('Errors detected')
+        if self._writer_queue.dropped_chunks:
+            logging.warning('%d chunks were not written to disk (writer queue full)', self._writer_queue.dropped_chunks)
+
+    def get_queue_status(self):
+        ''' Occupancy of the readout stage queues
+        '''
+        return [queue.get_status() for queue in self._get_queues()]
+
+    def get_polling_status(self):
+        ''' Statistics of the FIFO polling: poll periods in s, fill levels as fraction of fifo_depth
+        '''
+        stats = self._polling_stats
+        status = dict(stats)
+        n_intervals = max(stats['polls'] - 1, 1)
+        status['mean_interval'] = stats['interval_sum'] / n_intervals
+        status['mean_fill'] = stats['fill_sum'] / max(stats['polls'], 1)
+        status['min_interval'] = stats['min_interval'] or 0.
+        status['max_interval'] = stats['max_interval'] or 0.
+        del status['interval_sum'], status['fill_sum']
+        return status
+
+    def _update_polling(self, fill_words, time_read):
+        ''' Add the fill level of a poll to the statistics and return the period until the next poll
+        '''
+        stats = self._polling_stats
+        fill = fill_words / float(self.fifo_depth)
+        stats['polls'] += 1
+        stats['fill_sum'] += fill
+        stats['max_fill'] = max(stats['max_fill'], fill)
+        if fill > self.target_fill:
+            stats['over_target'] += 1
+        if not fill_words:
+            stats['empty_polls'] += 1
+        if self._last_poll is not None:
+            interval = time_read - self._last_poll
+            stats['interval_sum'] += interval
+            stats['min_interval'] = interval if stats['min_interval'] is None else min(stats['min_interval'], interval)
+            stats['max_interval'] = interval if stats['max_interval'] is None else max(stats['max_interval'], interval)
+        if not self.adaptive_polling:
+            self._last_poll = time_read
+            return self.readout_interval
+
+        # The FIFO is empty after every read, thus the fill level is the data of one poll period
+        if self._last_poll is not None and time_read > self._last_poll:
+            fill_rate = fill_words / (time_read - self._last_poll)
+            self._fill_rate = fill_rate if self._fill_rate is None else 0.5 * (self._fill_rate + fill_rate)
+        self._last_poll = time_read
+        if fill > self.target_fill or self._fill_rate is None:
+            interval = self.min_readout_interval
+        elif self._fill_rate > 0:
+            # Aim at half of the target for rate fluctuations, increase slowly after bursts
+            interval = min(0.5 * self.target_fill * self.fifo_depth / self._fill_rate, 2. * self._poll_interval)
+        else:
+            interval = 2. * self._poll_interval
+        self._poll_interval = min(max(interval, self.min_readout_interval), self.max_readout_interval)
+        return self._poll_interval
 
     # Helper functions to be called from 'main' methods
     def readout(self, no_data_timeout=None):
@@ -182,11 +625,22 @@ class FifoReadout(object):
                 time_read = time()
                 if no_data_timeout and curr_time + no_data_timeout < self.get_float_time():
                     raise NoDataTimeout("Received no data for {:.2f} second(s)".format(no_data_timeout))
-                data = self.read_data()
+                if self.adaptive_polling:
+                    fill_words = self.get_fifo_size()
+                    data = self.read_data() if fill_words else None  # Save the read transfer if empty
+                else:
+                    data = self.read_data()
+                    fill_words = data.shape[0]  # All data are read, thus the data size is the fill level
+                if data is None:
+                    data = np.zeros(0, dtype=np.uint32)
+                else:
+                    self.telemetry.add_read(time() - time_read, data.shape[0])
                 self._record_count += len(data)
+                poll_interval = self._update_polling(fill_words, time_read)
 
             except Exception as exc:
                 no_data_timeout = None
+                poll_interval = self.readout_interval
                 if self.errback:
                     self.errback(sys.exc_info())
                 else:
@@ -199,25 +653,35 @@ class FifoReadout(object):
                 if data_words > 0:
                     last_time, curr_time = self.update_timestamp()
                     status = 0
+                    data.flags.writeable = False  # Shared by all consumers
 
                     if self.callback:
-                        self._data_deque.append((data, last_time, curr_time, status))
+                        self._data_deque.put((data, last_time, curr_time, status))
+                    if self.writer:
+                        self._writer_queue.put((data, last_time, curr_time, status))
                     if self.fill_buffer:
                         self._data_buffer.append((data, last_time, curr_time, status))
-                    self._words_per_read.append(data_words)
+                    for queue, _ in self._subscribers:
+                        queue.put((data, last_time, curr_time, status))
+                    self._words_per_read.append((time_read, data_words))
                 elif self.stop_readout.is_set():
                     break
-                else:
-                    self._words_per_read.append(0)
+                while self._words_per_read and self._words_per_read[0][0] < time_read - self._moving_average_time_period:
+                    self._words_per_read.popleft()
+                self.telemetry.add_queue_status(self.get_queue_status())
 
             finally:
-                time_wait = self.readout_interval - (time() - time_read)
+                time_wait = poll_interval - (time() - time_read)
             if self._calculate.is_set():
                 self._calculate.clear()
-                self._result.put(sum(self._words_per_read))
+                self._result.put(sum(words for _, words in self._words_per_read))
 
         if self.callback:
-            self._data_deque.append(None)  # Set last item to None to stop worker_thread
+            self._data_deque.close()  # Set last item to None to stop worker_thread
+        if self.writer:
+            self._writer_queue.close()  # Set last item to None to stop writer_thread
+        for queue, _ in self._subscribers:
+            queue.close()
         logging.debug("Stopped {}".format(self.readout_thread.name))
 
     def worker(self):
@@ -225,35 +689,51 @@ class FifoReadout(object):
         Worker thread continuously calling callback function when data is available"
         """
         logging.debug("Stating {}".format(self.worker_thread.name))
+        self._consume(self._data_deque, self.callback)
+        logging.debug("Stopped {}".format(self.worker_thread.name))
+
+    def writer_worker(self):
+        """
+        Writer thread continuously calling writer function when data is available
+        """
+        logging.debug("Stating {}".format(self.writer_thread.name))
+        self._consume(self._writer_queue, self.writer)
+        logging.debug("Stopped {}".format(self.writer_thread.name))
+
+    def _consume(self, queue, function):
         while True:
             try:
-                data = self._data_deque.popleft()
-            except IndexError:
-                self.stop_readout.wait(self.readout_interval)  # sleep to reduce CPU usage
-            else:
-                if data is None:  # if None then exit
-                    break
+                data = queue.get(timeout=self.readout_interval)
+            except Empty:
+                continue
+            if data is None:  # if None then exit
+                break
+            try:
+                start = time()
+                function(data)
+                self.telemetry.add_callback(queue.name, time() - start)
+            except Exception:
+                if self.errback:
+                    self.errback(sys.exc_info())
                 else:
-                    try:
-                        self.callback(data)
-                    except Exception:
-                        self.errback(sys.exc_info())
-
-        logging.debug("Stopped {}".format(self.watchdog_thread.name))
+                    logging.exception('Exception in %s', function)
 
     def watchdog(self):
         logging.debug('Starting %s', self.watchdog_thread.name)
         while True:
             try:
+                self.telemetry.discard_counts = {'tdc': self.get_tdc_fifo_discard_count(), 'data_rx': self.get_data_rx_fifo_discard_count(),
+                                                 'tlu': self.get_data_tlu_fifo_discard_count(),
+                                                 'timestamp': self.get_data_timestamp_fifo_discard_count()}
                 #if not any(self.get_rx_sync_status()):
                 #    raise RxSyncError('No RX sync')
                 #if any(self.get_rx_8b10b_error_count()):
                 #    raise EightbTenbError('RX 8b10b error(s) detected')
 
-                if self.get_data_rx_fifo_discard_count():
+                if self.telemetry.discard_counts['data_rx']:
                     raise FifoError('DATA RX FIFO discard error(s) detected')
 
-                if self.get_tdc_fifo_discard_count():
+                if self.telemetry.discard_counts['tdc']:
                     raise FifoError('TDC FIFO discard error(s) detected')
             except Exception:
                 self.errback(sys.exc_info())
@@ -279,6 +759,11 @@ class FifoReadout(object):
         self.timestamp = curr_time
         return last_time, curr_time
 
+    def get_fifo_size(self):
+        ''' FIFO fill level in words
+        '''
+        return self.dut['fifo']['FIFO_SIZE'] // 4
+
     def read_status(self):
         raise NotImplementedError()
 
@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import numpy as np
+import tables as tb
+from scipy.special import erf
+from tjmonopix.analysis import analysis_utils as au
+
+
+class TestAnalysisUtils(unittest.TestCase):
+    def test_fit_scurves_vectorized(self):
+        ''' Vectorized S-curve fit has to give the same results as the curve_fit of every pixel '''
+        rng = np.random.RandomState(0)
+        n_injections, n_pixels = 100, 50
+        scan_param_range = np.arange(0, 64)
+        mu = rng.normal(30, 5, n_pixels)
+        sigma = rng.uniform(1., 3., n_pixels)
+        for invert_x in [False, True]:
+            sign = -1. if invert_x else 1.
+            probability = 0.5 * (1. + sign * erf((scan_param_range - mu[:, np.newaxis]) / (np.sqrt(2.) * sigma[:, np.newaxis])))
+            scurves = np.zeros(shape=(112 * 224, scan_param_range.shape[0]), dtype=np.uint16)
+            scurves[:n_pixels] = rng.binomial(n_injections, probability)
+            scurves[n_pixels:2 * n_pixels] = rng.randint(0, 10, size=(n_pixels, scan_param_range.shape[0]))  # Not fittable
+
+            thr, sig, chi2 = [m.ravel() for m in au.fit_scurves_vectorized(scurves, scan_param_range, n_injections, invert_x=invert_x)]
+            expected = np.array([au.fit_scurve(scurve, scan_param_range, n_injections, 1., invert_x) for scurve in scurves[:2 * n_pixels]])
+
+            np.testing.assert_allclose(thr[:2 * n_pixels], expected[:, 0], rtol=1e-4)
+            np.testing.assert_allclose(sig[:2 * n_pixels], expected[:, 1], rtol=1e-3)
+            np.testing.assert_allclose(chi2[:2 * n_pixels], expected[:, 2], rtol=1e-3)
+            self.assertFalse(np.any(thr[2 * n_pixels:]))
+
+    def test_assign_scan_ids(self):
+        ''' Hits in gaps and unordered meta data have to be flagged, all hits have to get a scan_param_id '''
+        meta_data = np.zeros(3, dtype=[('index_start', '<u4'), ('index_stop', '<u4'), ('scan_param_id', '<u2')])
+        meta_data['index_start'], meta_data['index_stop'], meta_data['scan_param_id'] = [0, 10, 25], [10, 20, 30], [5, 6, 7]
+        for meta_data, expected_flags in [(meta_data, au.SCAN_ID_GAP), (meta_data[[2, 0, 1]], au.SCAN_ID_GAP | au.SCAN_ID_UNSORTED)]:
+            scan_id_index, flags = au.get_scan_id_index(meta_data)
+            hits = np.zeros(8, dtype=[('col', 'u1'), ('scan_param_id', '<u4')])
+            hits['scan_param_id'] = [0, 9, 10, 19, 22, 25, 29, 41]  # 22 in a gap, 41 after the last readout
+            gap_flags, n_gaps, meta_idx = au.assign_scan_ids(hits, scan_id_index)
+            np.testing.assert_array_equal(hits['scan_param_id'], [5, 5, 6, 6, 6, 7, 7, 7])
+            self.assertEqual((flags | gap_flags, n_gaps), (expected_flags, 2))
+            self.assertEqual(scan_id_index[meta_idx]['scan_param_id'], 7)
+        self.assertEqual(au.assign_scan_ids(hits[:0], scan_id_index, 2), (0, 0, 2))
+
+    def test_assign_scan_ids_chunks(self):
+        ''' Chunk by chunk with a large meta data table the result has to be the one of a single call, the time per
+            chunk must not grow with the meta data size '''
+        n_meta, n_chunks = 2000000, 2000
+        meta_data = np.zeros(n_meta, dtype=[('index_start', '<u8'), ('index_stop', '<u8'), ('scan_param_id', '<u2')])
+        meta_data['index_start'] = np.arange(n_meta, dtype=np.uint64) * 10
+        meta_data['index_stop'] = meta_data['index_start'] + 8  # Gaps of 2 words
+        meta_data['scan_param_id'] = np.arange(n_meta) // 1000
+        scan_id_index, flags = au.get_scan_id_index(meta_data)
+        self.assertEqual(flags, 0)
+        hits = np.zeros(n_chunks * 100, dtype=[('col', 'u1'), ('scan_param_id', '<i8')])
+        hits['scan_param_id'] = np.sort(np.random.RandomState(0).randint(0, n_meta * 10, hits.shape[0]))
+        last_readout = hits['scan_param_id'][-1] // 10
+        expected = hits.copy()
+        _, expected_gaps, _ = au.assign_scan_ids(expected, scan_id_index)
+        np.testing.assert_array_equal(expected['scan_param_id'], (hits['scan_param_id'] // 10) // 1000)
+
+        start_time, meta_idx, n_gaps = time.time(), 0, 0
+        for chunk in np.array_split(hits, n_chunks):
+            _, chunk_gaps, meta_idx = au.assign_scan_ids(chunk, scan_id_index, meta_idx)
+            n_gaps += chunk_gaps
+        self.assertLess(time.time() - start_time, 5.)  # Searching all rows every chunk takes minutes
+        np.testing.assert_array_equal(hits, expected)
+        self.assertEqual((n_gaps, meta_idx), (expected_gaps, last_readout))
+
+    def test_scan_param_index(self):
+        ''' Scan parameter ranges built chunk by chunk have to give the hits of one scan parameter '''
+        working_dir = tempfile.mkdtemp()
+        try:
+            hits = np.zeros(1000, dtype=[('col', 'u1'), ('scan_param_id', '<i4')])
+            hits['scan_param_id'] = np.repeat([0, 1, 2, 1], [100, 350, 300, 250])  # Scan parameter 1 twice
+            hits['col'] = np.arange(1000) % 112
+            with tb.open_file(os.path.join(working_dir, 'interpreted.h5'), 'w') as h5_file:
+                h5_file.create_table(h5_file.root, name='Dut', obj=hits)
+                self.assertEqual(au.read_scan_param_index(h5_file)[0].shape[0], 4)  # Without index table
+                index = au.create_scan_param_index(h5_file, node='Dut', chunk_size=128)
+                np.testing.assert_array_equal(index['start'], [0, 100, 450, 750])
+                np.testing.assert_array_equal(index['stop'], [100, 450, 750, 1000])
+                np.testing.assert_array_equal(au.read_scan_param(h5_file, 2), hits[450:750])
+                np.testing.assert_array_equal(au.read_scan_param(h5_file, 1), hits[hits['scan_param_id'] == 1])
+                self.assertEqual(au.read_scan_param(h5_file, 3).shape[0], 0)
+        finally:
+            shutil.rmtree(working_dir)
+
+    def test_ring_buffer(self):
+        ''' Pending rows have to stay in order when they are moved to the start and the oldest rows are dropped if the capacity is exceeded '''
+        rows = np.zeros(25, dtype=[('timestamp', '<u8'), ('col', 'u1')])
+        rows['timestamp'] = np.arange(25)
+        ring = au.RingBuffer(10, dtype=[('timestamp', '<u8')], name='ts')
+        ring.append(rows[:6])
+        ring.consume(4)
+        ring.append(rows[6:12])  # Does not fit at the end
+        np.testing.assert_array_equal(ring.data['timestamp'], np.arange(4, 12))
+        ring.append(rows[12:15])  # Exceeds the capacity
+        np.testing.assert_array_equal(ring.data['timestamp'], np.arange(5, 15))
+        ring.append(rows[15:])  # More rows than the capacity
+        np.testing.assert_array_equal(ring.data['timestamp'], np.arange(15, 25))
+        ring.consume(20)
+        status = ring.get_status()
+        self.assertEqual((status['fill'], status['max_fill'], status['appended'], status['consumed'], status['dropped'], status['moves']),
+                         (0, 10, 25, 14, 11, 2))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import tables as tb
+from tjmonopix.analysis import event_builder, event_builder_basic, event_builder_mon
+
+hit_dtype = [('col', 'u1'), ('row', '<u2'), ('le', 'u1'), ('te', 'u1'), ('cnt', '<u4'), ('timestamp', '<i8'), ('scan_param_id', '<i4')]
+event_dtype = [('event_number', '<i8'), ('frame', 'u1'), ('column', 'u1'), ('row', 'u1'), ('charge', 'u1')]
+
+
+def generate_hits(n_triggers, hits_per_trigger, seed=0):
+    ''' TLU words with hits_per_trigger TJ hits in the event window and noise hits between the triggers,
+        the timestamps overflow the 19 bit TLU timestamp and the trigger numbers the 16 bit TLU counter
+    '''
+    rng = np.random.RandomState(seed)
+    trigger_ts = (0x7FFF0 + np.cumsum(rng.randint(3000, 300000, n_triggers))) & ~0xF
+    blocks = []
+    for trigger, timestamp in enumerate(trigger_ts):
+        hits = np.zeros(hits_per_trigger + 2, dtype=hit_dtype)
+        hits['col'][:-1] = rng.randint(0, 112, hits_per_trigger + 1)
+        hits['row'] = rng.randint(0, 224, hits_per_trigger + 2)
+        hits['te'] = rng.randint(0, 64, hits_per_trigger + 2)
+        hits['timestamp'][:hits_per_trigger] = np.sort(timestamp + 16 * rng.randint(-48, 32, hits_per_trigger))
+        hits['timestamp'][hits_per_trigger] = timestamp + 1500  # Noise hit after the window
+        hits['col'][-1] = 0xFF  # TLU word after the hits before the trigger
+        hits['cnt'][-1] = (0xFFF0 + trigger) & 0xFFFF
+        hits['timestamp'][-1] = timestamp & 0x7FFF0
+        n_before = np.count_nonzero(hits['timestamp'][:hits_per_trigger] < timestamp)
+        blocks.append(np.r_[hits[:n_before], hits[-1:], hits[n_before:-1]])
+    return np.concatenate(blocks)
+
+
+def generate_tlu_hits(n_triggers, wait_cycles=20, seed=0):
+    ''' interpreter_idx hits: TLU word, trigger timestamp and one TJ hit per trigger (trigger number + 1 in row) '''
+    rng = np.random.RandomState(seed)
+    hits = np.zeros(3 * n_triggers, dtype=[('col', 'u1'), ('row', '<u2'), ('le', 'u1'), ('te', 'u1'), ('cnt', '<u4'), ('timestamp', '<u8')])
+    trigger_ts = np.cumsum(rng.randint(0x400, 0x10000, n_triggers)).astype(np.uint64)
+    hits['col'][0::3], hits['cnt'][0::3] = 0xFF, np.arange(n_triggers)
+    hits['timestamp'][0::3] = (trigger_ts + np.uint64((wait_cycles + 1) * 16)) & np.uint64(0x7FFFF)
+    hits['col'][1::3], hits['timestamp'][1::3] = 0xFC, trigger_ts
+    hits['col'][2::3], hits['row'][2::3] = rng.randint(0, 112, n_triggers), np.arange(n_triggers) + 1
+    hits['timestamp'][2::3] = trigger_ts + rng.randint(0, 0x80, n_triggers).astype(np.uint64)
+    return hits
+
+
+class TestEventBuilder(unittest.TestCase):
+    def test_events(self):
+        ''' All hits in the window have to be in the event, independent of the chunk and event buffer size and with a restored state '''
+        hits = generate_hits(500, 40)
+        tj_hits = hits[hits['col'] < 112]
+        window_hits = tj_hits[np.arange(tj_hits.shape[0]) % 41 != 40]
+
+        results = []
+        for chunk_size, buffer_size in [(hits.shape[0], hits.shape[0]), (1000, hits.shape[0]), (97, hits.shape[0]), (hits.shape[0], 100)]:
+            builder = event_builder.EventBuilder(event_builder.WINDOW_START, event_builder.WINDOW_STOP)
+            events = []
+            for start in range(0, hits.shape[0], chunk_size):
+                if start == 5 * chunk_size:
+                    state = event_builder.get_state(builder)
+                    builder = event_builder.EventBuilder(event_builder.WINDOW_START, event_builder.WINDOW_STOP)
+                    event_builder.set_state(builder, state)
+                flush = start + chunk_size >= hits.shape[0]
+                events.append(builder.build_events(hits[start:start + chunk_size], np.zeros(buffer_size, dtype=event_dtype), flush).copy())
+                while flush and builder.n_triggers:  # Event buffer was full
+                    events.append(builder.build_events(hits[:0], np.zeros(buffer_size, dtype=event_dtype), True).copy())
+            results.append(np.concatenate(events))
+
+        np.testing.assert_array_equal(results[0]['event_number'], np.repeat(0xFFF0 + np.arange(500), 40))  # Trigger number overflow
+        np.testing.assert_array_equal(results[0]['column'], window_hits['col'] + 1)
+        np.testing.assert_array_equal(results[0]['row'], window_hits['row'] + 1)
+        np.testing.assert_array_equal(results[0]['charge'], ((window_hits['te'] - window_hits['le']) & 0x3F) + 1)
+        for result in results[1:]:
+            np.testing.assert_array_equal(result, results[0])
+
+    def test_window_edges(self):
+        ''' Hits from trigger - 768 to trigger + 527 have to be in the event, hits just outside not '''
+        trigger_ts = 0x7FFF0 + 0x1000
+        offsets = np.array([-769, -768, -1, 0, 520, 527, 528])
+        hits = np.zeros(offsets.shape[0] + 1, dtype=hit_dtype)
+        hits['row'][:-1] = np.arange(offsets.shape[0])
+        hits['timestamp'][:-1] = trigger_ts + offsets
+        hits['col'][-1], hits['timestamp'][-1] = 0xFF, trigger_ts & 0x7FFF0
+        hits = np.r_[hits[:3], hits[-1:], hits[3:-1]]  # TLU word after the hits before the trigger
+        builder = event_builder.EventBuilder(event_builder.WINDOW_START, event_builder.WINDOW_STOP)
+        events = builder.build_events(hits, np.zeros(hits.shape[0], dtype=event_dtype), True)
+        np.testing.assert_array_equal(events['row'] - 1, [1, 2, 3, 4, 5])
+
+    def test_tlu_resync(self):
+        ''' Lost TLU words and trigger timestamps must only lose their own trigger, independent of the chunk and output size '''
+        hits = generate_tlu_hits(2000, wait_cycles=10)
+        lost_tlu, lost_ts = [100, 101, 1500], [700, 1200, 1201, 1202]
+        hits = np.delete(hits, np.r_[3 * np.array(lost_tlu), 3 * np.array(lost_ts) + 1])
+        for chunk_size, n in [(hits.shape[0], 10000), (1000, 10000), (37, 10000), (hits.shape[0], 50)]:  # n < events: drained with flush
+            builder = event_builder_basic.BuildEvents(WAIT_CYCLES=10, n=n, capacity=10000)
+            events = np.concatenate([builder.run(hits[start:start + chunk_size], start + chunk_size >= hits.shape[0]).copy()
+                                     for start in range(0, hits.shape[0], chunk_size)])
+            np.testing.assert_array_equal(events['trigger_number'], np.setdiff1d(np.arange(2000), lost_tlu + lost_ts))
+            np.testing.assert_array_equal(events['row'], events['trigger_number'] + 1)
+            status = builder.get_status()
+            self.assertEqual((status['dropped_tlu'], status['dropped_ts'], status['synced']), (len(lost_ts), len(lost_tlu), 2000 - 7))
+        events_short = event_builder_basic.BuildEvents(WAIT_CYCLES=10, data_format=0x0).run(hits, flush=True)  # Format of the correlator
+        self.assertEqual(events_short.dtype, np.dtype(event_builder_basic.event_dtype_short))
+        np.testing.assert_array_equal(events_short['trigger_number'], events['trigger_number'])
+
+    def test_build_h5(self):
+        ''' The events of build_h5 have to keep the file format with trigger_timestamp '''
+        hits = generate_tlu_hits(100, wait_cycles=10)
+        working_dir = tempfile.mkdtemp()
+        try:
+            hit_file, event_file = os.path.join(working_dir, 'hits.h5'), os.path.join(working_dir, 'events.h5')
+            with tb.open_file(hit_file, 'w') as h5_file:
+                h5_file.create_table(h5_file.root, name='Hits', obj=hits)
+            events = event_builder_mon.build_h5(None, hit_file, event_file, n=37, WAIT_CYCLES=10)
+            expected = event_builder_basic.BuildEvents(WAIT_CYCLES=10).run(hits, flush=True)
+            self.assertEqual(events.dtype, np.dtype(event_builder_mon.h5_event_dtype))
+            np.testing.assert_array_equal(events['trigger_timestamp'], expected['ts_timestamp'])
+            np.testing.assert_array_equal(events['row'], expected['row'])
+        finally:
+            shutil.rmtree(working_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+import json
+import time
+import unittest
+import zmq
+from fifo_readout import FifoReadout
+from tjmonopix.sim_dut import SimulatedDut
+
+
+class TestFifoReadout(unittest.TestCase):
+    def test_adaptive_polling(self):
+        ''' Adaptive polling has to read all data with fewer polls and keep the FIFO fill level low '''
+        dut = SimulatedDut(hit_rate=1e4, seed=0)
+        fifo_readout = FifoReadout(dut)
+        fifo_readout.configure_polling(adaptive=True, min_interval=0.001, max_interval=0.05, target_fill=0.1, fifo_depth=10000)
+        n_words = [0]
+
+        def callback(data_tuple):
+            n_words[0] += data_tuple[0].shape[0]
+
+        fifo_readout.start(callback=callback)
+        dut.set_monoread()
+        time.sleep(1.)
+        dut.stop_monoread()
+        time.sleep(1.)
+        fifo_readout.stop()
+
+        status = fifo_readout.get_polling_status()
+        self.assertEqual(dut.n_lost_words, 0)
+        self.assertEqual(n_words[0], dut.n_words)
+        self.assertLess(status['polls'], 500)  # Fixed 1 ms polling: 2000
+        self.assertLess(status['max_fill'], 0.5)
+        self.assertGreater(status['max_interval'], 0.04)  # Idle FIFO
+
+    def test_telemetry(self):
+        ''' Telemetry has to be available during the readout and on the side channel '''
+        dut = SimulatedDut(hit_rate=1e4, seed=0)
+        fifo_readout = FifoReadout(dut)
+        context = zmq.Context.instance()
+        socket = context.socket(zmq.SUB)
+        socket.setsockopt(zmq.SUBSCRIBE, b'')
+        socket.setsockopt(zmq.RCVTIMEO, 2000)
+        fifo_readout.telemetry.start_publishing('tcp://127.0.0.1:5599', interval=0.1)
+        socket.connect('tcp://127.0.0.1:5599')
+        try:
+            fifo_readout.start(callback=lambda data_tuple: time.sleep(0.002))
+            dut.set_monoread()
+            time.sleep(0.5)
+            status = json.loads(json.dumps(fifo_readout.telemetry.get_status()))
+            published = socket.recv_json()
+            dut.stop_monoread()
+            fifo_readout.stop()
+        finally:
+            fifo_readout.telemetry.stop_publishing()
+            socket.close(linger=0)
+
+        self.assertGreater(status['read_latency']['count'], 10)
+        self.assertAlmostEqual(sum(status['words_per_read']['counts']), status['read_latency']['count'], delta=1)  # Concurrent update
+        self.assertGreater(status['callback_time']['worker']['p50'], 0.0015)
+        self.assertEqual(status['queues'][0]['name'], 'worker')
+        self.assertGreater(len(status['queue_history']['time']), 0)
+        self.assertIn('read_latency', published)
+
+    def test_subscribers(self):
+        ''' Every subscriber has to get the same read-only chunks, a slow subscriber must not stall the others '''
+        dut = SimulatedDut(hit_rate=1e4, seed=0)
+        fifo_readout = FifoReadout(dut)
+        fast_chunks, slow_chunks = [], []
+        fifo_readout.subscribe('fast', lambda data_tuple: fast_chunks.append(data_tuple[0]), high_water=None)
+        fifo_readout.subscribe('slow', lambda data_tuple: (slow_chunks.append(data_tuple[0]), time.sleep(0.05)), high_water=1, policy='drop')
+        with self.assertRaises(ValueError):
+            fifo_readout.subscribe('fast', lambda data_tuple: None)
+        fifo_readout.start()
+        dut.set_monoread()
+        time.sleep(0.5)
+        dut.stop_monoread()
+        fifo_readout.stop()
+
+        status = dict((queue_status['name'], queue_status) for queue_status in fifo_readout.get_queue_status())
+        self.assertEqual(sum(chunk.shape[0] for chunk in fast_chunks), dut.n_words)
+        self.assertEqual(status['fast']['dropped_chunks'], 0)
+        self.assertGreater(status['slow']['dropped_chunks'], 0)
+        self.assertEqual(len(slow_chunks) + status['slow']['dropped_chunks'], len(fast_chunks))
+        self.assertTrue(any(slow_chunk is fast_chunk for slow_chunk in slow_chunks[1:2] for fast_chunk in fast_chunks))  # Not copied
+        self.assertFalse(fast_chunks[0].flags.writeable)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,38 @@
+import os
+import shutil
+import tempfile
 import unittest
 import numpy as np
-from tjmonopix.analysis import interpreter
+import tables as tb
+from tjmonopix.analysis import interpreter, interpreter_idx
+from tjmonopix.analysis.analysis import Analysis
+from tjmonopix.scan_base import MetaTable
+
+
+def generate_raw_data(n_words, error_rate=0., seed=0):
+    ''' Random TJ hits, timestamp blocks and TLU words with some corrupted and swapped words
+    '''
+    rng = np.random.RandomState(seed)
+    n_blocks = n_words // 3
+    kind = rng.choice(4, size=n_blocks, p=[0.6, 0.2, 0.05, 0.15])  # TJ, timestamp, timestamp header, TLU
+    lengths = np.array([4, 3, 1, 1])[kind]
+    starts = np.cumsum(lengths) - lengths
+    word_kind = np.repeat(kind, lengths)
+    word_number = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+    header = np.repeat(rng.choice([0x6, 0x4, 0x5, 0x7], size=n_blocks), lengths)
+    raw_data = rng.randint(0, 1 << 28, size=word_kind.shape[0]).astype(np.uint32)
+    raw_data[word_kind == 0] |= (word_number[word_kind == 0] << 28).astype(np.uint32)
+    sel = word_kind == 1
+    raw_data[sel] = (raw_data[sel] & 0xFFFFFF) | ((header[sel] << 28) | ((3 - word_number[sel]) << 24)).astype(np.uint32)
+    sel = word_kind == 2
+    raw_data[sel] = (raw_data[sel] & 0xFFFFFF) | (header[sel] << 28).astype(np.uint32)
+    raw_data[word_kind == 3] |= np.uint32(0x80000000)
+
+    errors = np.where(rng.uniform(size=raw_data.shape[0]) < error_rate)[0]
+    raw_data[errors] = rng.randint(0, 1 << 32, size=errors.shape[0], dtype=np.int64).astype(np.uint32)
+    swaps = np.where(rng.uniform(size=raw_data.shape[0] - 1) < error_rate)[0]
+    raw_data[swaps], raw_data[swaps + 1] = raw_data[swaps + 1], raw_data[swaps].copy()
+    return raw_data[:n_words]
 
 
 class TestInterpreter(unittest.TestCase):
@@ -60,6 +92,99 @@ class TestInterpreter(unittest.TestCase):
         np.testing.assert_array_equal(hit_data, self.expected_broken_hit_data)
         self.assertEqual(errors, 2)
 
+    def test_streaming(self):
+        ''' Interpret data readout chunk by readout chunk '''
+        for raw_data, meta_data, expected_hit_data, expected_errors in [
+                (self.correct_raw_data, self.meta_data_for_correct, self.expected_correct_hit_data, 0),
+                (self.broken_raw_data, self.meta_data_for_broken, self.expected_broken_hit_data, 2)]:
+            for raw_idx in [0, (1 << 32) - 10]:  # Raw data index overflowing 32 bit during the run
+                my_interpreter = interpreter.StreamingInterpreter()
+                my_interpreter.data_interpreter.raw_idx = raw_idx
+                hit_data = []
+                for index_start, index_stop, scan_param_id in meta_data:
+                    hit_data.append(my_interpreter.interpret(raw_data[index_start:index_stop], scan_param_id).copy())
+                hit_data = np.concatenate(hit_data)
+
+                for name in expected_hit_data.dtype.names:
+                    np.testing.assert_array_equal(hit_data[name], expected_hit_data[name])
+                self.assertEqual(my_interpreter.get_error_count(), expected_errors)
+
+    def test_parallel(self):
+        ''' Parallel analysis has to give the same hits and errors as the serial analysis '''
+        working_dir = tempfile.mkdtemp()
+        try:
+            raw_data_file = os.path.join(working_dir, 'raw_data.h5')
+            raw_data = generate_raw_data(200000, 1e-3, 1)
+            with tb.open_file(raw_data_file, 'w') as out_file:
+                out_file.create_earray(out_file.root, name='raw_data', obj=raw_data)
+                meta_data_table = out_file.create_table(out_file.root, name='meta_data', description=MetaTable)
+                meta_data = np.zeros(shape=200, dtype=meta_data_table.dtype)
+                meta_data['index_start'] = np.arange(200) * 1000
+                meta_data['index_stop'] = np.arange(1, 201) * 1000
+                meta_data['scan_param_id'] = np.arange(200) // 20
+                meta_data_table.append(meta_data)
+                meta_data_table.attrs.scan_id = 'source_scan'
+
+            results = []
+            for n_processes in [1, 2]:
+                analysis = Analysis(raw_data_file, n_processes=n_processes)
+                analysis.chunk_size = 5000
+                analysis.chunks_per_process = 4
+                analysis.analyze_data()
+                with tb.open_file(analysis.analyzed_data_file) as in_file:
+                    results.append((in_file.root.Dut[:], analysis.error_count))
+
+            np.testing.assert_array_equal(results[0][0], results[1][0])
+            self.assertEqual(results[0][1], results[1][1])
+            self.assertGreater(results[0][1], 0)
+        finally:
+            shutil.rmtree(working_dir)
+
+    def test_interpreter_idx_chunks(self):
+        ''' Hits of interpreter_idx must not depend on the chunk boundaries, also with a restored state '''
+        raw_data = generate_raw_data(30000, 1e-3, 3)
+        expected_hits = interpreter_idx.InterRawIdx().run(raw_data)
+        self.assertTrue(np.all(np.diff(expected_hits['scan_param_id'].astype(np.int64)) > 0))  # At most one hit per word
+
+        data_interpreter = interpreter_idx.InterRawIdx(chunk=1000)
+        hits = [data_interpreter.run(raw_data[start:start + 777]) for start in range(0, 21756, 777)]
+        state = data_interpreter.get_state()
+        data_interpreter = interpreter_idx.InterRawIdx(chunk=10)  # Output array has to grow
+        data_interpreter.set_state(state)
+        hits.append(data_interpreter.run(raw_data[21756:]))
+        np.testing.assert_array_equal(np.concatenate(hits), expected_hits)
+
+        with self.assertRaises(ValueError):
+            interpreter_idx.InterRawIdx().run(raw_data, hits=np.empty(10, dtype=interpreter_idx.hit_idx_dtype))
+
+    def test_resume(self):
+        ''' Resumed analysis of a raw data file that got extended has to give the same hits as one analysis '''
+        working_dir = tempfile.mkdtemp()
+        try:
+            raw_data = generate_raw_data(100000, 1e-3, 2)
+            results = []
+            for name, stops in [('full', [100000]), ('resumed', [34000, 100000])]:
+                raw_data_file = os.path.join(working_dir, name + '.h5')
+                for stop in stops:
+                    with tb.open_file(raw_data_file, 'w') as out_file:
+                        out_file.create_earray(out_file.root, name='raw_data', obj=raw_data[:stop])
+                        meta_data_table = out_file.create_table(out_file.root, name='meta_data', description=MetaTable)
+                        meta_data = np.zeros(shape=stop // 1000, dtype=meta_data_table.dtype)
+                        meta_data['index_start'] = np.arange(stop // 1000) * 1000
+                        meta_data['index_stop'] = np.arange(1, stop // 1000 + 1) * 1000
+                        meta_data['scan_param_id'] = np.arange(stop // 1000) // 10
+                        meta_data_table.append(meta_data)
+                        meta_data_table.attrs.scan_id = 'source_scan'
+                    analysis = Analysis(raw_data_file)
+                    analysis.chunk_size = 5000
+                    analysis.analyze_data(resume=True)
+                with tb.open_file(analysis.analyzed_data_file) as in_file:
+                    results.append((in_file.root.Dut[:], analysis.error_count))
+
+            np.testing.assert_array_equal(results[0][0], results[1][0])
+            self.assertEqual(results[0][1], results[1][1])
+        finally:
+            shutil.rmtree(working_dir)
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,105 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import numpy as np
+import tables as tb
+from tjmonopix.analysis import analysis_utils as au
+from tjmonopix.analysis.raw_data_files import get_segment_files, open_raw_data_file, create_sidecar
+from tjmonopix.replay import ReplayDut, ReplayScan
+from tjmonopix.scan_base import MetaTable
+from tjmonopix.sim_dut import SimulatedDut
+
+
+class TestReplay(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.working_dir = tempfile.mkdtemp()
+        cls.raw_data_file = os.path.join(cls.working_dir, 'recorded.h5')
+        dut = SimulatedDut(hit_rate=1e5, seed=0)
+        dut.set_monoread()
+        dut.set_timestamp('mon')
+        with tb.open_file(cls.raw_data_file, 'w') as out_file:
+            raw_data = out_file.create_earray(out_file.root, name='raw_data', atom=tb.UIntAtom(), shape=(0,))
+            meta_data = out_file.create_table(out_file.root, name='meta_data', description=MetaTable)
+            for i in range(30):  # 10 ms chunks, 3 scan parameters
+                words, _, _ = dut.generate(0.01 * i, 0.01)
+                meta_data.append([(raw_data.nrows, raw_data.nrows + words.shape[0], words.shape[0], 100. + 0.01 * i,
+                                   100. + 0.01 * (i + 1), i // 10, 0)])
+                raw_data.append(words)
+            cls.raw_data = raw_data[:]
+            cls.meta_data = meta_data[:]
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.working_dir)
+
+    def replay(self, speed, rotation=None, pipelined=False, fifo_depth=1 << 21):
+        dut = ReplayDut(self.raw_data_file, speed=speed, fifo_depth=fifo_depth)
+        bench = {'general': {'output_directory': self.working_dir, 'raw_data_rotation': rotation or {}, 'raw_data_sidecar': bool(rotation),
+                             'readout': {'pipelined': pipelined}},
+                 'dut': {'send_data': None}}
+        try:
+            scan = ReplayScan(bench_config=bench, dut=dut)
+            start_time = time.time()
+            output_file = scan.start()
+            duration = time.time() - start_time
+        finally:
+            dut.close()
+        if rotation:
+            return output_file
+        with tb.open_file(output_file) as in_file:
+            self.assertEqual(in_file.root.scan_param_index.nrows, 3)
+            np.testing.assert_array_equal(au.read_scan_param(in_file, 1), self.raw_data[self.meta_data[10]['index_start']:self.meta_data[19]['index_stop']])
+            return in_file.root.raw_data[:], in_file.root.meta_data[:], duration
+
+    def test_replay(self):
+        ''' Replayed raw data has to be written unchanged with the recorded scan parameters '''
+        raw_data, meta_data, _ = self.replay(speed=None)
+        np.testing.assert_array_equal(raw_data, self.raw_data)
+        scan_param_ids = np.repeat(meta_data['scan_param_id'], (meta_data['index_stop'] - meta_data['index_start']).astype(np.int64))
+        np.testing.assert_array_equal(scan_param_ids, np.repeat(self.meta_data['scan_param_id'], self.meta_data['data_length']))
+
+    def test_small_fifo(self):
+        ''' Chunks larger than the FIFO must not stop the replay at maximum speed '''
+        raw_data, _, _ = self.replay(speed=None, fifo_depth=int(self.meta_data['data_length'].max()) // 2)
+        np.testing.assert_array_equal(raw_data, self.raw_data)
+
+    def test_replay_timing(self):
+        ''' Timed replay has to take the recorded time divided by the speed-up '''
+        raw_data, _, duration = self.replay(speed=2.)
+        np.testing.assert_array_equal(raw_data, self.raw_data)
+        self.assertGreater(duration, 0.3 / 2.)
+
+    def test_rotation(self):
+        ''' Rotated raw data files (written by the writer thread) have to be readable as one file and segment by segment '''
+        output_file = self.replay(speed=None, rotation={'max_words': self.raw_data.shape[0] // 4}, pipelined=True)
+        segment_files = get_segment_files(output_file)
+        self.assertGreater(len(segment_files), 2)
+        with open_raw_data_file(output_file) as in_file:
+            np.testing.assert_array_equal(in_file.root.raw_data[:], self.raw_data)
+            meta_data = in_file.root.meta_data[:]
+            np.testing.assert_array_equal(meta_data['index_start'][1:], meta_data['index_stop'][:-1])
+            np.testing.assert_array_equal(au.read_scan_param(in_file, 1), self.raw_data[self.meta_data[10]['index_start']:self.meta_data[19]['index_stop']])
+            self.assertEqual(in_file.root.meta_data.attrs.scan_id, 'replay')
+            self.assertIn('status', in_file.root.meta_data.attrs._f_list())
+        with tb.open_file(segment_files[-1]) as in_file:  # Attributes of the end of the run are in the first segment
+            self.assertNotIn('status', in_file.root.meta_data.attrs._f_list())
+        raw_data = []
+        for segment_file in segment_files:
+            with open_raw_data_file(segment_file, all_segments=False, mmap=True) as in_file:
+                meta_data = in_file.root.meta_data[:]
+                self.assertEqual(meta_data[0]['index_start'], 0)
+                self.assertEqual(meta_data[-1]['index_stop'], in_file.root.raw_data.shape[0])
+                self.assertIsInstance(in_file.root.raw_data, np.memmap)  # Sidecar written during the run
+                raw_data.append(in_file.root.raw_data[:])
+        np.testing.assert_array_equal(np.concatenate(raw_data), self.raw_data)
+        sidecar = create_sidecar(self.raw_data_file)  # Sidecar of a recorded run
+        with open_raw_data_file(self.raw_data_file, mmap=True) as in_file:
+            np.testing.assert_array_equal(in_file.root.raw_data, self.raw_data)
+        os.remove(sidecar)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+import time
+import unittest
+import numpy as np
+from tjmonopix.analysis import interpreter
+from tjmonopix.sim_dut import SimulatedDut
+
+
+class TestSimulatedDut(unittest.TestCase):
+    def test_raw_data(self):
+        ''' Simulated raw data has to be interpreted without errors '''
+        dut = SimulatedDut(hit_rate=1e5, cluster_size=2., noisy_pixels=3, noise_rate=1e3, seed=0)
+        dut.set_monoread()
+        dut.set_timestamp('mon')
+        dut.set_timestamp('rx1')
+        dut.set_tlu()
+        raw_data, _, _ = dut.generate(1., 0.1)
+
+        hit_dtype = [("col", "<u1"), ("row", "<u2"), ("le", "<u1"), ("te", "<u1"), ("cnt", "<u4"),
+                     ("timestamp", "<i8"), ("scan_param_id", "<i4")]
+        meta_data = np.array([(0, raw_data.shape[0], 0)], dtype=[("index_start", "<u4"), ("index_stop", "<u4"), ("scan_param_id", "<u4")])
+        data_interpreter = interpreter.RawDataInterpreter()
+        hits = data_interpreter.interpret(raw_data, meta_data, np.zeros(shape=raw_data.shape[0], dtype=hit_dtype))
+
+        self.assertEqual(data_interpreter.get_error_count(), 0)
+        tj_hits = hits[hits["col"] < 112]
+        n_clusters = np.count_nonzero(hits["col"] == 0xFD)
+        self.assertGreater(n_clusters, 9000)
+        for col in [0xFB, 0xFE, 0xFF]:  # TLU timestamp, external timestamp and TLU word for every cluster
+            self.assertEqual(np.count_nonzero(hits["col"] == col), n_clusters)
+        self.assertTrue(np.all(np.diff(tj_hits["timestamp"]) >= 0))
+        self.assertTrue(np.all((tj_hits["timestamp"] >= 1. * 640e6) & (tj_hits["timestamp"] < 1.1 * 640e6)))
+        np.testing.assert_array_equal(hits["cnt"][hits["col"] == 0xFF], np.arange(n_clusters) & 0xFFFF)
+
+    def test_fifo_overflow(self):
+        ''' Data not fitting into the FIFO has to be lost and counted '''
+        dut = SimulatedDut(hit_rate=1e6, fifo_depth=1000, seed=0)
+        dut.set_monoread()
+        time.sleep(0.05)
+        self.assertEqual(dut['fifo']['FIFO_SIZE'], 4 * 1000)
+        self.assertEqual(dut['fifo'].get_data().shape[0], 1000)
+        self.assertEqual(dut['data_rx'].LOST_COUNT, 255)
+        dut['data_rx']['RESET'] = 1
+        self.assertEqual(dut['data_rx'].LOST_COUNT, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,10 +2,13 @@ import numpy as np
 import tables as tb
 import logging
 import numba
+import multiprocessing as mp
+from collections import deque
 from tqdm import tqdm
 
 from tjmonopix.analysis import analysis_utils as au
 from tjmonopix.analysis import interpreter, event_builder
+from tjmonopix.analysis.raw_data_files import open_raw_data_file
 from pixel_clusterizer.clusterizer import HitClusterizer
 
 logging.basicConfig(
@@ -13,8 +16,33 @@ logging.basicConfig(
 loglevel = logging.INFO
 
 
+def _interpret_range(args):
+    ''' Interpret raw data words [start, stop) chunk by chunk, starting with an empty interpreter state
+
+        Runs in the worker processes of the parallel analysis. Returns the hits of every chunk with the
+        raw data index as scan_param_id and the interpreter state at the end.
+    '''
+    raw_data_file, start, stop, chunk_size, hit_dtype, mmap = args
+    data_interpreter = interpreter.RawDataInterpreter()
+    hits = []
+    with open_raw_data_file(raw_data_file, mmap=mmap) as in_file:
+        meta_data = in_file.root.meta_data[:0]
+        hit_buffer = np.zeros(shape=chunk_size, dtype=hit_dtype)
+        for chunk_start in range(start, stop, chunk_size):
+            raw_data = in_file.root.raw_data[chunk_start:min(stop, chunk_start + chunk_size)]
+            hits.append(data_interpreter.interpret(raw_data, meta_data, hit_buffer).copy())
+    return hits, interpreter.get_state(data_interpreter)
+
+
+def _shift_raw_idx(hits, offset):
+    ''' Add offset to the raw data index stored in scan_param_id
+    '''
+    if offset:
+        hits['scan_param_id'] += offset
+
+
 class Analysis():
-    def __init__(self, raw_data_file=None, cluster_hits=False, build_events=False, build_events_simple=False):
+    def __init__(self, raw_data_file=None, cluster_hits=False, build_events=False, build_events_simple=False, n_processes=1, mmap=False):
 
         self.logger = logging.getLogger(self.__class__.__name__)
         self.logger.setLevel(loglevel)
@@ -25,7 +53,16 @@ class Analysis():
             raise RuntimeError("Please decide for one type of event building only")
 
         self.raw_data_file = raw_data_file
+        self.mmap = mmap  # Read raw data memory mapped from the sidecar file, see raw_data_files
         self.chunk_size = 200000
+        self.n_processes = n_processes if n_processes else mp.cpu_count()
+        self.chunks_per_process = 20  # Raw data chunks interpreted per task in parallel mode
+        self.max_tasks_in_flight = 2 * self.n_processes  # Tasks submitted but not stitched yet in parallel mode, limits the memory
+        self.n_threads = 1  # Threads filling the s-curve and ToT histograms
+        self.max_hits_per_word = 1  # Worst case: TLU words and timestamps give up to one hit per raw data word
+        self.buffer_pool = au.BufferPool()  # Hit and event buffers reused for every chunk
+        # Time window of the hits of an event relative to the trigger in 640 MHz clock cycles (build_events)
+        self.event_window = (event_builder.WINDOW_START, event_builder.WINDOW_STOP)
         self.cluster_hits = cluster_hits
         if self.cluster_hits:
             self._setup_clusterizer()
@@ -196,7 +233,13 @@ class Analysis():
 #             else:
             self.clz.set_end_of_cluster_function(end_of_cluster_function)
 
-    def analyze_data(self):
+    def analyze_data(self, resume=False):
+        ''' Interpret the raw data file and store hits (events, clusters) in the _interpreted.h5 file
+
+            The progress is checkpointed into the output file after every chunk (every task in parallel mode).
+            With resume=True the analysis continues at the checkpoint of a previous, interrupted analysis,
+            or analyzes only the new raw data if the raw data file was extended meanwhile.
+        '''
         self.analyzed_data_file = self.raw_data_file[:-3] + '_interpreted.h5'
         hit_dtype = [
             ('col', 'u1'),
@@ -205,7 +248,7 @@ class Analysis():
             ('te', 'u1'),
             ('cnt', '<u4'),
             ('timestamp', '<i8'),
-            ('scan_param_id', '<i4'),
+            ('scan_param_id', '<i8'),  # Holds the 64 bit raw data index until the scan_param_id is assigned
         ]
         event_dtype = [
             ("event_number", "<i8"),
@@ -219,12 +262,11 @@ class Analysis():
             hit_dtype.append(('charge', 'u1'))
             hit_dtype.append(('event_number', '<i8'))
         if self.build_events:
-            ev_builder = event_builder.EventBuilder()
-            end_of_last_chunk = np.zeros(23, dtype=hit_dtype)
+            ev_builder = event_builder.EventBuilder(self.event_window[0], self.event_window[1])
         if self.build_events_simple:
             last_event_number, last_timestamp = 0, 0
         
-        with tb.open_file(self.raw_data_file) as in_file:
+        with open_raw_data_file(self.raw_data_file, mmap=self.mmap) as in_file:
             n_words = in_file.root.raw_data.shape[0]
             meta_data = in_file.root.meta_data[:]
 
@@ -233,8 +275,12 @@ class Analysis():
                 return
 
             self.n_params = np.amax(meta_data["scan_param_id"])
+            scan_id = in_file.root.meta_data.attrs.scan_id
+            # Histograms are filled chunk by chunk, s-curves only for threshold scans
+            hit_hists = au.HitHistograms(self.n_params + 1 if scan_id in ["threshold_scan"] else None, n_threads=self.n_threads)
 
-            with tb.open_file(self.analyzed_data_file, "w") as out_file:
+            checkpoint = self._load_checkpoint(n_words) if resume else None
+            with tb.open_file(self.analyzed_data_file, "w" if checkpoint is None else "r+") as out_file:
                 hit_table = None
                 if self.build_events:
                     event_table = None
@@ -242,7 +288,26 @@ class Analysis():
                 if self.build_events_simple:
                     event_table = None
 
-                if self.cluster_hits:
+                if checkpoint is not None:
+                    cluster_table = out_file.root.Cluster if self.cluster_hits else None
+                    hit_table, event_table, cluster_table = [
+                        self._truncate_table(table, checkpoint.get(n_rows, 0)) for table, n_rows in
+                        [(out_file.root.Dut, 'n_hits'), (getattr(out_file.root, 'Hits', None), 'n_events'), (cluster_table, 'n_clusters')]]
+                    if self.build_events:
+                        n_events = checkpoint['n_events']
+                        event_builder.set_state(ev_builder, checkpoint['event_builder_state'])
+                    if self.build_events_simple:
+                        last_event_number, last_timestamp = checkpoint['last_event_number'], checkpoint['last_timestamp']
+                    if self.cluster_hits:
+                        hist_cs_size, hist_cs_tot, hist_cs_shape = checkpoint['hist_cs_size'], checkpoint['hist_cs_tot'], checkpoint['hist_cs_shape']
+                    start, state = checkpoint['raw_data_index'], checkpoint['interpreter_state']
+                    for index in range(0, hit_table.nrows, self.chunk_size):  # Histograms of the hits up to the checkpoint
+                        hit_hists.fill(hit_table[index:index + self.chunk_size])
+                    self.logger.info('Resume analysis at raw data word {:d} of {:d}'.format(start, n_words))
+                else:
+                    start, state = 0, None
+
+                if self.cluster_hits and checkpoint is None:
                     cluster_table = out_file.create_table(
                         out_file.root, name='Cluster',
                         description=self.cluster_dtype,
@@ -254,21 +319,8 @@ class Analysis():
                     hist_cs_tot = np.zeros(shape=(100, ), dtype=np.uint32)
                     hist_cs_shape = np.zeros(shape=(300, ), dtype=np.int32)
 
-                start = 0
-
-                data_interpreter = interpreter.RawDataInterpreter()
-                pbar = tqdm(total=n_words)
-                while start < n_words:
-                    tmp_end = min(n_words, start + self.chunk_size)
-                    raw_data = in_file.root.raw_data[start:tmp_end]
-                    hit_buffer = np.zeros(shape=self.chunk_size, dtype=hit_dtype)
-
-                    hit_dat = data_interpreter.interpret(
-                        raw_data,
-                        meta_data,
-                        hit_buffer
-                    )
-
+                pbar = tqdm(total=n_words, initial=start)
+                for start, tmp_end, hit_dat, state in self._interpret_chunks(in_file, meta_data, hit_dtype, start, state):
                     if hit_table is None:
                         hit_table = out_file.create_table(
                             where=out_file.root,
@@ -283,27 +335,33 @@ class Analysis():
 
                     hit_table.append(hit_dat)
                     hit_table.flush()
+                    hit_hists.fill(hit_dat)
 
                     if self.build_events:
-                        ev_buffer = np.zeros(shape=self.chunk_size, dtype=event_dtype)
-                        events, end_of_last_chunk = ev_builder.build_events(hit_dat, ev_buffer, end_of_last_chunk)
-                        n_events += len(events)
-                        if event_table is None:
-                            event_table = out_file.create_table(
-                                where=out_file.root,
-                                name="Hits",
-                                description=events.dtype,
-                                expectedrows=self.chunk_size,
-                                title='event_data',
-                                filters=tb.Filters(
-                                    complib='blosc',
-                                    complevel=5,
-                                    fletcher32=False))
-                        event_table.append(events)
+                        ev_buffer = self.buffer_pool.get('events', self.chunk_size, event_dtype)
+                        flush = tmp_end == n_words
+                        events = ev_builder.build_events(hit_dat, ev_buffer, flush)
+                        while True:
+                            n_events += len(events)
+                            if event_table is None:
+                                event_table = out_file.create_table(
+                                    where=out_file.root,
+                                    name="Hits",
+                                    description=events.dtype,
+                                    expectedrows=self.chunk_size,
+                                    title='event_data',
+                                    filters=tb.Filters(
+                                        complib='blosc',
+                                        complevel=5,
+                                        fletcher32=False))
+                            event_table.append(events)
+                            if not flush or ev_builder.n_triggers == 0:
+                                break
+                            events = ev_builder.build_events(hit_dat[:0], ev_buffer, True)  # Event buffer was full
                         event_table.flush()
 
                     if self.build_events_simple:
-                        ev_buffer = np.zeros(shape=self.chunk_size, dtype=event_dtype)
+                        ev_buffer = self.buffer_pool.get('events', self.chunk_size, event_dtype)
                         events, last_event_number, last_timestamp = au.build_events_from_timestamp(
                             hit_dat[hit_dat["col"] < 112],
                             ev_buffer,
@@ -347,64 +405,249 @@ class Analysis():
                         hist_cs_tot += cs_tot.astype(np.uint32)
                         hist_cs_shape += cs_shape.astype(np.uint32)
 
+                    if state is not None:
+                        checkpoint = {'raw_data_index': tmp_end, 'interpreter_state': state, 'n_hits': hit_table.nrows,
+                                      'settings': self._checkpoint_settings()}
+                        if self.build_events:
+                            checkpoint['event_builder_state'] = event_builder.get_state(ev_builder)
+                        if self.build_events_simple:
+                            checkpoint.update(last_event_number=last_event_number, last_timestamp=last_timestamp)
+                        if self.build_events or self.build_events_simple:
+                            checkpoint['n_events'] = event_table.nrows
+                        if self.cluster_hits:
+                            checkpoint.update(n_clusters=cluster_table.nrows, hist_cs_size=hist_cs_size,
+                                              hist_cs_tot=hist_cs_tot, hist_cs_shape=hist_cs_shape)
+                        self._write_checkpoint(out_file, checkpoint)
+
                     pbar.update(tmp_end - start)
-                    start = tmp_end
                 pbar.close()
+                self.logger.debug("{:d} bytes of hit and event buffers".format(self.buffer_pool.nbytes))
 
                 # TODO: Copy all attributes properly to output_file, maybe own table
-                out_file.root.Dut.attrs.scan_id = in_file.root.meta_data.attrs.scan_id
-                self._create_additional_hit_data()
-                self.logger.info("{:d} errors occured during analysis".format(data_interpreter.get_error_count()))
+                out_file.root.Dut.attrs.scan_id = scan_id
+                au.create_scan_param_index(out_file, node='Dut')
+                self._create_additional_hit_data(hit_hists)
+                self.logger.info("{:d} errors occured during analysis".format(self.error_count))
+                if self.scan_id_flags & au.SCAN_ID_UNSORTED:
+                    self.logger.warning("meta_data is not ordered by index_start")
+                if self.scan_id_flags & au.SCAN_ID_GAP:
+                    self.logger.warning("{:d} hits are in no readout of the meta_data, scan_param_id of the preceding readout used".format(self.n_scan_id_gaps))
                 if self.build_events:
                     self.logger.info("{:d} events built".format(n_events))
+                    if ev_builder.n_out_of_order:
+                        self.logger.warning("{:d} TJ hits not ordered by timestamp".format(ev_builder.n_out_of_order))
 
 #                 self._create_additional_hit_data()
                 if self.cluster_hits:
                     self._create_additional_cluster_data(hist_cs_size, hist_cs_tot, hist_cs_shape)
 
-    def _create_additional_hit_data(self):
-        with tb.open_file(self.analyzed_data_file, 'r+') as out_file:
-            hits = out_file.root.Dut[:]
-            scan_id = out_file.root.Dut.attrs["scan_id"]
+    def _interpret_chunks(self, in_file, meta_data, hit_dtype, start=0, state=None):
+        ''' Interpret the raw data chunk by chunk, beginning at raw data index start with interpreter state state
 
-            hist_occ = au.occ_hist2d(hits)
+            Yields start and stop index of every raw data chunk, the hits of the chunk and the interpreter
+            state after the chunk (None if not known for this chunk). The interpreter error count is stored
+            in self.error_count, the flags and number of hits in gaps of the scan_param_id assignment in
+            self.scan_id_flags and self.n_scan_id_gaps.
+        '''
+        self.error_count = 0 if state is None else int(state['error_cnt'])
+        self.scan_id_index, self.scan_id_flags = au.get_scan_id_index(meta_data)  # Sorted readouts, once per file
+        self.n_scan_id_gaps = 0
+        if self.n_processes > 1 and in_file.root.raw_data.shape[0] - start > self.chunk_size * self.chunks_per_process:
+            for chunk in self._interpret_chunks_parallel(in_file, meta_data, hit_dtype, start, state):
+                yield chunk
+            return
+
+        n_words = in_file.root.raw_data.shape[0]
+        no_meta_data = meta_data[:0]
+        data_interpreter = interpreter.RawDataInterpreter()
+        if state is not None:
+            interpreter.set_state(data_interpreter, state)
+        while start < n_words:
+            tmp_end = min(n_words, start + self.chunk_size)
+            raw_data = in_file.root.raw_data[start:tmp_end]
+            hit_buffer = self.buffer_pool.get('hits', self.chunk_size * self.max_hits_per_word, hit_dtype)
+
+            hit_dat = data_interpreter.interpret(
+                raw_data,
+                no_meta_data,
+                hit_buffer
+            )
+            data_interpreter.meta_idx = self._assign_scan_ids(hit_dat, data_interpreter.meta_idx)
+            self.error_count = data_interpreter.get_error_count()
+            yield start, tmp_end, hit_dat, interpreter.get_state(data_interpreter)
+            start = tmp_end
+
+    def _interpret_chunks_parallel(self, in_file, meta_data, hit_dtype, start=0, state=None):
+        ''' Interpret the raw data in a process pool, same output as the serial interpretation
+
+            The raw data is split into ranges of several chunks that are interpreted in parallel, each
+            starting with an empty interpreter state. At the start of every range the actual state of the
+            previous range is used to interpret the data again, together with an interpreter starting with
+            an empty state, until both states are equivalent (usually after a few words). From there on
+            the hits of the worker are correct, only the raw data index (errors are not counted) is shifted.
+            At most max_tasks_in_flight ranges are submitted ahead of the range that is stitched.
+        '''
+        n_words = in_file.root.raw_data.shape[0]
+        range_size = self.chunk_size * self.chunks_per_process
+        ranges = [(self.raw_data_file, range_start, min(range_start + range_size, n_words), self.chunk_size, hit_dtype, self.mmap)
+                  for range_start in range(start, n_words, range_size)]
+        no_meta_data = meta_data[:0]
+        hit_buffer = self.buffer_pool.get('stitching', self.chunk_size * self.max_hits_per_word, hit_dtype)
+
+        # Compile before the worker processes are forked
+        data_interpreter = interpreter.RawDataInterpreter()
+        data_interpreter.interpret(in_file.root.raw_data[:1], no_meta_data, hit_buffer)
+        data_interpreter = interpreter.RawDataInterpreter()
+        if state is not None:
+            interpreter.set_state(data_interpreter, state)
+        meta_idx = data_interpreter.meta_idx
+
+        pool = mp.Pool(self.n_processes)
+        try:
+            tasks = deque(pool.apply_async(_interpret_range, (args, )) for args in ranges[:self.max_tasks_in_flight])
+            for range_index, (_, range_start, range_stop, _, _, _) in enumerate(ranges):
+                hits, end_state = tasks.popleft().get()
+                if range_index + len(tasks) + 1 < len(ranges):
+                    tasks.append(pool.apply_async(_interpret_range, (ranges[range_index + len(tasks) + 1], )))
+                # Interpreter with the same start state as the worker
+                worker_interpreter = interpreter.RawDataInterpreter()
+                converged = interpreter.is_equivalent_state(interpreter.get_state(data_interpreter), interpreter.get_state(worker_interpreter))
+                raw_idx_offset = int(data_interpreter.raw_idx)
+                error_offset = data_interpreter.get_error_count()
+                for chunk_index, chunk_hits in enumerate(hits):
+                    start = range_start + chunk_index * self.chunk_size
+                    tmp_end = min(range_stop, start + self.chunk_size)
+                    if converged:
+                        hit_dat = chunk_hits
+                        _shift_raw_idx(hit_dat, raw_idx_offset)
+                    else:  # Interpret with actual state until it is equivalent to the worker state
+                        hit_dat, n_worker_hits = [], 0
+                        position, size = start, 256
+                        while position < tmp_end and not converged:
+                            raw_data = in_file.root.raw_data[position:min(tmp_end, position + size)]
+                            hit_dat.append(data_interpreter.interpret(raw_data, no_meta_data, hit_buffer).copy())
+                            n_worker_hits += worker_interpreter.interpret(raw_data, no_meta_data, hit_buffer).shape[0]
+                            position += raw_data.shape[0]
+                            size *= 2
+                            converged = interpreter.is_equivalent_state(interpreter.get_state(data_interpreter),
+                                                                        interpreter.get_state(worker_interpreter))
+                        if converged:
+                            raw_idx_offset = int(data_interpreter.raw_idx) - int(worker_interpreter.raw_idx)
+                            error_offset = data_interpreter.get_error_count() - worker_interpreter.get_error_count()
+                            _shift_raw_idx(chunk_hits, raw_idx_offset)
+                            hit_dat.append(chunk_hits[n_worker_hits:])
+                        hit_dat = np.concatenate(hit_dat)
+
+                    meta_idx = self._assign_scan_ids(hit_dat, meta_idx)
+                    if chunk_index < len(hits) - 1:
+                        yield start, tmp_end, hit_dat, None
+                        continue
+
+                    if converged:  # Continue with the state of the worker
+                        end_state = np.array([end_state])[0]  # unpickled records are read-only
+                        end_state['raw_idx'] += raw_idx_offset
+                        end_state['error_cnt'] += error_offset
+                        interpreter.set_state(data_interpreter, end_state)
+                    data_interpreter.meta_idx = meta_idx
+                    self.error_count = data_interpreter.get_error_count()
+                    yield start, tmp_end, hit_dat, interpreter.get_state(data_interpreter)
+        finally:
+            pool.terminate()
+
+    def _assign_scan_ids(self, hit_dat, meta_idx):
+        ''' Replace the raw data index in scan_param_id of the hits by the scan_param_id, count the hits in gaps
+        '''
+        flags, n_gaps, meta_idx = au.assign_scan_ids(hit_dat, self.scan_id_index, meta_idx)
+        self.scan_id_flags |= flags
+        self.n_scan_id_gaps += n_gaps
+        return meta_idx
+
+    def _checkpoint_settings(self):
+        return [self.cluster_hits, self.build_events, self.build_events_simple] + list(self.event_window)
+
+    def _load_checkpoint(self, n_words):
+        ''' Return the checkpoint stored in the output file or None if the analysis cannot be resumed
+        '''
+        try:
+            with tb.open_file(self.analyzed_data_file, 'r') as out_file:
+                checkpoint = dict((name, out_file.root.Checkpoint._v_attrs[name]) for name in out_file.root.Checkpoint._v_attrs._f_list())
+        except (IOError, OSError, tb.NoSuchNodeError):
+            self.logger.info('No checkpoint found, analyze all data')
+            return None
+        if list(checkpoint['settings']) != self._checkpoint_settings():
+            self.logger.warning('Checkpoint is from analysis with different settings, analyze all data')
+            return None
+        if checkpoint['raw_data_index'] > n_words:
+            self.logger.warning('Checkpoint is beyond the end of the raw data, analyze all data')
+            return None
+        return checkpoint
+
+    def _write_checkpoint(self, out_file, checkpoint):
+        ''' Store the progress of the analysis in the output file to be able to resume it
+        '''
+        if 'Checkpoint' not in out_file.root:
+            out_file.create_group(out_file.root, name='Checkpoint', title='Analysis checkpoint')
+        for name, value in checkpoint.items():
+            out_file.root.Checkpoint._v_attrs[name] = value
+        out_file.flush()
+
+    def _truncate_table(self, table, n_rows):
+        ''' Remove rows written after the checkpoint
+        '''
+        if table is not None and table.nrows > n_rows:
+            table.truncate(n_rows)
+        return table
+
+    def _remove_nodes(self, out_file, names):
+        ''' Remove result nodes of a previous analysis that are created again
+        '''
+        for name in names:
+            if name in out_file.root:
+                out_file.remove_node(out_file.root, name)
+
+    def _create_additional_hit_data(self, hit_hists):
+        with tb.open_file(self.analyzed_data_file, 'r+') as out_file:
+            self._remove_nodes(out_file, ['HistOcc', 'HistSCurve', 'ToTAve', 'ToTRms', 'ThresholdMap', 'NoiseMap', 'Chi2Map'])
 
             out_file.create_carray(out_file.root,
                                    name='HistOcc',
                                    title='Occupancy Histogram',
-                                   obj=hist_occ,
+                                   obj=hit_hists.hist_occ,
                                    filters=tb.Filters(complib='blosc',
                                                       complevel=5,
                                                       fletcher32=False))
 
             # TODO: ToT Histogram?
 
-            if scan_id in ["threshold_scan"]:
+            if hit_hists.hist_scurve is not None:
                 n_injections = 100  # TODO: get from run configuration
                 scan_param_range = np.arange(0, self.n_params + 1, 1)  # TODO: get from run configuration
 
-                hist_scurve = au.scurve_hist3d(hits, scan_param_range)
-
                 out_file.create_carray(out_file.root,
                                        name="HistSCurve",
                                        title="Scurve Data",
-                                       obj=hist_scurve,
+                                       obj=hit_hists.hist_scurve,
                                        filters=tb.Filters(complib='blosc',
                                                           complevel=5,
                                                           fletcher32=False))
 
-                ave_tots = au.tot_ave3d(hits, scan_param_range)
-                ave_tots = np.array(ave_tots, dtype=np.float32) / np.array(hist_scurve, dtype=np.float32)
                 out_file.create_carray(out_file.root,
                                        name="ToTAve",
                                        title="ToT average",
-                                       obj=ave_tots,
+                                       obj=hit_hists.get_tot_mean(),
+                                       filters=tb.Filters(complib='blosc',
+                                                          complevel=5,
+                                                          fletcher32=False))
+                out_file.create_carray(out_file.root,
+                                       name="ToTRms",
+                                       title="ToT RMS",
+                                       obj=hit_hists.get_tot_rms(),
                                        filters=tb.Filters(complib='blosc',
                                                           complevel=5,
                                                           fletcher32=False))
 
-                self.threshold_map, self.noise_map, self.chi2_map = au.fit_scurves_multithread(
-                    hist_scurve.reshape(112 * 224, self.n_params + 1), scan_param_range, n_injections=n_injections, invert_x=False
+                self.threshold_map, self.noise_map, self.chi2_map = au.fit_scurves_vectorized(
+                    hit_hists.hist_scurve.reshape(112 * 224, self.n_params + 1), scan_param_range, n_injections=n_injections, invert_x=False
                 )
 
                 out_file.create_carray(out_file.root, name='ThresholdMap', title='Threshold Map', obj=self.threshold_map,
@@ -419,6 +662,7 @@ class Analysis():
             Store cluster histograms in analyzed data file
         '''
         with tb.open_file(self.analyzed_data_file, 'r+') as out_file:
+            self._remove_nodes(out_file, ['HistClusterSize', 'HistClusterTot', 'HistClusterShape'])
             out_file.create_carray(out_file.root,
                                    name='HistClusterSize',
                                    title='Cluster Size Histogram',
@@ -8,6 +8,8 @@ from functools import partial
 import logging
 from tqdm import tqdm
 
+from tjmonopix.analysis.raw_data_files import get_raw_data_offset
+
 logger = logging.getLogger('Analysis')
 
 
@@ -27,20 +29,169 @@ def gauss(x, *p):
     return amplitude * np.exp(- (x - mu)**2.0 / (2.0 * sigma**2.0))
 
 
+SCAN_ID_GAP = 0x1  # Hits with a raw data index in no readout (gap between readouts, before the first or after the last)
+SCAN_ID_UNSORTED = 0x2  # meta_data rows not ordered by index_start
+
+
+scan_id_index_dtype = [('index_start', '<i8'), ('index_stop', '<i8'), ('scan_param_id', '<i8')]
+
+
+def get_scan_id_index(meta_data):
+    ''' Readouts of the meta_data ordered by index_start for assign_scan_ids, built once per file
+
+        Returns the readouts (index_start, index_stop, scan_param_id) and the flags (SCAN_ID_UNSORTED if the
+        meta_data rows had to be sorted).
+    '''
+    scan_id_index = np.empty(meta_data.shape[0], dtype=scan_id_index_dtype)
+    for name in ['index_start', 'index_stop', 'scan_param_id']:
+        scan_id_index[name] = meta_data[name]
+    if np.any(scan_id_index['index_start'][1:] < scan_id_index['index_start'][:-1]):
+        return scan_id_index[np.argsort(scan_id_index['index_start'], kind='mergesort')], SCAN_ID_UNSORTED
+    return scan_id_index, 0
+
+
 @numba.njit
+def assign_scan_ids(hits, scan_id_index, meta_idx=0):
+    ''' Replace the raw data index stored in scan_param_id of the hits by the scan_param_id of the readout the data
+        word belongs to, for a whole chunk of hits at once
+
+        scan_id_index are the readouts ordered by index_start, from get_scan_id_index or meta_data that is ordered.
+        The search starts at row meta_idx (returned for the preceding chunk), only hits before this readout are
+        searched in all rows. Hits in a gap get the scan_param_id of the preceding readout (of the first readout if
+        there is none). Without hits or readouts the hits are not changed.
+
+        Returns the flags (SCAN_ID_GAP), the number of hits in gaps and the scan_id_index row of the last hit
+        (meta_idx without hits).
+    '''
+    n_meta = scan_id_index.shape[0]
+    if n_meta == 0 or hits.shape[0] == 0:
+        return 0, 0, np.int64(meta_idx)
+    row = min(np.int64(meta_idx), n_meta - 1)
+    n_gaps = 0
+    for i in range(hits.shape[0]):
+        raw_idx = np.int64(hits[i]['scan_param_id'])
+        if raw_idx < np.int64(scan_id_index[row]['index_start']):
+            lo, hi = 0, row
+        elif row + 1 == n_meta or raw_idx < np.int64(scan_id_index[row + 1]['index_start']):
+            lo, hi = row, row  # Same readout as the preceding hit
+        else:
+            lo, hi = row + 1, n_meta - 1
+        while lo < hi:  # Last row with index_start <= raw_idx (or the first row)
+            mid = (lo + hi + 1) // 2
+            if np.int64(scan_id_index[mid]['index_start']) <= raw_idx:
+                lo = mid
+            else:
+                hi = mid - 1
+        row = lo
+        if raw_idx < np.int64(scan_id_index[row]['index_start']) or raw_idx >= np.int64(scan_id_index[row]['index_stop']):
+            n_gaps += 1
+        hits[i]['scan_param_id'] = scan_id_index[row]['scan_param_id']
+    return SCAN_ID_GAP if n_gaps > 0 else 0, n_gaps, row
+
+
 def correlate_scan_ids(hits, meta_data):
-    meta_i = 0
-
-    for idx, param_id in enumerate(hits["scan_param_id"]):
-        while meta_i < len(meta_data):
-            if param_id >= meta_data[meta_i]['index_start'] and param_id < meta_data[meta_i]['index_stop']:
-                hits[idx]['scan_param_id'] = meta_data[meta_i]['scan_param_id']
-                break
-            elif param_id >= meta_data[meta_i]['index_stop']:
-                meta_i += 1
+    ''' Hits with the scan_param_id of the meta_data instead of the raw data index, see assign_scan_ids
+    '''
+    scan_id_index, flags = get_scan_id_index(meta_data)
+    gap_flags, n_gaps, _ = assign_scan_ids(hits, scan_id_index)
+    if flags & SCAN_ID_UNSORTED:
+        logger.warning('meta_data is not ordered by index_start')
+    if gap_flags & SCAN_ID_GAP:
+        logger.warning('%d hits are in no readout of the meta_data, scan_param_id of the preceding readout used', n_gaps)
     return hits
 
 
+scan_param_index_dtype = [('scan_param_id', '<i4'), ('start', '<i8'), ('stop', '<i8')]
+
+
+def get_scan_param_index(scan_param_id, index_start=None, index_stop=None, offset=0):
+    ''' Ranges of consecutive rows with the same scan_param_id
+
+        Without index_start/index_stop the ranges are row numbers (plus offset), e.g. of a hit table.
+        With the index_start/index_stop columns of the meta_data the ranges are raw_data words.
+    '''
+    scan_param_id = np.asarray(scan_param_id)
+    if scan_param_id.shape[0] == 0:
+        return np.zeros(0, dtype=scan_param_index_dtype)
+    first = np.r_[0, np.nonzero(np.diff(scan_param_id))[0] + 1]
+    last = np.r_[first[1:], scan_param_id.shape[0]]
+    index = np.zeros(first.shape[0], dtype=scan_param_index_dtype)
+    index['scan_param_id'] = scan_param_id[first]
+    index['start'] = first + offset if index_start is None else index_start[first]
+    index['stop'] = last + offset if index_stop is None else index_stop[last - 1]
+    return index
+
+
+def merge_scan_param_index(index, other):
+    ''' Append the ranges of other, a range continuing the last one of index is merged
+    '''
+    if index.shape[0] and other.shape[0] and index[-1]['scan_param_id'] == other[0]['scan_param_id'] \
+            and index[-1]['stop'] == other[0]['start']:
+        index = index.copy()
+        index[-1]['stop'] = other[0]['stop']
+        other = other[1:]
+    return np.concatenate([index, other])
+
+
+def create_scan_param_index(h5_file, node='raw_data', chunk_size=10000000):
+    ''' Write the scan_param_index table of node into the open h5_file
+
+        For raw_data the word ranges are taken from the meta_data, for hit tables (e.g. Dut) the row ranges are taken
+        from their scan_param_id column, read chunk by chunk.
+    '''
+    if node == 'raw_data':  # Word ranges of this file for segments of a rotated run
+        meta_data = h5_file.root.meta_data[:]
+        offset = get_raw_data_offset(h5_file.root.meta_data)
+        index = get_scan_param_index(meta_data['scan_param_id'], meta_data['index_start'] - offset, meta_data['index_stop'] - offset)
+    else:
+        table = h5_file.get_node(h5_file.root, node)
+        index = np.zeros(0, dtype=scan_param_index_dtype)
+        for start in range(0, table.nrows, chunk_size):
+            index = merge_scan_param_index(index, get_scan_param_index(
+                table.read(start, start + chunk_size, field='scan_param_id'), offset=start))
+    if 'scan_param_index' in h5_file.root:
+        h5_file.remove_node(h5_file.root, 'scan_param_index')
+    index_table = h5_file.create_table(h5_file.root, name='scan_param_index', obj=index,
+                                       title='Ranges of %s for every scan_param_id' % node)
+    index_table.attrs.node = node
+    return index
+
+
+def read_scan_param_index(h5_file, node=None):
+    ''' Scan parameter ranges of node (raw_data or hit table), without scan_param_index table (older files) it is created
+        from the meta_data or the hits in memory
+    '''
+    if 'scan_param_index' in h5_file.root and node in (None, h5_file.root.scan_param_index.attrs.node):
+        return h5_file.root.scan_param_index[:], h5_file.root.scan_param_index.attrs.node
+    if node is None:
+        node = 'raw_data' if 'raw_data' in h5_file.root else 'Dut'
+    if node == 'raw_data':
+        meta_data = h5_file.root.meta_data[:]
+        offset = get_raw_data_offset(h5_file.root.meta_data)
+        return get_scan_param_index(meta_data['scan_param_id'], meta_data['index_start'] - offset, meta_data['index_stop'] - offset), node
+    logger.info('No scan_param_index for %s, reading all scan_param_ids', node)
+    return get_scan_param_index(h5_file.get_node(h5_file.root, node).col('scan_param_id')), node
+
+
+def read_scan_param(h5_file, scan_param_id, node=None):
+    ''' Raw data words or hits of one scan parameter step without reading the whole file
+
+        Parameters
+        ----------
+        h5_file : tables.File
+            Raw data file (node raw_data) or interpreted file (node Dut)
+        scan_param_id : int
+        node : str
+            Node to read, default is the node of the scan_param_index (raw_data or Dut)
+    '''
+    index, node = read_scan_param_index(h5_file, node)
+    data = h5_file.get_node(h5_file.root, node)
+    ranges = index[index['scan_param_id'] == scan_param_id]
+    if ranges.shape[0] == 1:
+        return data[ranges[0]['start']:ranges[0]['stop']]
+    return np.concatenate([data[:0]] + [data[r['start']:r['stop']] for r in ranges])
+
+
 @numba.njit(locals={'cluster_shape': numba.int64})
 def calc_cluster_shape(cluster_array):
     '''Boolean 8x8 array to number.
@@ -77,42 +228,242 @@ def xy2d_morton(x, y):
 @numba.njit
 def occ_hist2d(hits):
     hist_occ = np.zeros(shape=(112, 224), dtype=np.uint32)
+    fill_occ_hist2d(hits, hist_occ)
+
+    return hist_occ
+
 
+@numba.njit
+def fill_occ_hist2d(hits, hist_occ):
     for hit in hits:
         col = hit['col']
         row = hit['row']
         if col >= 0 and col < hist_occ.shape[0] and row >= 0 and row < hist_occ.shape[1]:
             hist_occ[col, row] += 1
 
-    return hist_occ
-
 
 @numba.njit
 def scurve_hist3d(hits, scan_param_range):
-    hist_scurves = np.zeros(shape=(112, 224, len(scan_param_range)), dtype=np.uint16)
+    ''' Hit count per pixel and scan parameter (64 bit), use HitHistograms for hit count and ToT together
+    '''
+    hist_scurve = np.zeros(shape=(112, 224, len(scan_param_range)), dtype=np.uint64)
+    fill_scurve_hist3d(hits, hist_scurve)
 
+    return hist_scurve
+
+
+@numba.njit
+def fill_scurve_hist3d(hits, hist_scurve):
     for hit in hits:
         col = hit["col"]
         row = hit["row"]
         param = hit["scan_param_id"]
-        if col >= 0 and col < hist_scurves.shape[0] and row >= 0 and row < hist_scurves.shape[1]:
-            hist_scurves[col, row, param] += 1
-
-    return hist_scurves
+        if col < hist_scurve.shape[0] and row < hist_scurve.shape[1] and param >= 0 and param < hist_scurve.shape[2]:
+            hist_scurve[col, row, param] += 1
 
 
 @numba.njit
 def tot_ave3d(hits, scan_param_range):
-    ave_tots = np.zeros(shape=(112, 224, len(scan_param_range)), dtype=np.uint16)
+    ''' ToT sum per pixel and scan parameter (64 bit), use HitHistograms for hit count and ToT together
+    '''
+    hist_tot = np.zeros(shape=(112, 224, len(scan_param_range)), dtype=np.uint64)
+    fill_tot_hist3d(hits, hist_tot)
+
+    return hist_tot
+
+
+@numba.njit
+def fill_tot_hist3d(hits, hist_tot):
+    for hit in hits:
+        col = hit["col"]
+        row = hit["row"]
+        param = hit["scan_param_id"]
+        if col < hist_tot.shape[0] and row < hist_tot.shape[1] and param >= 0 and param < hist_tot.shape[2]:
+            hist_tot[col, row, param] += (hit["te"] - hit["le"]) & 0x3F
+
+
+@numba.njit
+def fill_scurve_tot_hist3d(hits, hist_scurve_tot):
+    ''' Fill hit count, ToT sum and ToT sum of squares per pixel and scan parameter in one pass
 
+        hist_scurve_tot has the shape (col, row, scan parameter, 3), the three values of a pixel and
+        scan parameter are adjacent in memory.
+    '''
     for hit in hits:
         col = hit["col"]
         row = hit["row"]
         param = hit["scan_param_id"]
-        if col >= 0 and col < ave_tots.shape[0] and row >= 0 and row < ave_tots.shape[1]:
-            ave_tots[col, row, param] += (hit["te"] - hit['le']) & 0x3F
+        if col < hist_scurve_tot.shape[0] and row < hist_scurve_tot.shape[1] and param >= 0 and param < hist_scurve_tot.shape[2]:
+            tot = (hit["te"] - hit["le"]) & 0x3F
+            hist_scurve_tot[col, row, param, 0] += 1
+            hist_scurve_tot[col, row, param, 1] += tot
+            hist_scurve_tot[col, row, param, 2] += tot * tot
+
+
+@numba.njit(parallel=True)
+def fill_scurve_tot_hist3d_parallel(hits, hist_scurve_tot, n_parts):
+    ''' Same as fill_scurve_tot_hist3d, hit ranges are histogrammed in parallel into partial histograms
+    '''
+    part_size = (hits.shape[0] + n_parts - 1) // n_parts
+    part_hists = np.zeros((n_parts, ) + hist_scurve_tot.shape, dtype=hist_scurve_tot.dtype)
+    for part in numba.prange(n_parts):
+        fill_scurve_tot_hist3d(hits[part * part_size:(part + 1) * part_size], part_hists[part])
+    for part in range(n_parts):
+        hist_scurve_tot += part_hists[part]
+
+
+class HitHistograms(object):
+    ''' Occupancy, s-curve and ToT histograms that are filled chunk by chunk
+
+        Memory does not depend on the number of hits. Histograms of different parts of the data
+        (e.g. filled in different processes) are merged with add(). The s-curve and ToT histograms
+        (hit count, ToT sum and ToT sum of squares per pixel and scan parameter, 64 bit each) are
+        only created if the number of scan parameters is given. With n_threads > 1 these are filled
+        by several threads, each with own partial histograms.
+    '''
+
+    def __init__(self, n_scan_params=None, n_threads=1):
+        self.n_threads = n_threads
+        self.hist_occ = np.zeros(shape=(112, 224), dtype=np.uint32)
+        if n_scan_params:
+            self.hist_scurve_tot = np.zeros(shape=(112, 224, n_scan_params, 3), dtype=np.uint64)
+        else:
+            self.hist_scurve_tot = None
+
+    @property
+    def hist_scurve(self):
+        return None if self.hist_scurve_tot is None else self.hist_scurve_tot[..., 0]
+
+    @property
+    def tot_sum(self):
+        return None if self.hist_scurve_tot is None else self.hist_scurve_tot[..., 1]
+
+    @property
+    def tot_sum2(self):
+        return None if self.hist_scurve_tot is None else self.hist_scurve_tot[..., 2]
+
+    def fill(self, hits):
+        fill_occ_hist2d(hits, self.hist_occ)
+        if self.hist_scurve_tot is None:
+            return
+        if self.n_threads > 1 and hits.shape[0] >= 10000 * self.n_threads:
+            fill_scurve_tot_hist3d_parallel(hits, self.hist_scurve_tot, self.n_threads)
+        else:
+            fill_scurve_tot_hist3d(hits, self.hist_scurve_tot)
+
+    def add(self, other):
+        self.hist_occ += other.hist_occ
+        if self.hist_scurve_tot is not None:
+            self.hist_scurve_tot += other.hist_scurve_tot
+        return self
+
+    def get_tot_mean(self):
+        ''' Mean ToT per pixel and scan parameter (NaN without hits) '''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return (self.tot_sum / self.hist_scurve.astype(np.float64)).astype(np.float32)
+
+    def get_tot_rms(self):
+        ''' ToT standard deviation per pixel and scan parameter (NaN without hits) '''
+        with np.errstate(invalid='ignore', divide='ignore'):
+            n_hits = self.hist_scurve.astype(np.float64)
+            variance = self.tot_sum2 / n_hits - (self.tot_sum / n_hits) ** 2
+        return np.sqrt(np.clip(variance, 0., None)).astype(np.float32)
+
+
+class BufferPool(object):
+    ''' Small pool of preallocated structured arrays that are reused chunk after chunk
+
+        The buffers of one name are handed out round robin, thus a buffer is overwritten only after
+        n_buffers further calls of get() and results of the previous chunk (views into the buffer)
+        stay valid meanwhile. Buffers are only reallocated if size or dtype change, their content
+        is not reset.
+    '''
+
+    def __init__(self, n_buffers=2):
+        self.n_buffers = n_buffers
+        self._buffers = {}
+        self._next = {}
 
-    return ave_tots
+    def get(self, name, size, dtype):
+        buffers = self._buffers.setdefault(name, [None] * self.n_buffers)
+        index = self._next.get(name, 0)
+        self._next[name] = (index + 1) % self.n_buffers
+        buffer = buffers[index]
+        if buffer is None or buffer.shape[0] < size or buffer.dtype != np.dtype(dtype):
+            buffer = buffers[index] = np.zeros(shape=size, dtype=dtype)
+        return buffer[:size]
+
+    @property
+    def nbytes(self):
+        return sum(buffer.nbytes for buffers in self._buffers.values() for buffer in buffers if buffer is not None)
+
+
+class RingBuffer(object):
+    ''' Pending rows of a streaming builder (e.g. TLU words waiting for their timestamp) with fixed capacity
+
+        append() adds rows (the fields of the buffer are taken by name), data is the contiguous view of the pending
+        rows and consume(n) releases the first n of them after every call of the builder. If new rows do not fit at
+        the end of the buffer the pending rows are moved to the start, thus the cost per call depends on the new and
+        pending rows only. If the capacity is exceeded the oldest rows are dropped (counted and logged).
+    '''
+
+    def __init__(self, capacity, dtype, name=None):
+        self.name = name
+        self._buffer = np.zeros(shape=capacity, dtype=dtype)
+        self._start = 0
+        self._stop = 0
+        self.n_appended = 0
+        self.n_consumed = 0
+        self.n_dropped = 0
+        self.n_moves = 0
+        self.max_fill = 0
+
+    @property
+    def capacity(self):
+        return self._buffer.shape[0]
+
+    @property
+    def data(self):
+        return self._buffer[self._start:self._stop]
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def append(self, rows):
+        n_rows = rows.shape[0]
+        n_dropped = max(0, len(self) + n_rows - self.capacity)
+        if n_dropped:
+            logger.warning('Ring buffer %s full (capacity %d), dropped the oldest %d rows', self.name, self.capacity, n_dropped)
+            self.n_dropped += n_dropped
+        if n_rows > self.capacity:  # Only the newest rows fit
+            self._start = self._stop = 0
+            rows, n_rows = rows[n_rows - self.capacity:], self.capacity
+        elif self._stop + n_rows > self.capacity:
+            self._start += n_dropped
+            n_pending = len(self)
+            if n_pending > 0:
+                self._buffer[:n_pending] = self._buffer[self._start:self._stop]
+                self.n_moves += 1
+            self._start, self._stop = 0, n_pending
+        for name in self._buffer.dtype.names:
+            self._buffer[name][self._stop:self._stop + n_rows] = rows[name]
+        self._stop += n_rows
+        self.n_appended += n_rows
+        self.max_fill = max(self.max_fill, len(self))
+
+    def consume(self, n_rows):
+        n_rows = min(n_rows, len(self))
+        self._start += n_rows
+        self.n_consumed += n_rows
+        if self._start == self._stop:
+            self._start = self._stop = 0
+
+    def clear(self):
+        self.consume(len(self))
+
+    def get_status(self):
+        return {'name': self.name, 'capacity': self.capacity, 'fill': len(self), 'max_fill': self.max_fill,
+                'appended': self.n_appended, 'consumed': self.n_consumed, 'dropped': self.n_dropped, 'moves': self.n_moves}
 
 
 def imap_bar(func, args, n_processes=None):
@@ -149,8 +500,8 @@ def get_threshold(x, y, n_injections, invert_x=False):
     if not np.all(np.diff(x) == d):
         raise NotImplementedError('Threshold can only be calculated for equidistant x values!')
     if invert_x:
-        return x.min() + (d * M).astype(np.float) / n_injections
-    return x.max() - (d * M).astype(np.float) / n_injections
+        return x.min() + (d * M).astype(np.float64) / n_injections
+    return x.max() - (d * M).astype(np.float64) / n_injections
 
 
 def get_noise(x, y, n_injections, invert_x=False):
@@ -176,7 +527,7 @@ def get_noise(x, y, n_injections, invert_x=False):
         mu1 = y[x < mu].sum()
         mu2 = (n_injections - y[x > mu]).sum()
 
-    return d * (mu1 + mu2).astype(np.float) / n_injections * np.sqrt(np.pi / 2.)
+    return d * (mu1 + mu2).astype(np.float64) / n_injections * np.sqrt(np.pi / 2.)
 
 
 def fit_scurve(scurve_data, scan_param_range, n_injections, sigma_0, invert_x):
@@ -188,7 +539,7 @@ def fit_scurve(scurve_data, scan_param_range, n_injections, sigma_0, invert_x):
             (mu, sigma, chi2/ndf)
     '''
 
-    scurve_data = np.array(scurve_data, dtype=np.float)
+    scurve_data = np.array(scurve_data, dtype=np.float64)
 
     # Deselect masked values (== nan)
     x = scan_param_range[~np.isnan(scurve_data)]
@@ -201,7 +552,7 @@ def fit_scurve(scurve_data, scan_param_range, n_injections, sigma_0, invert_x):
         return (0., 0., 0.)
 
     # Calculate data errors, Binomial errors
-    yerr = np.sqrt(y * (1. - y.astype(np.float) / n_injections))
+    yerr = np.sqrt(y * (1. - y.astype(np.float64) / n_injections))
     # Set minimum error != 0, needed for fit minimizers
     # Set arbitrarly to error of 0.5 injections
     min_err = np.sqrt(0.5 - 0.5 / n_injections)
@@ -266,12 +617,12 @@ def fit_scurves_multithread(scurves, scan_param_range, n_injections=None, invert
     # plateau region of an S-curve and only taking the value until the plateau ends. Fit range
     # is specified by a masked array.
     if optimize_fit_range:
-        scurve_mask = np.ones_like(scurves, dtype=np.bool)  # Mask to specify fit range
+        scurve_mask = np.ones_like(scurves, dtype=np.bool_)  # Mask to specify fit range
         for i, scurve in enumerate(scurves):
             if not np.any(scurve) or np.all(scurve == n_injections):  # Speedup, nothing to do
                 continue
 
-            scurve_diff = np.diff(scurve.astype(np.float))
+            scurve_diff = np.diff(scurve.astype(np.float64))
             max_inj = np.min([n_injections, scurve.max()])
 
             # Get indeces where S-Curve is settled (max injections and no slope)
@@ -343,13 +694,120 @@ def fit_scurves_multithread(scurves, scan_param_range, n_injections=None, invert
     return thr2D, sig2D, chi2ndf2D
 
 
+def fit_scurves_vectorized(scurves, scan_param_range, n_injections=None, invert_x=False, max_iterations=100):
+    ''' Fit S-curves of all pixels at once with a vectorized Levenberg-Marquardt fit.
+
+        Same start values, data errors, fit model and result selection as fit_scurve, thus the
+        results agree with fit_scurves_multithread within the fit tolerance, but without a
+        curve_fit call per pixel.
+
+        Parameters
+        ----------
+        scurves: numpy array like
+            Histogram with S-Curves. Channel index in the first and data in the second dimension.
+            Masked (masked array) or NaN values are not used in the fit.
+        scan_param_range: array like
+            Values used durig S-Curve scanning.
+        n_injections: integer
+            Number of injections
+        invert_x: boolean
+            True when x-axis inverted
+        max_iterations: integer
+            Maximum number of Levenberg-Marquardt iterations
+    '''
+    x = np.array(scan_param_range, dtype=np.float64)
+    y = np.ma.filled(np.ma.masked_array(scurves, dtype=np.float64), np.nan)
+    valid = ~np.isnan(y)
+    y = np.where(valid, y, 0.)
+    n_valid = valid.sum(axis=1)
+    d = np.diff(x)[0]
+    if not np.all(np.diff(x) == d):
+        raise NotImplementedError('Threshold can only be calculated for equidistant x values!')
+
+    # Start values: threshold and noise from fit less approximation (see get_threshold, get_noise)
+    x_valid = np.where(valid, x, np.nan)
+    with np.errstate(invalid='ignore'):
+        if invert_x:
+            mu_0 = np.nanmin(x_valid, axis=1) + d * y.sum(axis=1) / n_injections
+        else:
+            mu_0 = np.nanmax(x_valid, axis=1) - d * y.sum(axis=1) / n_injections
+        below, above = x_valid < mu_0[:, np.newaxis], x_valid > mu_0[:, np.newaxis]
+    if invert_x:
+        below, above = above, below
+    noise = np.abs(d) * ((y * below).sum(axis=1) + ((n_injections - y) * above).sum(axis=1)) / n_injections * np.sqrt(np.pi / 2.)
+    y_max = np.where(valid, y, -np.inf).max(axis=1)
+    sigma_0 = np.median(noise[y_max == n_injections]) if np.any(y_max == n_injections) else 1.
+
+    # Only fit data that is fittable
+    fit = np.logical_and(n_valid >= 3, y_max >= 0.2 * n_injections)
+
+    # Binomial errors with a minimum error of 0.5 injections, additional hits not following fit model get high error
+    y_err = np.sqrt(np.clip(y * (1. - y / n_injections), 0., None))
+    y_err = np.maximum(y_err, np.sqrt(0.5 - 0.5 / n_injections))
+    y_err = np.where(y > n_injections, y - n_injections, y_err)
+    weight = np.where(valid, 1. / y_err, 0.)
+
+    sign = -1. if invert_x else 1.  # zcurve: S-curve mirrored at mu
+
+    def model(p):
+        z = (x - p[:, 1:2]) / (np.sqrt(2.) * p[:, 2:3])
+        return z, 0.5 * p[:, 0:1] * (1. + sign * erf(z))
+
+    def chi2(p, y, weight):
+        return np.sum(((y - model(p)[1]) * weight) ** 2, axis=1)
+
+    params = np.zeros(shape=(scurves.shape[0], 3))
+    params[:, 0], params[:, 1], params[:, 2] = n_injections, mu_0, sigma_0
+    lambdas = np.full(scurves.shape[0], 1e-3)
+    active = np.where(np.logical_and(fit, np.isfinite(mu_0)))[0]
+    current_chi2 = chi2(params[active], y[active], weight[active])
+    for _ in range(max_iterations):
+        if active.shape[0] == 0:
+            break
+        p, y_a, w_a = params[active], y[active], weight[active]
+        z, f = model(p)
+        # Weighted residuals and Jacobian of the model for all active pixels
+        r = (y_a - f) * w_a
+        df_dz = sign * p[:, 0:1] * np.exp(-z ** 2) / np.sqrt(np.pi)
+        jac = np.stack([(1. + sign * erf(z)) / 2., -df_dz / (np.sqrt(2.) * p[:, 2:3]), -df_dz * z / p[:, 2:3]], axis=2) * w_a[:, :, np.newaxis]
+        jtj = np.einsum('nki,nkj->nij', jac, jac)
+        jtr = np.einsum('nki,nk->ni', jac, r)
+        damped = jtj + (lambdas[active, np.newaxis, np.newaxis] * np.eye(3)) * jtj + 1e-12 * np.eye(3)
+        step = np.linalg.solve(damped, jtr[:, :, np.newaxis])[:, :, 0]
+        new_p = p + step
+        with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+            new_chi2 = chi2(new_p, y_a, w_a)
+        better = new_chi2 < current_chi2
+        params[active[better]] = new_p[better]
+        lambdas[active] = np.where(better, lambdas[active] / 10., lambdas[active] * 10.)
+        converged = np.logical_or(np.logical_and(better, current_chi2 - new_chi2 <= 1e-10 * current_chi2),
+                                  lambdas[active] > 1e10)
+        current_chi2 = np.where(better, new_chi2, current_chi2)[~converged]
+        active = active[~converged]
+
+    # Treat data that does not follow an S-Curve, every fit result is possible here but not meaningful
+    mu, sigma = params[:, 1], params[:, 2]
+    with np.errstate(invalid='ignore'):
+        x_min, x_max = np.nanmin(np.where(valid, x, np.nan), axis=1), np.nanmax(np.where(valid, x, np.nan), axis=1)
+        good = np.logical_and.reduce([fit, sigma > 0, mu > x_min - 5. * np.abs(sigma), mu < x_max + 5. * np.abs(sigma)])
+        chi2ndf = np.sum(np.where(valid, y - model(params)[1], 0.) ** 2, axis=1) / (n_valid - 3 - 1)
+
+    thr = np.where(good, mu, 0.)
+    sig = np.where(good, sigma, 0.)
+    chi2ndf = np.where(good, chi2ndf, 0.)
+    thr2D = np.reshape(thr, (112, 224))
+    sig2D = np.reshape(sig, (112, 224))
+    chi2ndf2D = np.reshape(chi2ndf, (112, 224))
+    return thr2D, sig2D, chi2ndf2D
+
+
 def fit_line(y_data, y_err, x_data):
     """
         Fit line to x and y data.
         Returns:
             (slope, offset, chi2)
     """
-    y_data = np.array(y_data, dtype=np.float)
+    y_data = np.array(y_data, dtype=np.float64)
 
     # Select valid data
     x = x_data[~np.isnan(y_data)]
@@ -380,8 +838,8 @@ def fit_gauss(y_data, y_err, x_data):
         Returns:
             (amp, mu, sigma, chi2)
     """
-    y_data = np.array(y_data, dtype=np.float)
-    y_err = np.array(y_err, dtype=np.float)
+    y_data = np.array(y_data, dtype=np.float64)
+    y_err = np.array(y_err, dtype=np.float64)
 
     # Select valid data
     x = x_data[~np.isnan(y_data)]
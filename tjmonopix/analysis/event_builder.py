@@ -11,13 +11,71 @@ logging.basicConfig(
 
 logger = logger = logging.getLogger("Event builder")
 
+# Default time window of the hits of an event: hit timestamp - trigger timestamp in 640 MHz clock cycles,
+# optimized for 99.99% correct event reconstruction (cuts -518 < trigger - hit < 773 on timestamps masked with 0x7FFF0)
+WINDOW_START = -768
+WINDOW_STOP = 527
+# Maximum time a TLU word can follow TJ hits with a later timestamp in the data, older hits are not kept for the next chunk
+MAX_TRIGGER_DELAY = 0x10000
+
 class_spec = [
-    ("chunk_size", numba.uint32),
-    ("tlu_index", numba.int64),
+    ("window_start", numba.int64),
+    ("window_stop", numba.int64),
+    ("max_trigger_delay", numba.int64),
     ("trigger_number", numba.int64),
     ("trigger_timestamp", numba.int64),
+    ("last_hit_timestamp", numba.int64),
+    ("n_out_of_order", numba.int64),
+    # TJ hits ordered by timestamp that can be in the window of the following triggers: hit_start to hit_start + n_hits
+    ("hit_start", numba.int64),
+    ("n_hits", numba.int64),
+    ("hit_timestamp", numba.int64[:]),
+    ("hit_column", numba.uint8[:]),
+    ("hit_row", numba.uint8[:]),
+    ("hit_charge", numba.uint8[:]),
+    # Triggers that are not processed yet: trigger_start to trigger_start + n_triggers
+    ("trigger_start", numba.int64),
+    ("n_triggers", numba.int64),
+    ("first_without_next", numba.int64),
+    ("trigger_numbers", numba.int64[:]),
+    ("trigger_tlu_timestamps", numba.int64[:]),
+    ("trigger_timestamps", numba.int64[:]),
+    ("trigger_prev_hit", numba.int64[:]),
+    ("trigger_next_hit", numba.int64[:]),
 ]
 
+# State (see get_state): scalars and the used part of the hit and trigger arrays, first_without_next relative to trigger_start
+state_names = [name for name, _ in class_spec if name not in ("window_start", "window_stop", "max_trigger_delay", "hit_start", "trigger_start")]
+
+
+def get_state(builder):
+    ''' Return the state of an EventBuilder as dict, e.g. for an analysis checkpoint
+    '''
+    state = {}
+    for name in state_names:
+        value = getattr(builder, name)
+        if isinstance(value, np.ndarray):
+            if name.startswith("hit_"):
+                value = value[builder.hit_start:builder.hit_start + builder.n_hits].copy()
+            else:
+                value = value[builder.trigger_start:builder.trigger_start + builder.n_triggers].copy()
+        state[name] = value
+    state["first_without_next"] -= builder.trigger_start
+    return state
+
+
+def set_state(builder, state):
+    ''' Set the state of an EventBuilder from a dict (see get_state)
+    '''
+    builder.reset()
+    builder.reserve_hits(state["hit_timestamp"].shape[0])
+    builder.reserve_triggers(state["trigger_numbers"].shape[0])
+    for name in state_names:
+        if isinstance(state[name], np.ndarray):
+            getattr(builder, name)[:state[name].shape[0]] = state[name]
+        else:
+            setattr(builder, name, int(state[name]))
+
 
 def build_events(hit_data, chunk_size=1000000):
     event_dtype = [
@@ -28,12 +86,11 @@ def build_events(hit_data, chunk_size=1000000):
         ("charge", "u1"),
     ]
 
-    builder = EventBuilder()
-    events = np.array([], dtype=event_dtype)
+    builder = EventBuilder(WINDOW_START, WINDOW_STOP)
+    events = []
 
     start = 0
     n_hits = len(hit_data)
-    end_of_last_chunk = np.zeros(23, dtype=hit_data.dtype)
 
     logger.info("Building events")
     pbar = tqdm(total=n_hits)
@@ -41,76 +98,240 @@ def build_events(hit_data, chunk_size=1000000):
         tmp_end = min(n_hits, start + chunk_size)
         hits = hit_data[start:tmp_end]
         ev_buffer = np.zeros(len(hits), dtype=event_dtype)
-        event_chunk, end_of_last_chunk = builder.build_events(hits, ev_buffer, end_of_last_chunk)
-
-        events = np.append(events, event_chunk)
+        events.append(builder.build_events(hits, ev_buffer, tmp_end == n_hits).copy())
+        while tmp_end == n_hits and builder.n_triggers:  # Event buffer was full
+            events.append(builder.build_events(hits[:0], ev_buffer, True).copy())
         pbar.update(tmp_end - start)
         start = tmp_end
     pbar.close()
+    events = np.concatenate(events) if events else np.zeros(0, dtype=event_dtype)
     logger.info("%s events build" % len(events))
 
     return events
 
 
+@numba.njit
+def _expand_timestamp(tlu_timestamp, reference):
+    ''' Timestamp with the 19 bit of the TLU word that is closest to the reference timestamp
+    '''
+    diff = (tlu_timestamp - reference) & 0x7FFFF
+    if diff >= 0x40000:
+        diff -= 0x80000
+    return reference + diff
+
+
 @numba.experimental.jitclass(class_spec)
 class EventBuilder(object):
-    def __init__(self):
+    ''' Events of TJ hits in the time window around the trigger (TLU word) from the time ordered hits and triggers
+
+        The 19 bit trigger timestamp of the TLU word is expanded with the timestamp of the TJ hit before or after the
+        TLU word in the data (whichever is closer), the 16 bit trigger number counts the overflows. Hits and triggers
+        are merged in one pass, every hit is added to all triggers with the hit in the window [window_start, window_stop].
+        Triggers are processed when their window is closed, hits and triggers of the following chunks are taken into
+        account, hits that cannot be in the window of a following trigger are removed.
+    '''
+    def __init__(self, window_start, window_stop):
+        self.window_start = window_start
+        self.window_stop = window_stop
+        self.max_trigger_delay = MAX_TRIGGER_DELAY
+        self.hit_timestamp = np.zeros(1024, dtype=np.int64)
+        self.hit_column = np.zeros(1024, dtype=np.uint8)
+        self.hit_row = np.zeros(1024, dtype=np.uint8)
+        self.hit_charge = np.zeros(1024, dtype=np.uint8)
+        self.trigger_numbers = np.zeros(1024, dtype=np.int64)
+        self.trigger_tlu_timestamps = np.zeros(1024, dtype=np.int64)
+        self.trigger_timestamps = np.zeros(1024, dtype=np.int64)
+        self.trigger_prev_hit = np.zeros(1024, dtype=np.int64)
+        self.trigger_next_hit = np.zeros(1024, dtype=np.int64)
         self.reset()
 
     def reset(self):
-        self.tlu_index = 0
         self.trigger_number = -1
         self.trigger_timestamp = -1
+        self.last_hit_timestamp = -1
+        self.n_out_of_order = 0
+        self.hit_start = 0
+        self.n_hits = 0
+        self.trigger_start = 0
+        self.n_triggers = 0
+        self.first_without_next = 0
+
+    def reserve_hits(self, size):
+        ''' Space for size hits after hit_start, the pending hits are moved to the start of the arrays if needed
+        '''
+        if self.hit_start + size > self.hit_timestamp.shape[0] and self.hit_start > 0:
+            for j in range(self.n_hits):
+                self.hit_timestamp[j] = self.hit_timestamp[self.hit_start + j]
+                self.hit_column[j] = self.hit_column[self.hit_start + j]
+                self.hit_row[j] = self.hit_row[self.hit_start + j]
+                self.hit_charge[j] = self.hit_charge[self.hit_start + j]
+            self.hit_start = 0
+        if size > self.hit_timestamp.shape[0]:
+            size = max(size, 2 * self.hit_timestamp.shape[0])
+            hit_timestamp = np.zeros(size, dtype=np.int64)
+            hit_column = np.zeros(size, dtype=np.uint8)
+            hit_row = np.zeros(size, dtype=np.uint8)
+            hit_charge = np.zeros(size, dtype=np.uint8)
+            hit_timestamp[:self.n_hits] = self.hit_timestamp[:self.n_hits]
+            hit_column[:self.n_hits] = self.hit_column[:self.n_hits]
+            hit_row[:self.n_hits] = self.hit_row[:self.n_hits]
+            hit_charge[:self.n_hits] = self.hit_charge[:self.n_hits]
+            self.hit_timestamp, self.hit_column, self.hit_row, self.hit_charge = hit_timestamp, hit_column, hit_row, hit_charge
+
+    def reserve_triggers(self, size):
+        ''' Space for size triggers after trigger_start, the pending triggers are moved to the start of the arrays if needed
+        '''
+        if self.trigger_start + size > self.trigger_numbers.shape[0] and self.trigger_start > 0:
+            for t in range(self.n_triggers):
+                self.trigger_numbers[t] = self.trigger_numbers[self.trigger_start + t]
+                self.trigger_tlu_timestamps[t] = self.trigger_tlu_timestamps[self.trigger_start + t]
+                self.trigger_timestamps[t] = self.trigger_timestamps[self.trigger_start + t]
+                self.trigger_prev_hit[t] = self.trigger_prev_hit[self.trigger_start + t]
+                self.trigger_next_hit[t] = self.trigger_next_hit[self.trigger_start + t]
+            self.first_without_next -= self.trigger_start
+            self.trigger_start = 0
+        if size > self.trigger_numbers.shape[0]:
+            size = max(size, 2 * self.trigger_numbers.shape[0])
+            trigger_numbers = np.zeros(size, dtype=np.int64)
+            trigger_tlu_timestamps = np.zeros(size, dtype=np.int64)
+            trigger_timestamps = np.zeros(size, dtype=np.int64)
+            trigger_prev_hit = np.zeros(size, dtype=np.int64)
+            trigger_next_hit = np.zeros(size, dtype=np.int64)
+            trigger_numbers[:self.n_triggers] = self.trigger_numbers[:self.n_triggers]
+            trigger_tlu_timestamps[:self.n_triggers] = self.trigger_tlu_timestamps[:self.n_triggers]
+            trigger_timestamps[:self.n_triggers] = self.trigger_timestamps[:self.n_triggers]
+            trigger_prev_hit[:self.n_triggers] = self.trigger_prev_hit[:self.n_triggers]
+            trigger_next_hit[:self.n_triggers] = self.trigger_next_hit[:self.n_triggers]
+            self.trigger_numbers, self.trigger_tlu_timestamps, self.trigger_timestamps = trigger_numbers, trigger_tlu_timestamps, trigger_timestamps
+            self.trigger_prev_hit, self.trigger_next_hit = trigger_prev_hit, trigger_next_hit
 
-    def build_events(self, hits, ev_buffer, end_of_last_chunk):
-        # Use only DUT and TLU words
-        sel = np.logical_or(hits["col"] == 255, hits["col"] < 112)
-        data = hits[sel]
+    def build_events(self, hits, ev_buffer, flush):
+        ''' Add the hits of the next chunk and return the events of all triggers with closed window
 
-        # Add last chunk in beginning of current one
-        data = np.append(end_of_last_chunk, data)
+            With flush (last chunk) all triggers are processed. If ev_buffer is full the remaining triggers are
+            processed with the next call (with flush call again until n_triggers is 0).
+        '''
+        self.reserve_hits(self.n_hits + hits.shape[0])
+        self.reserve_triggers(self.n_triggers + hits.shape[0])
+        for i in range(hits.shape[0]):
+            col = hits[i]["col"]
+            if col < 112:  # TJ hit, sorted in by timestamp (out of order hits are rare)
+                timestamp = np.int64(hits[i]["timestamp"])
+                j = self.hit_start + self.n_hits
+                while j > self.hit_start and self.hit_timestamp[j - 1] > timestamp:
+                    self.hit_timestamp[j] = self.hit_timestamp[j - 1]
+                    self.hit_column[j] = self.hit_column[j - 1]
+                    self.hit_row[j] = self.hit_row[j - 1]
+                    self.hit_charge[j] = self.hit_charge[j - 1]
+                    j -= 1
+                if j < self.hit_start + self.n_hits:
+                    self.n_out_of_order += 1
+                self.hit_timestamp[j] = timestamp
+                self.hit_column[j] = col + 1
+                self.hit_row[j] = hits[i]["row"] + 1
+                self.hit_charge[j] = ((hits[i]["te"] - hits[i]["le"]) & 0x3F) + 1
+                self.n_hits += 1
+                self.last_hit_timestamp = timestamp
+                for t in range(self.first_without_next, self.trigger_start + self.n_triggers):
+                    self.trigger_next_hit[t] = timestamp
+                self.first_without_next = self.trigger_start + self.n_triggers
+            elif col == 255:  # TLU word
+                cnt = np.int64(hits[i]["cnt"])
+                # Check for trigger number overflow
+                if self.trigger_number >= 0 and cnt < (self.trigger_number & 0xFFFF):
+                    self.trigger_number += 0x10000
+                if self.trigger_number < 0:
+                    self.trigger_number = cnt
+                else:
+                    self.trigger_number = (self.trigger_number & 0x7FFFFFFFFFFF0000) | cnt
+                t = self.trigger_start + self.n_triggers
+                self.trigger_numbers[t] = self.trigger_number
+                self.trigger_tlu_timestamps[t] = hits[i]["timestamp"]
+                self.trigger_timestamps[t] = -1
+                self.trigger_prev_hit[t] = self.last_hit_timestamp
+                self.trigger_next_hit[t] = -1
+                self.n_triggers += 1
+        return self._build(ev_buffer, flush)
 
-        # Go through TLU words
-        tlu_indices = np.where(data["col"][:-8] == 255)[0]  # Look only until -8th data word
+    def _build(self, ev_buffer, flush):
         out_i = 0
-        for tlu_word_i in tlu_indices:
-            # if tlu_word_i > (len(dat) - 8):
-            #     continue
-
-            # Check for trigger timestamp overflow
-            if self.trigger_timestamp >= 0 and data[tlu_word_i]["timestamp"] < (self.trigger_timestamp & 0x7FFF0):
-                self.trigger_timestamp = (2 ** 15 << 4) + self.trigger_timestamp
-            # Get trigger timestamp
-            if self.trigger_timestamp < 0:
-                self.trigger_timestamp = data[tlu_word_i]["timestamp"]
-            else:
-                self.trigger_timestamp = (0x7FFFFFFFFFF80000 & self.trigger_timestamp) | data[tlu_word_i]["timestamp"]
-
-            # For every TLU word look for (time-wise) close hits in vicinity
-            for word in data[tlu_word_i - 15 : tlu_word_i + 8]:
-                if (  # DO NOT CHANGE CONSTANTS HERE: optimized for 99.99% correct event reconstruction
-                    word["col"] < 112
-                    and ((self.trigger_timestamp & 0x7FFF0) - (word["timestamp"] & 0x7FFF0)) > -518
-                    and ((self.trigger_timestamp & 0x7FFF0) - (word["timestamp"] & 0x7FFF0)) < 773
-                ):
-                    # Check for trigger number overflow
-                    if self.trigger_number >= 0 and data[tlu_word_i]["cnt"] < (
-                        self.trigger_number & 0x000000000000FFFF
-                    ):
-                        self.trigger_number = np.int64(2 ** 16) + self.trigger_number
-                    # Get trigger number
-                    if self.trigger_number < 0:
-                        self.trigger_number = data[tlu_word_i]["cnt"]
-                    else:
-                        self.trigger_number = (0x7FFFFFFFFFFF0000 & self.trigger_number) | data[tlu_word_i]["cnt"]
-
-                    ev_buffer[out_i]["event_number"] = self.trigger_number
-                    ev_buffer[out_i]["column"] = word["col"] + 1
-                    ev_buffer[out_i]["row"] = word["row"] + 1
-                    ev_buffer[out_i]["charge"] = ((word["te"] - word["le"]) & 0x3F) + 1
-                    out_i += 1
-        end_of_chunk = data[-23:]  # Carry last 15 + 8 words to next chunk
-        return ev_buffer[:out_i], end_of_chunk
+        lo = self.hit_start
+        hit_stop = self.hit_start + self.n_hits
+        t = self.trigger_start
+        while t < self.trigger_start + self.n_triggers:
+            if self.trigger_timestamps[t] < 0:
+                if self.trigger_next_hit[t] < 0 and not flush:
+                    break
+                self.trigger_timestamps[t] = self._expand(t)
+            trigger_timestamp = self.trigger_timestamps[t]
+            if not flush and self.last_hit_timestamp <= trigger_timestamp + self.window_stop:
+                break  # Hits in the window can follow
+
+            while lo < hit_stop and self.hit_timestamp[lo] < trigger_timestamp + self.window_start:
+                lo += 1
+            stop = lo
+            while stop < hit_stop and self.hit_timestamp[stop] <= trigger_timestamp + self.window_stop:
+                stop += 1
+            if out_i + stop - lo > ev_buffer.shape[0]:
+                if out_i == 0:
+                    raise ValueError("ev_buffer is too small for the hits of one trigger")
+                break
+            for j in range(lo, stop):
+                ev_buffer[out_i]["event_number"] = self.trigger_numbers[t]
+                ev_buffer[out_i]["frame"] = 0
+                ev_buffer[out_i]["column"] = self.hit_column[j]
+                ev_buffer[out_i]["row"] = self.hit_row[j]
+                ev_buffer[out_i]["charge"] = self.hit_charge[j]
+                out_i += 1
+            self.trigger_timestamp = trigger_timestamp
+            t += 1
+        self._remove(t - self.trigger_start)
+        return ev_buffer[:out_i]
+
+    def _expand(self, t):
+        tlu_timestamp = self.trigger_tlu_timestamps[t]
+        prev_hit, next_hit = self.trigger_prev_hit[t], self.trigger_next_hit[t]
+        if prev_hit >= 0 and next_hit >= 0:
+            prev_timestamp = _expand_timestamp(tlu_timestamp, prev_hit)
+            next_timestamp = _expand_timestamp(tlu_timestamp, next_hit)
+            if abs(prev_timestamp - prev_hit) <= abs(next_timestamp - next_hit):
+                return prev_timestamp
+            return next_timestamp
+        if prev_hit >= 0:
+            return _expand_timestamp(tlu_timestamp, prev_hit)
+        if next_hit >= 0:
+            return _expand_timestamp(tlu_timestamp, next_hit)
+        if self.trigger_timestamp >= 0:  # No TJ hits, overflow of the trigger timestamp
+            return self.trigger_timestamp + ((tlu_timestamp - self.trigger_timestamp) & 0x7FFFF)
+        return tlu_timestamp
+
+    def _remove(self, n_processed):
+        ''' Remove the processed triggers and the hits that cannot be in the window of a following trigger
+
+            Only the start indices are advanced, the arrays are compacted by reserve_hits and reserve_triggers.
+        '''
+        self.trigger_start += n_processed
+        self.n_triggers -= n_processed
+        self.first_without_next = max(self.trigger_start, self.first_without_next)
+
+        limit = self.last_hit_timestamp - self.max_trigger_delay
+        if self.trigger_timestamp >= 0:
+            limit = max(limit, self.trigger_timestamp)
+        for t in range(self.trigger_start, self.trigger_start + self.n_triggers):
+            if self.trigger_timestamps[t] >= 0:
+                limit = min(limit, self.trigger_timestamps[t])
+            elif self.trigger_prev_hit[t] >= 0:
+                limit = min(limit, self.trigger_prev_hit[t] - self.max_trigger_delay)
+        n_removed = 0
+        while n_removed < self.n_hits and self.hit_timestamp[self.hit_start + n_removed] < limit + self.window_start:
+            n_removed += 1
+        self.hit_start += n_removed
+        self.n_hits -= n_removed
+        if self.n_hits == 0:
+            self.hit_start = 0
+        if self.n_triggers == 0:
+            self.first_without_next -= self.trigger_start
+            self.trigger_start = 0
 
 
 if __name__ == "__main__":
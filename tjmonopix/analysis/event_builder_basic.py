@@ -1,6 +1,18 @@
+from __future__ import print_function
+import logging
+
 import numpy as np
 from numba import njit 
 
+from tjmonopix.analysis.analysis_utils import RingBuffer
+from tjmonopix.analysis.tlu_timestamp_synchronizer import TLUTimestampSynchronizer, sync_dtype
+
+logger = logging.getLogger('BuildEvents')
+
+event_dtype=[("le","u1"),("te","u1"),("column","u1"),("row","u2"),("trigger_number","i2"),("tlu_timestamp","u8"),
+             ("ts_timestamp","u8"),("token_timestamp","u8")]
+event_dtype_short=[("column","u1"),("row","u2"),("trigger_number","i2")]  # data_format without 0x2
+
 @njit
 def _build_with_tlu(sync,tj,data_out,upper,lower,data_format):
     tj_i=0
@@ -25,91 +37,67 @@ def _build_with_tlu(sync,tj,data_out,upper,lower,data_format):
                 data_out[i]["tlu_timestamp"]= sync[sync_i]["tlu_timestamp"]
                 data_out[i]["ts_timestamp"]= sync[sync_i]["ts_timestamp"]
                 data_out[i]["token_timestamp"]= tj[tj_i]["timestamp"]
+                data_out[i]["le"]= tj[tj_i]["le"]
+                data_out[i]["te"]= tj[tj_i]["te"]
             i= i+1
             tj_i = tj_i+1
     return 0, i, sync_i, tj_i, data_out
 
-@njit
-def _sync_tlu_timestamp(tlu,ts,data_out,offset):
-    tlu_i=0
-    ts_i=0
-    i=0
-    while tlu_i < len(tlu) and ts_i < len(ts) and i < len(data_out):
-        #print tlu_i, hex(tlu[tlu_i]["timestamp"]), ts_i, hex(ts[ts_i]["timestamp"]), 
-        #print hex((tlu[tlu_i]["timestamp"] - ts[ts_i]["timestamp"]) & np.uint64(0x7FFFF)),
-        if (tlu[tlu_i]["timestamp"] - ts[ts_i]["timestamp"] - np.uint64(offset+16*2)) & np.uint64(0x7FFFF)  <= 0x40000:
-            #ts_i =ts_i+1
-            #print "next ts"
-            print "tlu and tlu_ts is not synchronized, synchronize data manually",tlu_i,ts_i
-            return 1, i, tlu_i, ts_i, data_out
-        elif ((tlu[tlu_i]["timestamp"] - ts[ts_i]["timestamp"]- np.uint64(offset-16)) & np.uint64(0x7FFFF) ) > 0x40000:
-            #tlu_i=tlu_i+1
-            #print "next tlu"
-            print "tlu and tlu_ts is not synchronized, synchronize data manually",tlu_i,ts_i
-            return 2, i, tlu_i, ts_i, data_out
-        else:
-            data_out[i]["trigger_number"]=tlu[tlu_i]["cnt"] 
-            data_out[i]["tlu_timestamp"]=tlu[tlu_i]["timestamp"]
-            data_out[i]["ts_timestamp"]=ts[ts_i]["timestamp"]
-            ts_i=ts_i+1
-            tlu_i=tlu_i+1
-            i=i+1
-    return 0, i, tlu_i, ts_i, data_out
-
 
 class BuildEvents():
-    def __init__(self,upper=0x80,lower=-0x100,WAIT_CYCLES=20,data_format=0x2):
-        self.data_format=2
-        self.reset(upper,lower,WAIT_CYCLES)
-        
-    def reset(self,upper=0x80,lower=-0x100,WAIT_CYCLES=20,n=1000000):
-        if self.data_format & 0x2 == 0x2:
-            data_out_type=[("column","u1"),("row","u2"), ("trigger_number","i2"),("tlu_timestamp","u8"),("ts_timestamp","u8"), 
-                   ("token_timestamp","u8")]
-        else:
-            data_out_type=[("column","u1"),("row","u2"), ("trigger_number","i2")]
-        buf_type=[("trigger_number","i2"),("tlu_timestamp","u8"),("ts_timestamp","u8")]
-        
+    ''' Assigns the TLU trigger numbers to the TJ hits of consecutive chunks (online monitor, event_builder_mon.build_h5)
+
+        The TLU words are paired with the trigger timestamps by the TLUTimestampSynchronizer (re-syncs after lost
+        words), the pending TJ hits and synchronized triggers are kept in ring buffers of fixed capacity and
+        consumed entries are released after every call. get_status() gives the synchronisation counters and the
+        fill and trimming statistics of the buffers. run(hits, flush=True) for the last chunk of a file returns all
+        remaining events.
+
+        data_format 0x2 gives events of event_dtype (with LE, TE and timestamps), without it the events have
+        event_dtype_short. 0x1 logs the result of every build.
+    '''
+    def __init__(self,upper=0x80,lower=-0x100,WAIT_CYCLES=20,data_format=0x2,n=1000000,capacity=1000000,resync_window=16):
+        self.data_format=data_format
+        self.dtype=event_dtype if data_format & 0x2 == 0x2 else event_dtype_short
+        self.sync=TLUTimestampSynchronizer(WAIT_CYCLES,resync_window=resync_window,n=n,capacity=capacity)
+        self.reset(upper,lower,WAIT_CYCLES,n=n,capacity=capacity)
         
-        self.tlu=np.empty(0,dtype=[('cnt', '<u4'), ('timestamp', '<u8')])
-        self.ts=np.empty(0,dtype=[('timestamp', '<u8')])
-        self.tj=np.empty(0,dtype=[('timestamp', '<u8'),("col","u1"),("row","u2")])
-        self.buf=np.empty(0,dtype=buf_type)
-        self.data_out=np.empty(n,dtype=data_out_type)
-        self.tmpbuf=np.empty(n,dtype=buf_type)
+    def reset(self,upper=0x80,lower=-0x100,WAIT_CYCLES=20,n=1000000,capacity=1000000):
+        self.sync.reset(WAIT_CYCLES,n=n,capacity=capacity)
+        self.tj=RingBuffer(capacity,[('timestamp', '<u8'),("col","u1"),("row","u2"),("le","u1"),("te","u1")],name="tj")
+        self.buf=RingBuffer(capacity,sync_dtype,name="buf")
+        self.data_out=np.empty(n,dtype=event_dtype)
         
         self.upper=np.uint64(np.abs(upper))
         self.lower=np.uint64(np.abs(lower))
-        self.offset=(WAIT_CYCLES+1) * 16
-        
-    def check_fist_data(self,tlu_e,ts_e):
-        if (tlu_e["timestamp"]-ts_e["timestamp"]) & np.uint64(0x7FFFF) > np.uint64(0x15-16) \
-           and (tlu_e["timestamp"]-ts_e["timestamp"]) & np.uint64(0x7FFFF)< np.uint64(0x150+16*2) :
-                print "tlu and tlu_ts is synchronized"
-                return 0
-        else:
-            print "tlu and tlu_ts is not synchronized, synchronize data manually"
-            return -1
+
+    def get_status(self):
+        status=self.sync.get_status()
+        status['buffers']=status['buffers']+[self.tj.get_status(),self.buf.get_status()]
+        return status
         
-    def run(self, hits):
-        self.tlu=np.append(self.tlu,hits[hits["col"]==255][["timestamp","cnt"]])
-        self.ts=np.append(self.ts,hits[hits["col"]==252][["timestamp"]])
-        self.tj=np.append(self.tj,hits[np.bitwise_and(hits["col"]<112, hits["cnt"]==0)][["timestamp","col","row"]])
-        if len(self.tlu) >0 and len(self.ts) > 0:
-            self.check_fist_data(self.tlu[0],self.ts[0])
-        else:
-            return np.empty(0,dtype=data_out.dtype)
-        err, buf_i, tlu_i, ts_i, self.tmpbuf = _sync_tlu_timestamp(self.tlu,self.ts,self.tmpbuf,self.offset)
+    def run(self, hits, flush=False):
+        self.tj.append(hits[np.bitwise_and(hits["col"]<112, hits["cnt"]==0)])
+        self.buf.append(self.sync.run(hits,flush))
+        events=self._build()
+        if not flush or events.shape[0] < self.data_out.shape[0]:
+            return events
+        events=[events.copy()]
+        while events[-1].shape[0] == self.data_out.shape[0]:  # data_out was full, build the remaining events
+            events.append(self._build().copy())
+        return np.concatenate(events)
+
+    def _build(self):
+        err, i, buf_ii, tj_i, self.data_out = _build_with_tlu(self.buf.data,self.tj.data,self.data_out,self.upper,self.lower,self.data_format)
         if err != 0:
-            print "data might be broken, sync manually",tlu_i,ts_i,i
-            return np.empty(0,dtype=data_out.dtype)
-        self.buf=np.append(self.buf,self.tmpbuf[:buf_i])
-        err, i, buf_ii, tj_i, self.data_out = _build_with_tlu(self.buf,self.tj,self.data_out,self.upper,self.lower,self.data_format)
-        if err != 0 or self.data_format & 0x1 ==0x01:
-            print "error", err, i, buf_ii, tj_i
-        self.tj=self.tj[tj_i:]
-        self.buf=self.buf[buf_ii:]
-        return self.data_out[:i]
+            logger.error("Building events failed: error %d, events %d, used triggers %d and hits %d", err, i, buf_ii, tj_i)
+        elif self.data_format & 0x1 ==0x01:
+            logger.info("Built events %d, used triggers %d and hits %d", i, buf_ii, tj_i)
+        self.tj.consume(tj_i)
+        self.buf.consume(buf_ii)
+        if self.data_format & 0x2 == 0x2:
+            return self.data_out[:i]
+        return self.data_out[:i][[name for name, _ in event_dtype_short]].astype(event_dtype_short)
         
 if  __name__ == "__main__":
     import sys    
@@ -137,8 +125,9 @@ if  __name__ == "__main__":
     lower = -0x100
     upper = 0x80
     
-    builder= BuildEvents(upper,lower,WAIT_CYCLES)
-    data_out=builder.run(hits) 
+    builder= BuildEvents(upper,lower,WAIT_CYCLES,n=hits.shape[0],capacity=hits.shape[0])
+    data_out=builder.run(hits,flush=True)
+    print(builder.get_status())
     bins=np.arange(lower,upper,10)
     
     plt.hist((np.int64(data_out["ts_timestamp"])-np.int64(data_out["token_timestamp"])),bins=bins,histtype="step");
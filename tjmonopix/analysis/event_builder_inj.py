@@ -1,9 +1,12 @@
+from __future__ import print_function
 import time
 import numpy as np
 from numba import njit
 import tables
 import yaml
 
+from tjmonopix.analysis.raw_data_files import open_sidecar
+
 TS_TLU = 251
 TS_INJ = 252
 TS_MON = 253
@@ -28,8 +31,8 @@ def _build_inj(dat, injlist, thlist, phaselist, inj_period, inj_n, mode, buf, sc
     while dat_i < len(dat):
         if scan_param_id != dat[dat_i]["index"]:
             if inj_id != len(injlist) - 1 or inj_cnt != inj_n - 1:
-                print ("ERROR: Broken data, wrong ts_inj idx, inj_cnt,inj_n-1,inj_id,len(injlist)-1"),
-                print (dat_i, inj_cnt, inj_n - 1, inj_id, len(injlist) - 1)
+                print("ERROR: Broken data, wrong ts_inj idx, inj_cnt,inj_n-1,inj_id,len(injlist)-1")
+                print(dat_i, inj_cnt, inj_n - 1, inj_id, len(injlist) - 1)
             inj_id = -1
             inj_cnt = inj_n - 1
         scan_param_id = dat[dat_i]["index"]
@@ -51,8 +54,8 @@ def _build_inj(dat, injlist, thlist, phaselist, inj_period, inj_n, mode, buf, sc
                 inj_id = inj_id + 1
             elif (np.int64(ts_inj - pre_inj) >> 4) != inj_period:
                 # Otherwise, there was a previous injection. Check if timestamp makes sense
-                print ("ERROR: wrong inj_period: ts_inj-pre_inj,inj_period,inj_cnt,inj_id"),
-                print (np.int64(ts_inj - pre_inj) >> 4, inj_period, inj_cnt, inj_id)
+                print("ERROR: wrong inj_period: ts_inj-pre_inj,inj_period,inj_cnt,inj_id")
+                print(np.int64(ts_inj - pre_inj) >> 4, inj_period, inj_cnt, inj_id)
                 err = err + 1
                 if (mode & 0x2) == 2:
                     inj_cnt = 0
@@ -105,7 +108,7 @@ buf_type = [  # ("event_number","<i8"),
 ]
 
 
-def build_inj_h5(fhit, fraw, fout, n=500000, debug=0x2):
+def build_inj_h5(fhit, fraw, fout, n=500000, debug=0x2, mmap=False):
     buf = np.empty(n, dtype=buf_type)
     with tables.open_file(fraw) as f:
         status = yaml.safe_load(f.root.meta_data.attrs.status)
@@ -126,18 +129,21 @@ def build_inj_h5(fhit, fraw, fout, n=500000, debug=0x2):
         description = np.zeros((1,), dtype=buf_type).dtype
         hit_table = f_o.create_table(f_o.root, name="Hits", description=description, title='hit_data')
         with tables.open_file(fhit) as f:
-            end = len(f.root.Hits)
+            hits = open_sidecar(fhit, 'Hits') if mmap else None  # file_Hits.npy of raw_data_files.create_sidecar
+            if hits is None:
+                hits = f.root.Hits
+            end = len(hits)
             start = 0
             t0 = time.time()
             while start < end:  # # this does not work, need to read with one chunck
                 tmpend = min(end, start + n)
-                dat = f.root.Hits[start:tmpend]
-                print "data (inj_n %d,inj_loop %d): INJ=%d MONO=%d MON=%d" % (
+                dat = hits[start:tmpend]
+                print("data (inj_n %d,inj_loop %d): INJ=%d MONO=%d MON=%d" % (
                     inj_n, len(injlist),
                     len(np.where(dat["col"] == TS_INJ)[0]),
                     len(np.where(dat["col"] < COL_SIZE)[0]),
                     len(np.where(dat["col"] == TS_MON)[0])
-                )
+                ))
                 if end == tmpend:
                     mode = 0 | debug
                 else:
@@ -150,7 +156,7 @@ def build_inj_h5(fhit, fraw, fout, n=500000, debug=0x2):
                 )
                 hit_table.append(hit_dat)
                 hit_table.flush()
-                print "%d %d %.3f%% %.3fs %dhits %derrs" % (start, d_i, 100.0 * (start + d_i) / end, time.time() - t0, len(hit_dat), err)
+                print("%d %d %.3f%% %.3fs %dhits %derrs" % (start, d_i, 100.0 * (start + d_i) / end, time.time() - t0, len(hit_dat), err))
                 start = start + d_i
     return
 
@@ -161,5 +167,5 @@ if __name__ == "__main__":
     fhit = fraw[:-7] + "hit.h5"
     fout = fraw[:-7] + "ts.h5"
     assign_ts(fhit, fraw, fts, n=10000000)
-    print fout
+    print(fout)
 
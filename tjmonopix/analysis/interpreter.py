@@ -1,7 +1,10 @@
 import numpy as np
 import numba
+from numba.np.numpy_support import as_dtype
 from tqdm import tqdm
 
+from tjmonopix.analysis.analysis_utils import assign_scan_ids
+
 class_spec = [
     ('chunk_size', numba.uint32),
     ('tj_data_flag', numba.uint8),
@@ -21,10 +24,51 @@ class_spec = [
     ('le', numba.uint8),
     ('te', numba.uint8),
     ('noise', numba.uint8),
-    ('meta_idx', numba.uint32),
-    ('raw_idx', numba.uint32)
+    ('meta_idx', numba.int64),
+    ('raw_idx', numba.int64)  # 64 bit like the MetaTable indices, no overflow for long runs
 ]
 
+# Complete state of a RawDataInterpreter as numpy record
+state_dtype = np.dtype([(name, as_dtype(numba_type)) for name, numba_type in class_spec])
+
+
+def get_state(data_interpreter):
+    ''' Return the state of a RawDataInterpreter as a numpy record
+    '''
+    state = np.zeros(shape=1, dtype=state_dtype)[0]
+    for name in state_dtype.names:
+        state[name] = getattr(data_interpreter, name)
+    return state
+
+
+def set_state(data_interpreter, state):
+    ''' Set the state of a RawDataInterpreter from a numpy record (see get_state)
+    '''
+    for name in state_dtype.names:
+        setattr(data_interpreter, name, state[name].item())
+
+
+def is_equivalent_state(state, other_state):
+    ''' Check if two interpreter states lead to the same hits for any following raw data
+
+        Only flags and the data of blocks that are not complete yet are compared. Counters and
+        the data of the last complete blocks do not influence the following hits.
+    '''
+    if state['tj_data_flag'] != other_state['tj_data_flag']:
+        return False
+    if state['tj_data_flag'] >= 1 and any(state[name] != other_state[name] for name in ('col', 'row', 'le', 'te', 'noise')):
+        return False
+    if state['tj_data_flag'] >= 2 and state['tj_timestamp'] != other_state['tj_timestamp']:
+        return False
+    for name in ('hitor', 'ext', 'inj', 'tlu'):
+        if state[name + '_timestamp_flag'] != other_state[name + '_timestamp_flag']:
+            return False
+        if state[name + '_timestamp_flag'] >= 1 and state[name + '_timestamp'] != other_state[name + '_timestamp']:
+            return False
+    if state['hitor_timestamp_flag'] >= 1 and state['hitor_charge'] != other_state['hitor_charge']:
+        return False
+    return True
+
 
 @numba.njit
 def is_tjmono_data0(word):
@@ -190,16 +234,15 @@ class Interpreter(object):
         self.reset()
 
     def interpret_data(self, raw_data, meta_data, chunk_size=1000000):
-        hit_dtype = [('col', 'u1'), ('row', '<u2'), ('le', 'u1'), ('te', 'u1'), ('cnt', '<u4'), ('timestamp', '<i8'), ('scan_param_id', '<u4')]
+        hit_dtype = [('col', 'u1'), ('row', '<u2'), ('le', 'u1'), ('te', 'u1'), ('cnt', '<u4'), ('timestamp', '<i8'), ('scan_param_id', '<i8')]
 
         pbar = tqdm(total=len(raw_data))
         start = 0
         data_interpreter = RawDataInterpreter()
+        hit_buffer = np.zeros(shape=chunk_size, dtype=hit_dtype)  # Reused for every chunk, at most one hit per data word
         while start < len(raw_data):
             tmpend = start + chunk_size
 
-            hit_buffer = np.zeros(shape=chunk_size, dtype=hit_dtype)
-
             hit_data = data_interpreter.interpret(raw_data[start:tmpend], meta_data, hit_buffer)
 
             start = tmpend
@@ -209,6 +252,45 @@ class Interpreter(object):
         return hit_data, data_interpreter.get_error_count()
 
 
+class StreamingInterpreter(object):
+    ''' Interpret raw data chunk by chunk while it is recorded
+
+        The state of the RawDataInterpreter (partially received multi-word data) is kept between
+        the chunks, thus the hits are the same as if the whole raw data was interpreted at once.
+        All hits of a chunk get the scan_param_id of that chunk.
+    '''
+    hit_dtype = [('col', 'u1'), ('row', '<u2'), ('le', 'u1'), ('te', 'u1'), ('cnt', '<u4'), ('timestamp', '<i8'), ('scan_param_id', '<i8')]
+    meta_dtype = [('index_start', '<u8'), ('index_stop', '<u8'), ('data_length', '<u4'), ('timestamp_start', '<f8'),
+                  ('timestamp_stop', '<f8'), ('scan_param_id', '<u2'), ('error', '<u4')]
+
+    def __init__(self):
+        self.data_interpreter = RawDataInterpreter()
+        self._hit_buffer = np.zeros(shape=0, dtype=self.hit_dtype)
+        self._meta_data = np.zeros(shape=1, dtype=self.meta_dtype)
+        self.n_words = 0
+        self.n_hits = 0
+
+    def interpret(self, raw_data, scan_param_id=0):
+        ''' Interpret one chunk of raw data and return the hits (valid until the next call)
+        '''
+        if self._hit_buffer.shape[0] < raw_data.shape[0]:  # At most one hit per data word
+            self._hit_buffer = np.zeros(shape=max(raw_data.shape[0], 2 * self._hit_buffer.shape[0]), dtype=self.hit_dtype)
+
+        # Meta data of this chunk only, in terms of the internal raw data index of the interpreter
+        self._meta_data[0]['index_start'] = self.data_interpreter.raw_idx
+        self._meta_data[0]['index_stop'] = self.data_interpreter.raw_idx + raw_data.shape[0]
+        self._meta_data[0]['scan_param_id'] = scan_param_id
+        self.data_interpreter.meta_idx = 0
+
+        hit_data = self.data_interpreter.interpret(raw_data, self._meta_data, self._hit_buffer)
+        self.n_words += raw_data.shape[0]
+        self.n_hits += hit_data.shape[0]
+        return hit_data
+
+    def get_error_count(self):
+        return self.data_interpreter.get_error_count()
+
+
 @numba.experimental.jitclass(class_spec)
 class RawDataInterpreter(object):
     def __init__(self):
@@ -260,7 +342,7 @@ class RawDataInterpreter(object):
         meta_data : np.array
             The array with meta information (scan_param_id, data length, ...)
         hit_data : np.recarray(dtype=[("col", "<u1"), ("row", "<u2"), ("le", "<u1"), ("te", "<u1"), ("cnt", "<u4"),
-                                      ("timestamp", "<i8"), ("scan_param_id", "<u4")])
+                                      ("timestamp", "<i8"), ("scan_param_id", "<i8")])
             An array prepared to be filled with interpreted data
         """
 
@@ -541,12 +623,6 @@ class RawDataInterpreter(object):
         # Trim hit_data buffer to interpreted data hits
         hit_data = hit_data[:hit_index]
 
-        # Find correct scan_param_id in meta data and attach to hit
-        for scan_idx, param_id in enumerate(hit_data["scan_param_id"]):
-            while self.meta_idx < len(meta_data):
-                if param_id >= meta_data[self.meta_idx]['index_start'] and param_id < meta_data[self.meta_idx]['index_stop']:
-                    hit_data[scan_idx]['scan_param_id'] = meta_data[self.meta_idx]['scan_param_id']
-                    break
-                elif param_id >= meta_data[self.meta_idx]['index_stop']:
-                    self.meta_idx += 1
+        # Find correct scan_param_id in meta data (ordered by index_start) and attach to hit (hits in gaps are not flagged here, see Analysis)
+        _, _, self.meta_idx = assign_scan_ids(hit_data, meta_data, self.meta_idx)
         return hit_data
@@ -1,610 +1,290 @@
+from __future__ import print_function
 import sys,time,os
 import numpy as np
 import matplotlib.pyplot as plt
+import numba
 from numba import njit
+from numba.np.numpy_support import as_dtype
 import tables
 
+from tjmonopix.analysis.analysis_utils import assign_scan_ids, get_scan_id_index, SCAN_ID_GAP, SCAN_ID_UNSORTED
+from tjmonopix.analysis.raw_data_files import open_raw_data_file
+
 hit_idx_dtype=np.dtype([("col","<u1"),("row","<u1"),("le","<u1"),("te","<u1"),("cnt","<u4"),
-                    ("timestamp","<u8"),("scan_param_id","<u4")])
+                    ("timestamp","<u8"),("scan_param_id","<i8")])
                     
+# Timestamp modules: 0 TIMESTMP (0x41-0x43), 1 TIMESTMP160 INJ (0x51-0x53), 2 TIMESTMP640 MON (0x61-0x63),
+# 3 TIMESTMP640 MON, 2nd timestamp (0x65-0x67), 4 TIMESTMP160 TLU (0x71-0x73)
+N_TS = 5
+TS_HIT_COL = np.array([0xFE, 0xFC, 0xFD, 0xFD, 0xFB], dtype=np.uint8)
+TS_HIT_ROW = np.array([0, 0, 0, 1, 0], dtype=np.uint8)
+TS_ERR_COL = np.array([0xEE, 0xEC, 0xED, 0xED, 0xEB], dtype=np.uint8)
+TS_ERR_ROW = np.array([0, 0, 0, 4, 0], dtype=np.uint8)
+TS_UPPER_MASK = np.array([0xFFFF, 0xFFFF, 0xFF, 0xFF, 0xFFFF], dtype=np.uint64)  # Data bits of the first word
+
+TJ_MASK_LOWER = np.uint64(0x00000000FFFFFFF0)
+TJ_MASK_UPPER = np.uint64(0x00FFFFFF00000000)
+TS_MASK_DAT = np.uint64(0x0000000000FFFFFF)
+TS_MASK1 = np.uint64(0xFFFFFFFFFF000000)
+TS_MASK2 = np.uint64(0xFFFF000000FFFFFF)
+TS_MASK3 = np.uint64(0x0000FFFFFFFFFFFF)
+
+class_spec = [
+    ('debug', numba.uint32),
+    ('raw_idx', numba.int64),
+    ('error_cnt', numba.int64),
+    ('col', numba.uint8),
+    ('row', numba.uint8),
+    ('le', numba.uint8),
+    ('te', numba.uint8),
+    ('noise', numba.uint8),
+    ('rx_flg', numba.uint8),
+    ('timestamp', numba.uint64),
+    ('ts_timestamp', numba.uint64[:]),
+    ('ts_pre', numba.uint64[:]),
+    ('ts_flg', numba.uint8[:]),
+    ('ts_cnt', numba.uint32[:])
+]
+
+# Complete state of a RawIdxInterpreter as numpy record
+state_dtype = np.dtype([(name, as_dtype(numba_type.dtype), (N_TS, )) if isinstance(numba_type, numba.types.Array) else
+                        (name, as_dtype(numba_type)) for name, numba_type in class_spec])
+
+
+def get_state(data_interpreter):
+    ''' Return the state of a RawIdxInterpreter as a numpy record
+    '''
+    state = np.zeros(shape=1, dtype=state_dtype)[0]
+    for name in state_dtype.names:
+        state[name] = getattr(data_interpreter, name)
+    return state
+
+
+def set_state(data_interpreter, state):
+    ''' Set the state of a RawIdxInterpreter from a numpy record (see get_state)
+    '''
+    for name in state_dtype.names:
+        if state_dtype[name].shape:
+            getattr(data_interpreter, name)[:] = state[name]
+        else:
+            setattr(data_interpreter, name, state[name].item())
+
+
 @njit
-def _interpret_idx(raw,buf,start,col,row,le,te,noise,timestamp,rx_flg,
-               ts_timestamp,ts_pre,ts_flg,ts_cnt,
-               ts2_timestamp,ts2_pre,ts2_flg,ts2_cnt,
-               ts2t_timestamp,ts2t_flg,ts2t_cnt,
-               ts3_timestamp,ts3_pre,ts3_flg,ts3_cnt,
-               ts4_timestamp,ts4_pre,ts4_flg,ts4_cnt,debug):
-    TJ_MASK_LOWER = np.uint64(0x00000000FFFFFFF0)
-    TJ_MASK_UPPER = np.uint64(0x00FFFFFF00000000)
-
-    TS_MASK_DAT           =0x0000000000FFFFFF
-    TS_MASK1    =np.uint64(0xFFFFFFFFFF000000)
-    TS_MASK2    =np.uint64(0xFFFF000000FFFFFF)
-    TS_MASK3    =np.uint64(0x0000FFFFFFFFFFFF)
-
-    TS_MASK_TOT = np.uint64(0x0000000000FFFF00)
-    TS_DIV_MASK_DAT = np.uint64(0x00000000000000FF)
-    err=0
-    buf_i=0
-    for r_i,r in enumerate(raw):
-        ########################
-        ### MONOPIX_RX
-        ########################
-        if (r & 0xF0000000 == 0x30000000):
-            pass #TODO get count
-        elif (r & 0xF0000000 == 0x00000000):
-            col = 2 * (r & 0x3f) + (((r & 0x7FC0) >> 6) // 256)
-            row = ((r & 0x7FC0) >> 6) % 256
-            te = (r & 0x1F8000) >> 15
-            le = (r & 0x7E00000) >> 21
-            noise = (r & 0x8000000) >> 27
-           #if debug & 0x4 ==0x4:
-               #print r_i,hex(r),rx_flg,"ts=",hex(timestamp),col,row,noise
-
-            if rx_flg==0x0:
-              rx_flg=0x1
-            else:
-               err=err+1
-               buf[buf_i]["row"]=0xE1
-               buf[buf_i]["col"]=0
-               buf[buf_i]["le"]=rx_flg
-               buf[buf_i]["te"]=0
-               buf[buf_i]["timestamp"]= 0
-               buf[buf_i]["cnt"]=r
-               buf[buf_i]["scan_param_id"]=r_i+start
-               buf_i=buf_i+1
-               rx_flg=0
-           
-        elif (r & 0xF0000000 == 0x10000000):
-            timestamp = (timestamp & TJ_MASK_UPPER) | (
-                np.uint64(r)<<np.uint64(4) & TJ_MASK_LOWER)
-           #if debug & 0x4 ==0x4:
-               #print r_i,hex(r),rx_flg,"ts=",hex(timestamp),le,te
-               #pass
-               
-            if rx_flg==0x1:
-              rx_flg=0x2
-            else:
-               err=err+1
-               buf[buf_i]["row"]=0xE1
-               buf[buf_i]["col"]=1
-               buf[buf_i]["le"]=rx_flg
-               buf[buf_i]["te"]=0
-               buf[buf_i]["timestamp"]= 0
-               buf[buf_i]["cnt"]=r
-               buf[buf_i]["scan_param_id"]=r_i+start
-               buf_i=buf_i+1
-               rx_flg=0
-
-        elif (r & 0xF0000000 == 0x20000000):
-            timestamp = (timestamp & TJ_MASK_LOWER) | (
-                (np.uint64(r) << np.uint64(32)) & TJ_MASK_UPPER)
-           #if debug & 0x4 ==0x4:
-               #print r_i,hex(r),rx_flg,"ts=",hex(timestamp)
-               
-            if rx_flg == 0x2:
-               buf[buf_i]["row"]=row
-               buf[buf_i]["col"]=col
-               buf[buf_i]["le"]=le
-               buf[buf_i]["te"]=te
-               buf[buf_i]["timestamp"]= timestamp
-               buf[buf_i]["cnt"]=noise
-               buf[buf_i]["scan_param_id"]=r_i+start
-               buf_i=buf_i+1
-               rx_flg=0
-            else:
-               err=err+1
-               buf[buf_i]["row"]=0xE1
-               buf[buf_i]["col"]=2
-               buf[buf_i]["le"]=rx_flg
-               buf[buf_i]["te"]=0
-               buf[buf_i]["timestamp"]= 0
-               buf[buf_i]["cnt"]=r
-               buf[buf_i]["scan_param_id"]=r_i+start
-               buf_i=buf_i+1
-               rx_flg=0
-              
-        ########################
-        ### TIMESTMP
-        ########################
-        elif r & 0xFF000000 == 0x40000000: 
-            pass ## TODO get count
-        elif r & 0xFF000000 == 0x41000000: ## timestamp
-            ts_timestamp = (ts_timestamp & TS_MASK1) | np.uint64(r & TS_MASK_DAT)
-            ts_cnt=ts_cnt+1
-            #if debug & 0x4 ==0x4:
-                #print r_i,hex(r),"timestamp1",hex(ts_timestamp),ts_cnt
-
-            if ts_flg==2:
-               ts_flg=0
-               if debug & 0x1 == 0x1:
-                   ts_inter=(ts_timestamp-ts_pre)& 0xFFFFFFFF
-                   buf[buf_i]["col"]=0xFE
-                   buf[buf_i]["row"]= np.uint8(ts_inter)
-                   buf[buf_i]["le"]=np.uint8(ts_inter>>np.uint64(8))
-                   buf[buf_i]["te"]=np.uint8(ts_inter>>np.uint64(16))
-                   buf[buf_i]["timestamp"]=ts_timestamp
-                   buf[buf_i]["cnt"]=ts_cnt
-                   buf[buf_i]["scan_param_id"]=r_i+start
-                   buf_i=buf_i+1
-            else:
-               if debug & 0x1 == 0x1:
-                   buf[buf_i]["col"]=0xEE
-                   buf[buf_i]["row"]=2
-                   buf[buf_i]["le"]=ts_flg
-                   buf[buf_i]["te"]=0
-                   buf[buf_i]["timestamp"]=0
-                   buf[buf_i]["cnt"]=r
-                   buf[buf_i]["scan_param_id"]=r_i+start
-                   buf_i=buf_i+1
-               err=err+1
-               ts_flg=0
-        elif r & 0xFF000000 == 0x42000000: ## timestamp
-            ts_timestamp=(ts_timestamp & TS_MASK2) + (np.uint64(r & TS_MASK_DAT) << np.uint64(24))
-            #if debug & 0x4 ==0x4:
-                #print r_i,hex(r),"timestamp2",hex(ts_timestamp),
-
-            if ts_flg==0x1:
-              ts_flg=0x2
-            else:
-                if debug & 0x1 == 0x1:
-                   buf[buf_i]["col"]=0xEE
-                   buf[buf_i]["row"]=1
-                   buf[buf_i]["le"]=ts_flg
-                   buf[buf_i]["te"]=0
-                   buf[buf_i]["timestamp"]=0
-                   buf[buf_i]["cnt"]=r
-                   buf[buf_i]["scan_param_id"]=r_i+start
-                   buf_i=buf_i+1
-                ts_flg=0x0
-                err=err+1
-        elif r & 0xFF000000 == 0x43000000: ## timestamp
-            ts_pre=ts_timestamp
-            ts_timestamp=(ts_timestamp & TS_MASK3)+ (np.uint64(r & TS_MASK_DAT) << np.uint64(48))
-            #if debug & 0x4 ==0x4:
-               #print r_i,hex(r),"timestamp3",hex(ts_timestamp),
-
-            if ts_flg==0x0:
-               ts_flg=0x1
-            else:
-               if debug & 0x1 == 0x1:
-                   buf[buf_i]["col"]=0xEE
-                   buf[buf_i]["row"]=0
-                   buf[buf_i]["le"]=ts_flg
-                   buf[buf_i]["te"]=0
-                   buf[buf_i]["timestamp"]=0
-                   buf[buf_i]["cnt"]=r
-                   buf[buf_i]["scan_param_id"]=r_i+start
-                   buf_i=buf_i+1
-               ts_flg=0x0  
-               err=err+1
-               
-        ########################
-        ### TIMESTMP160 INJ
-        ########################
-        elif r & 0xFF000000 == 0x50000000:
-            pass  # TODO get count
-        elif r & 0xFF000000 == 0x51000000:  # timestamp
-            ts3_timestamp = (ts3_timestamp & np.uint64(0xFFFFFFFFFF000000)) | np.uint64( r & TS_MASK_DAT )
-            ts3_cnt = ts3_cnt+1
-            # if debug & 0x4 ==0x4:
-            #print r_i,hex(r),"timestamp1",hex(ts_timestamp),ts_cnt
-
-            if ts3_flg == 2:
-                ts3_flg = 0
-                if debug & 0x1 == 0x1:
-                    buf[buf_i]["col"] = 0xFC
-                    buf[buf_i]["row"] = 0
-                    buf[buf_i]["le"] = 0
-                    buf[buf_i]["te"] = 0
-                    buf[buf_i]["timestamp"] = ts3_timestamp
-                    buf[buf_i]["cnt"] = ts3_cnt
-                    buf[buf_i]["scan_param_id"]=r_i+start
-                    #if debug & 0x80 == 0x80:
-                    #    buf[buf_i]['idx']=r_i
-                    buf_i = buf_i+1
-            else:
-                if debug & 0x1 == 0x1:
-                   buf[buf_i]["col"]=0xEC
-                   buf[buf_i]["row"]=2
-                   buf[buf_i]["le"]=ts3_flg
-                   buf[buf_i]["te"]=0
-                   buf[buf_i]["timestamp"]=0
-                   buf[buf_i]["cnt"]=r
-                   buf[buf_i]["scan_param_id"]=r_i+start
-                   buf_i=buf_i+1
-                ts3_flg = 0 
-                err=err+1
-        elif r & 0xFF000000 == 0x52000000:  # timestamp
-            ts3_timestamp = (ts3_timestamp & np.uint64(0xFFFF000000FFFFFF)) | \
-                (np.uint64(r & TS_MASK_DAT) << np.uint64(24))
-            # if debug & 0x4 ==0x4:
-            #print r_i,hex(r),"timestamp1",hex(ts_timestamp)
-
-            if ts3_flg == 0x1:
-                ts3_flg = 0x2
-            else:
-                if debug & 0x1 == 0x1:
-                   buf[buf_i]["col"]=0xEC
-                   buf[buf_i]["row"]=1
-                   buf[buf_i]["le"]=ts3_flg
-                   buf[buf_i]["te"]=0
-                   buf[buf_i]["timestamp"]=0
-                   buf[buf_i]["cnt"]=r
-                   buf[buf_i]["scan_param_id"]=r_i+start
-                   buf_i=buf_i+1
-                ts3_flg = 0 
-                err=err+1
-        elif r & 0xFF000000 == 0x53000000:  # timestamp
-            ts3_timestamp = (ts3_timestamp & np.uint64(0x0000FFFFFFFFFFFF)) | (np.uint64(r & np.uint64(0x000000000000FFFF)) << np.uint64(48))
-            # if debug & 0x4 ==0x4:
-            #print r_i,hex(r),"ts2_timestamp",hex(ts_timestamp)
-
-            if ts3_flg == 0x0:
-                ts3_flg = 0x1
-            else:
-                if debug & 0x1 == 0x1:
-                   buf[buf_i]["col"]=0xEC
-                   buf[buf_i]["row"]=0
-                   buf[buf_i]["le"]=ts3_flg
-                   buf[buf_i]["te"]=0
-                   buf[buf_i]["timestamp"]=0
-                   buf[buf_i]["cnt"]=r
-                   buf[buf_i]["scan_param_id"]=r_i+start
-                   buf_i=buf_i+1
-                ts3_flg = 0 
-                err=err+1
-
-        ########################
-        ### TIMESTMP640 MON
-        ########################
-        elif r & 0xFF000000 == 0x60000000:
-            pass  # TODO get count
-        elif r & 0xFF000000 == 0x61000000:  # timestamp
-            ts2_timestamp = (ts2_timestamp & np.uint64(0xFFFFFFFFFF000000)) | np.uint64( r & TS_MASK_DAT )
-            ts2_cnt = ts2_cnt+1
-            # if debug & 0x4 ==0x4:
-            #print r_i,hex(r),"timestamp1",hex(ts_timestamp),ts_cnt
-
-            if ts2_flg == 2:
-                ts2_flg = 0
-                if debug & 0x1 == 0x1:
-                    buf[buf_i]["col"] = 0xFD
-                    buf[buf_i]["row"] = 0
-                    buf[buf_i]["le"] = 0
-                    buf[buf_i]["te"] = 0
-                    buf[buf_i]["timestamp"] = ts2_timestamp
-                    buf[buf_i]["cnt"] = ts2_cnt
-                    buf[buf_i]["scan_param_id"]=r_i+start
-                    #if debug & 0x80 == 0x80:
-                    #    buf[buf_i]['idx']=r_i
-                    buf_i = buf_i+1
-            else:
-                if debug & 0x1 == 0x1:
-                   buf[buf_i]["col"]=0xED
-                   buf[buf_i]["row"]=2
-                   buf[buf_i]["le"]=ts2_flg
-                   buf[buf_i]["te"]=0
-                   buf[buf_i]["timestamp"]=0
-                   buf[buf_i]["cnt"]=r
-                   buf[buf_i]["scan_param_id"]=r_i+start
-                   buf_i=buf_i+1
-                ts2_flg = 0   
-                err=err+1 
-        elif r & 0xFF000000 == 0x62000000:  # timestamp
-            ts2_timestamp = (ts2_timestamp & np.uint64(0xFFFF000000FFFFFF)) | \
-                (np.uint64(r & TS_MASK_DAT) << np.uint64(24))
-            # if debug & 0x4 ==0x4:
-            #print r_i,hex(r),"timestamp1",hex(ts_timestamp)
-
-            if ts2_flg == 0x1:
-                ts2_flg = 0x2
-            else:
-                if debug & 0x1 == 0x1:
-                   buf[buf_i]["col"]=0xED
-                   buf[buf_i]["row"]=1
-                   buf[buf_i]["le"]=ts2_flg
-                   buf[buf_i]["te"]=0
-                   buf[buf_i]["timestamp"]=0
-                   buf[buf_i]["cnt"]=r
-                   buf[buf_i]["scan_param_id"]=r_i+start
-                   buf_i=buf_i+1
-                ts2_flg = 0 
-                err=err+1   
-        elif r & 0xFF000000 == 0x63000000:  # timestamp
-            ts2_timestamp = (ts2_timestamp & np.uint64(0x0000FFFFFFFFFFFF)) | \
-                (np.uint64(r & TS_DIV_MASK_DAT) << np.uint64(48))
-            ts2_tot = (np.uint64(r & TS_MASK_TOT) >> np.uint64(8))
-            # if debug & 0x4 ==0x4:
-            #print r_i,hex(r),"ts2_timestamp",hex(ts_timestamp)
-
-            if ts2_flg == 0x0:
-                ts2_flg = 0x1
-            else:
-                if debug & 0x1 == 0x1:
-                   buf[buf_i]["col"]=0xED
-                   buf[buf_i]["row"]=0
-                   buf[buf_i]["le"]=ts2_flg
-                   buf[buf_i]["te"]=0
-                   buf[buf_i]["timestamp"]=0
-                   buf[buf_i]["cnt"]=r
-                   buf[buf_i]["scan_param_id"]=r_i+start
-                   buf_i=buf_i+1
-                ts2_flg = 0  
-                err=err+1
-        elif r & 0xFF000000 == 0x65000000:  # timestamp
-            ts2t_timestamp = (ts2t_timestamp & np.uint64(0xFFFFFFFFFF000000)) | np.uint64( r & TS_MASK_DAT )
-            ts2t_cnt = ts2t_cnt+1
-            # if debug & 0x4 ==0x4:
-            #print r_i,hex(r),"timestamp1",hex(ts_timestamp),ts_cnt
-
-            if ts2t_flg == 2:
-                ts2t_flg = 0
-                if debug & 0x1 == 0x1:
-                    buf[buf_i]["col"] = 0xFD
-                    buf[buf_i]["row"] = 1
-                    buf[buf_i]["le"] = 0
-                    buf[buf_i]["te"] = 0
-                    buf[buf_i]["timestamp"] = ts2t_timestamp
-                    buf[buf_i]["cnt"] = ts2t_cnt
-                    buf[buf_i]["scan_param_id"]=r_i+start
-                    #if debug & 0x80 == 0x80:
-                    #    buf[buf_i]['idx']=r_i
-                    buf_i = buf_i+1
-            else:
-                if debug & 0x1 == 0x1:
-                   buf[buf_i]["col"]=0xED
-                   buf[buf_i]["row"]=2+4
-                   buf[buf_i]["le"]=ts2t_flg
-                   buf[buf_i]["te"]=0
-                   buf[buf_i]["timestamp"]=0
-                   buf[buf_i]["cnt"]=r
-                   buf[buf_i]["scan_param_id"]=r_i+start
-                   buf_i=buf_i+1
-                ts2t_flg = 0   
-                err=err+1 
-        elif r & 0xFF000000 == 0x66000000:  # timestamp
-            ts2t_timestamp = (ts2t_timestamp & np.uint64(0xFFFF000000FFFFFF)) | \
-                (np.uint64(r & TS_MASK_DAT) << np.uint64(24))
-            # if debug & 0x4 ==0x4:
-            #print r_i,hex(r),"timestamp1",hex(ts_timestamp)
-
-            if ts2t_flg == 0x1:
-                ts2t_flg = 0x2
-            else:
-                if debug & 0x1 == 0x1:
-                   buf[buf_i]["col"]=0xED
-                   buf[buf_i]["row"]=1+4
-                   buf[buf_i]["le"]=ts2t_flg
-                   buf[buf_i]["te"]=0
-                   buf[buf_i]["timestamp"]=0
-                   buf[buf_i]["cnt"]=r
-                   buf[buf_i]["scan_param_id"]=r_i+start
-                   buf_i=buf_i+1
-                ts2t_flg = 0 
-                err=err+1   
-        elif r & 0xFF000000 == 0x67000000:  # timestamp
-            ts2t_timestamp = (ts2t_timestamp & np.uint64(0x0000FFFFFFFFFFFF)) | \
-                (np.uint64(r & TS_DIV_MASK_DAT) << np.uint64(48))
-            if ts2t_flg == 0x0:
-                ts2t_flg = 0x1
-            else:
-                if debug & 0x1 == 0x1:
-                   buf[buf_i]["col"]=0xED
-                   buf[buf_i]["row"]=0+4
-                   buf[buf_i]["le"]=ts2t_flg
-                   buf[buf_i]["te"]=0
-                   buf[buf_i]["timestamp"]=0
-                   buf[buf_i]["cnt"]=r
-                   buf[buf_i]["scan_param_id"]=r_i+start
-                   buf_i=buf_i+1
-                ts2t_flg = 0  
-                err=err+1
-   
-        ########################
-        ### TIMESTMP160 TLU
-        ########################
-        elif r & 0xFF000000 == 0x70000000:
-            pass  # TODO get count
-        elif r & 0xFF000000 == 0x71000000:  # timestamp
-            ts4_timestamp = (ts4_timestamp & np.uint64(0xFFFFFFFFFF000000)) | np.uint64( r & TS_MASK_DAT )
-            ts4_cnt = ts4_cnt+1
-            # if debug & 0x4 ==0x4:
-            #print r_i,hex(r),"timestamp1",hex(ts_timestamp),ts_cnt
-
-            if ts4_flg == 2:
-                ts4_flg = 0
-                if debug & 0x1 == 0x1:
-                    buf[buf_i]["col"] = 0xFB
-                    buf[buf_i]["row"] = 0
-                    buf[buf_i]["le"] = 0
-                    buf[buf_i]["te"] = 0
-                    buf[buf_i]["timestamp"] = ts4_timestamp
-                    buf[buf_i]["cnt"] = ts4_cnt
-                    buf[buf_i]["scan_param_id"]=r_i+start
-                    #if debug & 0x80 == 0x80:
-                    #    buf[buf_i]['idx']=r_i
-                    buf_i = buf_i+1
-            else:
-                if debug & 0x1 == 0x1:
-                   buf[buf_i]["col"]=0xEB
-                   buf[buf_i]["row"]=2
-                   buf[buf_i]["le"]=ts4_flg
-                   buf[buf_i]["te"]=0
-                   buf[buf_i]["timestamp"]=0
-                   buf[buf_i]["cnt"]=r
-                   buf[buf_i]["scan_param_id"]=r_i+start
-                   buf_i=buf_i+1
-                ts4_flg = 0  
-                err=err+1
-        elif r & 0xFF000000 == 0x72000000:  # timestamp
-            ts4_timestamp = (ts4_timestamp & np.uint64(0xFFFF000000FFFFFF)) | \
-                (np.uint64(r & TS_MASK_DAT) << np.uint64(24))
-            # if debug & 0x4 ==0x4:
-            #print r_i,hex(r),"timestamp1",hex(ts_timestamp)
-
-            if ts4_flg == 0x1:
-                ts4_flg = 0x2
-            else:
-                if debug & 0x1 == 0x1:
-                   buf[buf_i]["col"]=0xEB
-                   buf[buf_i]["row"]=1
-                   buf[buf_i]["le"]=ts4_flg
-                   buf[buf_i]["te"]=0
-                   buf[buf_i]["timestamp"]=0
-                   buf[buf_i]["cnt"]=r
-                   buf[buf_i]["scan_param_id"]=r_i+start
-                   buf_i=buf_i+1
-                ts4_flg = 0 
-                err=err+1 
-        elif r & 0xFF000000 == 0x73000000:  # timestamp
-            ts4_timestamp = (ts4_timestamp & np.uint64(0x0000FFFFFFFFFFFF)) | (np.uint64(r & np.uint64(0x000000000000FFFF)) << np.uint64(48))
-            # if debug & 0x4 ==0x4:
-            #print r_i,hex(r),"ts2_timestamp",hex(ts_timestamp)
-
-            if ts4_flg == 0x0:
-                ts4_flg = 0x1
-            else:
-                if debug & 0x1 == 0x1:
-                   buf[buf_i]["col"]=0xEB
-                   buf[buf_i]["row"]=0
-                   buf[buf_i]["le"]=ts4_flg
-                   buf[buf_i]["te"]=0
-                   buf[buf_i]["timestamp"]=0
-                   buf[buf_i]["cnt"]=r
-                   buf[buf_i]["scan_param_id"]=r_i+start
-                   buf_i=buf_i+1
-                ts4_flg = 0 
-                err=err+1                         
-
-        ########################
-        ### TLU
-        ########################
-        elif (r & 0x80000000 == 0x80000000):
-            tlu = r & 0xFFFF
-            tlu_org =(r>>12) & 0x7FFF0  #16-4(160MHz)
-            if debug & 0x20 ==0x00:
-                tlu_timestamp= ts_pre & np.uint64(0xFFFFFFFFFFF80000) | np.uint64(tlu_org)
-                if tlu_org < (np.int32(ts_pre) & 0x7FFF0):
-                #if np.uint64(tlu_timestamp - ts_pre) & np.uint64(0x8000) == np.uint64(0x8000):
+def _fill_hit(hits, hit_index, col, row, le, te, timestamp, cnt, raw_idx):
+    hits[hit_index]["col"] = col
+    hits[hit_index]["row"] = row
+    hits[hit_index]["le"] = le
+    hits[hit_index]["te"] = te
+    hits[hit_index]["timestamp"] = timestamp
+    hits[hit_index]["cnt"] = cnt
+    hits[hit_index]["scan_param_id"] = raw_idx
+    return hit_index + 1
+
+
+@njit(inline='always')
+def _timestamp_word(module, word, r, hits, hit_index, ts_timestamp, ts_pre, ts_flg, ts_cnt, debug, raw_idx):
+    ''' Word 3, 2, 1 (in this order) of a timestamp block of timestamp module module
+
+        Returns the new state of the module (timestamp, previous timestamp, flag, count), the hit index and the error.
+    '''
+    if word == 3:
+        ts_pre = ts_timestamp
+        ts_timestamp = (ts_timestamp & TS_MASK3) | ((np.uint64(r) & TS_UPPER_MASK[module]) << np.uint64(48))
+        expected_flg = 0
+    elif word == 2:
+        ts_timestamp = (ts_timestamp & TS_MASK2) | ((np.uint64(r) & TS_MASK_DAT) << np.uint64(24))
+        expected_flg = 1
+    else:
+        ts_timestamp = (ts_timestamp & TS_MASK1) | (np.uint64(r) & TS_MASK_DAT)
+        ts_cnt += 1
+        expected_flg = 2
+
+    if ts_flg != expected_flg:
+        if debug & 0x1 == 0x1:
+            hit_index = _fill_hit(hits, hit_index, TS_ERR_COL[module], TS_ERR_ROW[module] + 3 - word, ts_flg, 0, 0, r, raw_idx)
+        return ts_timestamp, ts_pre, 0, ts_cnt, hit_index, 1
+    if word > 1:
+        return ts_timestamp, ts_pre, expected_flg + 1, ts_cnt, hit_index, 0
+    if debug & 0x1 == 0x1:
+        if module == 0:  # Time since the last timestamp
+            ts_inter = (ts_timestamp - ts_pre) & np.uint64(0xFFFFFFFF)
+            hit_index = _fill_hit(hits, hit_index, TS_HIT_COL[0], ts_inter & np.uint64(0xFF), (ts_inter >> np.uint64(8)) & np.uint64(0xFF),
+                                  (ts_inter >> np.uint64(16)) & np.uint64(0xFF), ts_timestamp, ts_cnt, raw_idx)
+        else:
+            hit_index = _fill_hit(hits, hit_index, TS_HIT_COL[module], TS_HIT_ROW[module], 0, 0, ts_timestamp, ts_cnt, raw_idx)
+    return ts_timestamp, ts_pre, 0, ts_cnt, hit_index, 0
+
+
+@numba.experimental.jitclass(class_spec)
+class RawIdxInterpreter(object):
+    ''' Streaming interpreter of the raw data to hits of hit_idx_dtype, scan_param_id is the raw data index
+
+        debug:
+            0x1 write timestamps and timestamp errors, 0x2 write TLU words,
+            0x20 TLU timestamp based on TIMESTMP640 MON (default TIMESTMP)
+    '''
+    def __init__(self, debug):
+        self.debug = debug
+        self.ts_timestamp = np.zeros(N_TS, dtype=np.uint64)
+        self.ts_pre = np.zeros(N_TS, dtype=np.uint64)
+        self.ts_flg = np.zeros(N_TS, dtype=np.uint8)
+        self.ts_cnt = np.zeros(N_TS, dtype=np.uint32)
+        self.reset()
+
+    def reset(self):
+        """ Reset the complete state, the raw data index starts at 0
+        """
+        self.raw_idx = 0
+        self.error_cnt = 0
+        self.col = 0xFF
+        self.row = 0xFF
+        self.le = 0xFF
+        self.te = 0xFF
+        self.noise = 0
+        self.rx_flg = 0
+        self.timestamp = 0
+        self.ts_timestamp[:] = 0
+        self.ts_pre[:] = 0
+        self.ts_flg[:] = 0
+        self.ts_cnt[:] = 0
+
+    def interpret(self, raw_data, hits, hit_index):
+        """ Interpret raw_data and write the hits into hits, starting at hit_index
+
+            Every raw data word gives at most one hit. The interpretation stops if hits is full,
+            the state is kept to continue with the remaining words at any later call.
+
+            Returns the index after the last hit and the number of interpreted raw data words.
+        """
+        # State in local variables during the loop, stored at the end (timestamp modules as scalars, array access is ~4x slower)
+        debug, raw_idx, error_cnt = self.debug, self.raw_idx, self.error_cnt
+        col, row, le, te, noise, rx_flg, timestamp = self.col, self.row, self.le, self.te, self.noise, self.rx_flg, self.timestamp
+        ts_timestamp, ts_pre, ts_flg, ts_cnt = self.ts_timestamp, self.ts_pre, self.ts_flg, self.ts_cnt
+        ts0_timestamp, ts0_pre, ts0_flg, ts0_cnt = ts_timestamp[0], ts_pre[0], ts_flg[0], ts_cnt[0]
+        ts1_timestamp, ts1_pre, ts1_flg, ts1_cnt = ts_timestamp[1], ts_pre[1], ts_flg[1], ts_cnt[1]
+        ts2_timestamp, ts2_pre, ts2_flg, ts2_cnt = ts_timestamp[2], ts_pre[2], ts_flg[2], ts_cnt[2]
+        ts3_timestamp, ts3_pre, ts3_flg, ts3_cnt = ts_timestamp[3], ts_pre[3], ts_flg[3], ts_cnt[3]
+        ts4_timestamp, ts4_pre, ts4_flg, ts4_cnt = ts_timestamp[4], ts_pre[4], ts_flg[4], ts_cnt[4]
+        n_words = 0
+        for r in raw_data:
+            if hit_index >= hits.shape[0]:
+                break
+            header = r >> 24
+            ########################
+            # MONOPIX_RX
+            ########################
+            if r & 0xF0000000 == 0x30000000:
+                pass  # Token counter word, not used (the hit is complete with the 3rd word)
+            elif r & 0xF0000000 == 0x00000000:
+                col = np.uint8(2 * (r & 0x3f) + (((r & 0x7FC0) >> 6) // 256))
+                row = np.uint8(((r & 0x7FC0) >> 6) % 256)
+                te = np.uint8((r & 0x1F8000) >> 15)
+                le = np.uint8((r & 0x7E00000) >> 21)
+                noise = np.uint8((r & 0x8000000) >> 27)
+                if rx_flg == 0x0:
+                    rx_flg = 0x1
+                else:
+                    error_cnt += 1
+                    hit_index = _fill_hit(hits, hit_index, 0, 0xE1, rx_flg, 0, 0, r, raw_idx)
+                    rx_flg = 0
+            elif r & 0xF0000000 == 0x10000000:
+                timestamp = (timestamp & TJ_MASK_UPPER) | ((np.uint64(r) << np.uint64(4)) & TJ_MASK_LOWER)
+                if rx_flg == 0x1:
+                    rx_flg = 0x2
+                else:
+                    error_cnt += 1
+                    hit_index = _fill_hit(hits, hit_index, 1, 0xE1, rx_flg, 0, 0, r, raw_idx)
+                    rx_flg = 0
+            elif r & 0xF0000000 == 0x20000000:
+                timestamp = (timestamp & TJ_MASK_LOWER) | ((np.uint64(r) << np.uint64(32)) & TJ_MASK_UPPER)
+                if rx_flg == 0x2:
+                    hit_index = _fill_hit(hits, hit_index, col, row, le, te, timestamp, noise, raw_idx)
+                else:
+                    error_cnt += 1
+                    hit_index = _fill_hit(hits, hit_index, 2, 0xE1, rx_flg, 0, 0, r, raw_idx)
+                rx_flg = 0
+            ########################
+            # TIMESTMP modules
+            ########################
+            elif header == 0x40 or header == 0x50 or header == 0x60 or header == 0x70:
+                pass  # Debug word of the timestamp modules, not used
+            elif header >= 0x41 and header <= 0x43:
+                ts0_timestamp, ts0_pre, ts0_flg, ts0_cnt, hit_index, error = _timestamp_word(
+                    0, header & 0xF, r, hits, hit_index, ts0_timestamp, ts0_pre, ts0_flg, ts0_cnt, debug, raw_idx)
+                error_cnt += error
+            elif header >= 0x51 and header <= 0x53:
+                ts1_timestamp, ts1_pre, ts1_flg, ts1_cnt, hit_index, error = _timestamp_word(
+                    1, header & 0xF, r, hits, hit_index, ts1_timestamp, ts1_pre, ts1_flg, ts1_cnt, debug, raw_idx)
+                error_cnt += error
+            elif header >= 0x61 and header <= 0x63:
+                ts2_timestamp, ts2_pre, ts2_flg, ts2_cnt, hit_index, error = _timestamp_word(
+                    2, header & 0xF, r, hits, hit_index, ts2_timestamp, ts2_pre, ts2_flg, ts2_cnt, debug, raw_idx)
+                error_cnt += error
+            elif header >= 0x65 and header <= 0x67:
+                ts3_timestamp, ts3_pre, ts3_flg, ts3_cnt, hit_index, error = _timestamp_word(
+                    3, (header & 0xF) - 4, r, hits, hit_index, ts3_timestamp, ts3_pre, ts3_flg, ts3_cnt, debug, raw_idx)
+                error_cnt += error
+            elif header >= 0x71 and header <= 0x73:
+                ts4_timestamp, ts4_pre, ts4_flg, ts4_cnt, hit_index, error = _timestamp_word(
+                    4, header & 0xF, r, hits, hit_index, ts4_timestamp, ts4_pre, ts4_flg, ts4_cnt, debug, raw_idx)
+                error_cnt += error
+            ########################
+            # TLU
+            ########################
+            elif r & 0x80000000 == 0x80000000:
+                tlu = r & 0xFFFF
+                tlu_org = (r >> 12) & 0x7FFF0  # 16-4(160MHz)
+                pre = ts2_pre if debug & 0x20 == 0x20 else ts0_pre
+                tlu_timestamp = (pre & np.uint64(0xFFFFFFFFFFF80000)) | np.uint64(tlu_org)
+                if tlu_org < (pre & np.uint64(0x7FFF0)):
                     tlu_timestamp = tlu_timestamp + np.uint64(0x80000)
+                if debug & 0x2 == 0x2:
+                    hit_index = _fill_hit(hits, hit_index, 0xFF, 0xFF, 0xFF, 0xFF, tlu_timestamp, tlu, raw_idx)
             else:
-                tlu_timestamp= ts2_pre & np.uint64(0xFFFFFFFFFFF80000) | np.uint64(tlu_org)
-                if tlu_org < (np.int32(ts2_pre) & 0x7FFF0):
-                    tlu_timestamp = tlu_timestamp + np.uint64(0x80000)
-            #if debug & 0x4 ==0x4:
-                #print r_i,hex(r),"ts=",hex(tlu_timestamp),"tlu",tlu,hex(tlu_tmp),tlu_tmp < trig_tmp
-
-            if debug & 0x2 == 0x2:
-                buf[buf_i]["col"]=0xFF
-                buf[buf_i]["row"]=0xFF
-                buf[buf_i]["le"]= 0xFF 
-                buf[buf_i]["te"]= 0xFF
-                buf[buf_i]["timestamp"]=tlu_timestamp
-                buf[buf_i]["cnt"]=tlu
-                buf[buf_i]["scan_param_id"]=r_i+start
-                buf_i=buf_i+1
-        else:
-            buf[buf_i]["col"]=0xE0
-            buf[buf_i]["row"]=0
-            buf[buf_i]["le"]=0
-            buf[buf_i]["te"]=0
-            buf[buf_i]["timestamp"]=0
-            buf[buf_i]["cnt"]=r
-            buf[buf_i]["scan_param_id"]=r_i+start
-            buf_i=buf_i+1
-            err=err+1   
-    return err,buf[:buf_i],r_i,col,row,le,te,noise,timestamp,rx_flg,\
-                      ts_timestamp,ts_pre,ts_flg,ts_cnt,\
-                      ts2_timestamp,ts2_pre,ts2_flg,ts2_cnt,ts2t_timestamp,ts2t_flg,ts2t_cnt,\
-                      ts3_timestamp,ts3_pre,ts3_flg,ts3_cnt,\
-                      ts4_timestamp,ts4_pre,ts4_flg,ts4_cnt
-
-                      
-@njit
-def _assign_scan_id(dat,meta):
-    m_i=0
-    d_i=0
-    while m_i<len(meta) and d_i< len(dat):
-        if meta[m_i]["index_start"] <= dat[d_i]["scan_param_id"] \
-           and meta[m_i]["index_stop"] > dat[d_i]["scan_param_id"]:
-                dat[d_i]["scan_param_id"]=meta[m_i]["scan_param_id"]
-                d_i=d_i+1
-        elif meta[m_i]["index_stop"] <= dat[d_i]["scan_param_id"]:
-            m_i=m_i+1
-        else: # meta[m_i]["index_start"] > data[d_i]["scan_param_id"]
-            #print "error", m_i,d_i,meta[m_i]["index_start"],dat[d_i]["scan_param_id"]
-            #break
-            return 1,dat,m_i,d_i
-    return 0,dat,m_i, d_i
-                      
-                      
-def interpret_idx_h5(fin,fout,debug=3, n=100000000):
+                hit_index = _fill_hit(hits, hit_index, 0xE0, 0, 0, 0, 0, r, raw_idx)
+                error_cnt += 1
+            raw_idx += 1
+            n_words += 1
+
+        self.raw_idx, self.error_cnt = raw_idx, error_cnt
+        self.col, self.row, self.le, self.te, self.noise, self.rx_flg, self.timestamp = col, row, le, te, noise, rx_flg, timestamp
+        ts_timestamp[0], ts_pre[0], ts_flg[0], ts_cnt[0] = ts0_timestamp, ts0_pre, ts0_flg, ts0_cnt
+        ts_timestamp[1], ts_pre[1], ts_flg[1], ts_cnt[1] = ts1_timestamp, ts1_pre, ts1_flg, ts1_cnt
+        ts_timestamp[2], ts_pre[2], ts_flg[2], ts_cnt[2] = ts2_timestamp, ts2_pre, ts2_flg, ts2_cnt
+        ts_timestamp[3], ts_pre[3], ts_flg[3], ts_cnt[3] = ts3_timestamp, ts3_pre, ts3_flg, ts3_cnt
+        ts_timestamp[4], ts_pre[4], ts_flg[4], ts_cnt[4] = ts4_timestamp, ts4_pre, ts4_flg, ts4_cnt
+        return hit_index, n_words
+
+
+def interpret_idx_h5(fin,fout,debug=3, n=100000000, mmap=False):
+    data_interpreter = RawIdxInterpreter(debug)
     buf=np.empty(n,dtype=hit_idx_dtype)
-    col=0xFF
-    row=0xFF
-    le=0xFF
-    te=0xFF
-    noise=0
-    timestamp=np.uint64(0x0)
-    rx_flg=0
-    
-    ts_timestamp=np.uint64(0x0)
-    ts_pre=ts_timestamp
-    ts_cnt=0x0
-    ts_flg=0
-    
-    ts2_timestamp=np.uint64(0x0)
-    ts2_pre=ts2_timestamp
-    ts2_cnt=0x0
-    ts2_flg=0
-    ts2t_timestamp=np.uint64(0x0)
-    ts2t_cnt=0x0
-    ts2t_flg=0
-    
-    ts3_timestamp=np.uint64(0x0)
-    ts3_pre=ts3_timestamp
-    ts3_cnt=0x0
-    ts3_flg=0
-    
-    ts4_timestamp=np.uint64(0x0)
-    ts4_pre=ts4_timestamp
-    ts4_cnt=0x0
-    ts4_flg=0
-    
     with tables.open_file(fout, "w") as f_o:
         description=np.zeros((1,),dtype=hit_idx_dtype).dtype
         hit_table=f_o.create_table(f_o.root,name="Hits",description=description,title='hit_data')
-        with tables.open_file(fin) as f:
-            meta=f.root.meta_data[:]
+        with open_raw_data_file(fin, mmap=mmap) as f:  # mmap: read the raw data from the sidecar file
+            meta,meta_flags=get_scan_id_index(f.root.meta_data[:])  # sorted once, searched from m_i every chunk
+            if meta_flags & SCAN_ID_UNSORTED:
+                print("meta_data is not ordered by index_start")
+            m_i=0
             end=len(f.root.raw_data)
             start=0
             t0=time.time()
-            hit_total=0
             while start<end:
                 tmpend=min(end,start+n)
                 raw=f.root.raw_data[start:tmpend]
-                (err,hit_dat,r_i,col,row,le,te,noise,timestamp,rx_flg,
-                    ts_timestamp,ts_pre,ts_flg,ts_cnt,
-                    ts2_timestamp,ts2_pre,ts2_flg,ts2_cnt,ts2t_timestamp,ts2t_flg,ts2t_cnt,
-                    ts3_timestamp,ts3_pre,ts3_flg,ts3_cnt,
-                    ts4_timestamp,ts4_pre,ts4_flg,ts4_cnt
-                    ) = _interpret_idx(
-                    raw,buf,start,col,row,le,te,noise,timestamp,rx_flg,
-                    ts_timestamp,ts_pre,ts_flg,ts_cnt,
-                    ts2_timestamp,ts2_pre,ts2_flg,ts2_cnt,ts2t_timestamp,ts2t_flg,ts2t_cnt,
-                    ts3_timestamp,ts3_pre,ts3_flg,ts3_cnt,
-                    ts4_timestamp,ts4_pre,ts4_flg,ts4_cnt,debug)
-                n_hit=len(hit_dat)
-                hit_total=hit_total+n_hit
-                err,hit_dat,m_i,d_i = _assign_scan_id(hit_dat,meta)
-                meta=meta[m_i:]
-                if d_i!=n_hit:
-                    print "assing_scan has error data=%d, assigned=%d"%(n_hit,d_i)
-                print "%d %d %.3f%% %.3fs %dhits %derrs"%(start,r_i,100.0*(start+r_i+1)/end,time.time()-t0,len(hit_dat),err)
+                err=data_interpreter.error_cnt
+                n_hit, n_words = data_interpreter.interpret(raw, buf, 0)  # buf has space for one hit per word
+                err=data_interpreter.error_cnt-err
+                hit_dat=buf[:n_hit]
+                flags,n_gaps,m_i = assign_scan_ids(hit_dat,meta,m_i)
+                if flags & SCAN_ID_GAP:
+                    print("%d hits are in no readout of meta_data, scan_param_id of the preceding readout used"%n_gaps)
+                print("%d %d %.3f%% %.3fs %dhits %derrs"%(start,start+n_words,100.0*(start+n_words)/end,time.time()-t0,len(hit_dat),err))
                 hit_table.append(hit_dat)
                 hit_table.flush()
-                start=start+r_i+1
+                start=start+n_words
 
 def list2img(dat,delete_noise=True):
     if delete_noise==True:
@@ -627,70 +307,45 @@ def without_noise(dat):
     
 
 class InterRawIdx():
-    def __init__(self,chunk=100000000,debug=0):
-        self.reset()
-        self.buf=np.empty(chunk,dtype=hit_idx_dtype)
-        self.n=chunk
-        self.debug=0
-    def reset(self):
-        self.col=0xFF
-        self.row=0xFF
-        self.le=0xFF
-        self.te=0xFF
-        self.noise=0
-        self.timestamp=np.int64(0x0)
-        self.rx_flg=0
-        
-        self.ts_timestamp=np.uint64(0x0)
-        self.ts_pre=self.ts_timestamp
-        self.ts_cnt=0x0
-        self.ts_flg=0
-        
-        self.ts2_timestamp=np.uint64(0x0)
-        self.ts2_pre=self.ts2_timestamp
-        self.ts2_cnt=0x0
-        self.ts2_flg=0
-        self.ts2t_timestamp=np.uint64(0x0)
-        self.ts2t_cnt=0x0
-        self.ts2t_flg=0
-        
-        self.ts3_timestamp=np.uint64(0x0)
-        self.ts3_pre=self.ts3_timestamp
-        self.ts3_cnt=0x0
-        self.ts3_flg=0
-        
-        self.ts4_timestamp=np.uint64(0x0)
-        self.ts4_pre=self.ts4_timestamp
-        self.ts4_cnt=0x0
-        self.ts4_flg=0
+    ''' Interpretation of raw data given in chunks of any size with RawIdxInterpreter
 
-    def run(self,raw,data_format=3):
+        run() continues with the state of the previous call, thus the hits do not depend on the chunk boundaries.
+        The hits are written into an array that grows as needed or into the array given as hits.
+    '''
+    def __init__(self,chunk=100000000,debug=3):
+        self.n=chunk  # Maximum raw data words per call of the interpreter
+        self.debug=debug
+        self.interpreter=RawIdxInterpreter(debug)
+
+    def reset(self):
+        self.interpreter.reset()
+
+    def run(self,raw,data_format=None,hits=None):
+        if data_format is not None:
+            self.interpreter.debug=data_format
+        if hits is not None:
+            n_hits,n_words=self.interpreter.interpret(raw,hits,0)
+            if n_words!=len(raw):
+                raise ValueError("hits has space for %d hits only"%len(hits))
+            return hits[:n_hits]
+        hits=np.empty(min(len(raw),self.n)//4+16,dtype=hit_idx_dtype)  # 4 words per hit
+        n_hits=0
         start=0
-        end=len(raw)
-        ret=np.empty(0,dtype=hit_idx_dtype)
-        while start<end: ##TODO make chunk work
-            tmpend=min(end,start+self.n)
-            ( err,hit_dat,r_i,
-              self.col,self.row,self.le,self.te,self.noise,self.timestamp,self.rx_flg,
-              self.ts_timestamp,self.ts_pre,self.ts_flg,self.ts_cnt,
-              self.ts2_timestamp,self.ts2_pre,self.ts2_flg,self.ts2_cnt,
-              self.ts2t_timestamp,self.ts2t_flg,self.ts2t_cnt,
-              self.ts3_timestamp,self.ts3_pre,self.ts3_flg,self.ts3_cnt,
-              self.ts4_timestamp,self.ts4_pre,self.ts4_flg,self.ts4_cnt
-              ) = _interpret_idx(
-              raw[start:tmpend],self.buf,start,
-              self.col,self.row,self.le,self.te,self.noise,self.timestamp,self.rx_flg,
-              self.ts_timestamp,self.ts_pre,self.ts_flg,self.ts_cnt,
-              self.ts2_timestamp,self.ts2_pre,self.ts2_flg,self.ts2_cnt,
-              self.ts2t_timestamp,self.ts2t_flg,self.ts2t_cnt,
-              self.ts3_timestamp,self.ts3_pre,self.ts3_flg,self.ts3_cnt,
-              self.ts4_timestamp,self.ts4_pre,self.ts4_flg,self.ts4_cnt,data_format)
-            if err!=0:
-               self.reset()
-            ret=np.append(ret,hit_dat)
-            start=start+r_i+1
-        return ret
-        
+        while start<len(raw):
+            if n_hits==len(hits):
+                new_hits=np.empty(2*len(hits),dtype=hit_idx_dtype)
+                new_hits[:n_hits]=hits
+                hits=new_hits
+            n_hits,n_words=self.interpreter.interpret(raw[start:start+self.n],hits,n_hits)
+            start=start+n_words
+        return hits[:n_hits]
+
+    def get_state(self):
+        return get_state(self.interpreter)
+
+    def set_state(self,state):
+        set_state(self.interpreter,state)
+
     def mk_list(self,raw,delete_noise=True):
         dat=self.run(raw)
         if delete_noise==True:
@@ -706,18 +361,18 @@ class InterRawIdx():
         return list2cnt(dat,delete_noise=True)
         
 def raw2list(raw,delete_noise=True):
-    inter=InterRaw()
+    inter=InterRawIdx()
     dat=inter.run(raw)
     if delete_noise==True:
         dat=without_noise(dat)
     return dat
 
 def raw2img(raw,delete_noise=True):
-    inter=InterRaw()
-    return list2img(inter.run(raw),noise=noise)
+    inter=InterRawIdx()
+    return list2img(inter.run(raw),delete_noise=delete_noise)
 
 def raw2cnt(raw,delete_noise=True):
-    inter=InterRaw()
+    inter=InterRawIdx()
     return list2cnt(inter.run(raw),delete_noise=delete_noise)
 
 if __name__ == "__main__":
@@ -728,5 +383,5 @@ if __name__ == "__main__":
     # debug 
     # 
     # 0x20 correct tlu_timestamp based on timestamp2 0x00 based on timestamp
-    print fout
+    print(fout)
                
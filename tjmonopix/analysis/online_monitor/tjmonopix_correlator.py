@@ -103,7 +103,9 @@ class HitCorrelator(Transceiver):
             self.corr_col = np.zeros([self.config['max_n_columns_monopix'],self.config['max_n_columns_fei4']])
             self.corr_row = np.zeros([self.config['max_n_rows_monopix'],self.config['max_n_rows_fei4']])
         
-        self.mono_builder=BuildEvents(upper=0x80,lower=-0x100,WAIT_CYCLES=20,data_format=0x0)
+        # TLU handshake delay of the trigger timestamps (TRIGGER_HANDSHAKE_ACCEPT_WAIT_CYCLES of the tlu)
+        self.wait_cycles = self.config.get('TRIGGER_HANDSHAKE_ACCEPT_WAIT_CYCLES', 20)
+        self.mono_builder=BuildEvents(upper=0x80,lower=-0x100,WAIT_CYCLES=self.wait_cycles,data_format=0x0)
 
     def deserialze_data(self, data):  # According to pyBAR data serialization
         datar, meta = utils.simple_dec(data)
@@ -180,7 +182,7 @@ class HitCorrelator(Transceiver):
             self.mono_buffer = None
             self.mask_col = np.zeros_like(self.mask_col)
             self.mask_row = np.zeros_like(self.mask_row)
-            self.mono_builder.reset()
+            self.mono_builder.reset(WAIT_CYCLES=self.wait_cycles)
             gc.collect()  # garbage collector is called to free unused memory
         
         print "!!!!!!!!!!!!!!!!!",command
@@ -0,0 +1,270 @@
+''' Reader for raw data files that were rotated during the run (raw_data_rotation in the bench config)
+
+    ScanBase writes the first part of a run to run.h5 and the following segments to run_seg001.h5,
+    run_seg002.h5, ... The meta_data indices are continuous over all segments, the first raw data word
+    of a segment is stored in its meta_data attribute raw_data_offset.
+
+    open_raw_data_file gives one logical file with root.raw_data and root.meta_data:
+        - run.h5: the whole run (run.h5 and all its segments)
+        - run_seg002.h5 or run.h5 with all_segments=False: only this segment, e.g. to analyse segments in parallel
+    The meta_data indices are relative to the first word of the view. Files without segments are read as they are.
+
+    With mmap=True the raw data words are read from the sidecar file run.raw instead (uncompressed uint32 words of the
+    whole run, written during the run with raw_data_sidecar in the bench config or later with create_sidecar):
+    slices are np.memmap views without decompression and copy, buffering is left to the page cache of the OS.
+'''
+import logging
+import os
+import re
+
+import numpy as np
+import tables as tb
+
+logger = logging.getLogger('RawDataFile')
+
+SEGMENT_PATTERN = re.compile(r'_seg\d{3,}\.h5$')
+
+
+def get_segment_filename(raw_data_file, segment):
+    ''' File name of the segment of a run, segment 0 is the raw data file itself
+    '''
+    if segment == 0:
+        return raw_data_file
+    return '{:s}_seg{:03d}.h5'.format(raw_data_file[:-3], segment)
+
+
+def get_segment_files(raw_data_file):
+    ''' All files of a run in order, raw_data_file if it is a segment itself
+    '''
+    if SEGMENT_PATTERN.search(raw_data_file) or not os.path.isfile(raw_data_file):
+        return [raw_data_file]
+    directory, filename = os.path.split(raw_data_file)
+    segment_pattern = re.compile(re.escape(filename[:-3]) + r'_seg(\d{3,})\.h5$')
+    segments = []
+    for segment_file in os.listdir(directory or '.'):
+        match = segment_pattern.match(segment_file)
+        if match:
+            segments.append((int(match.group(1)), os.path.join(directory, segment_file)))
+    return [raw_data_file] + [segment_file for _, segment_file in sorted(segments)]
+
+
+def get_raw_data_offset(meta_data_node):
+    ''' Index of the first raw data word of the file in the run (0 if the run was not rotated)
+    '''
+    if 'raw_data_offset' in meta_data_node.attrs._f_list():
+        return int(meta_data_node.attrs.raw_data_offset)
+    return 0
+
+
+def get_sidecar_filename(filename, node='raw_data'):
+    ''' run.raw for the raw data of all segments of the run, file_node.npy for a table of the (interpreted) file
+    '''
+    if node == 'raw_data':
+        return SEGMENT_PATTERN.sub('.h5', filename)[:-3] + '.raw'
+    return '{:s}_{:s}.npy'.format(filename[:-3], node)
+
+
+def create_sidecar(filename, node='raw_data', chunk_size=10000000):
+    ''' Write the uncompressed copy of node (raw_data of the whole run or a table, e.g. Hits) for memory mapped reading
+    '''
+    sidecar_filename = get_sidecar_filename(filename, node)
+    if node == 'raw_data':
+        with open_raw_data_file(filename) as in_file, open(sidecar_filename, 'wb') as out_file:
+            for start in range(0, in_file.root.raw_data.shape[0], chunk_size):
+                in_file.root.raw_data[start:start + chunk_size].astype('<u4').tofile(out_file)
+    else:
+        with tb.open_file(filename) as in_file:
+            table = in_file.get_node(in_file.root, node)
+            out_array = np.lib.format.open_memmap(sidecar_filename, mode='w+', dtype=table.dtype, shape=(table.nrows, ))
+            for start in range(0, table.nrows, chunk_size):
+                out_array[start:start + chunk_size] = table[start:start + chunk_size]
+            out_array.flush()
+            del out_array
+    return sidecar_filename
+
+
+def open_sidecar(filename, node='raw_data', offset=0, n_rows=None):
+    ''' Read-only np.memmap of the sidecar of node, None if it does not exist or does not cover the rows [offset, offset + n_rows)
+    '''
+    sidecar_filename = get_sidecar_filename(filename, node)
+    if not os.path.isfile(sidecar_filename):
+        return None
+    if node == 'raw_data':
+        n_words = os.path.getsize(sidecar_filename) // 4
+        if n_rows is None:
+            n_rows = n_words - offset
+        if offset + n_rows > n_words or n_rows < 0:
+            return None
+        if n_rows == 0:
+            return np.zeros(0, dtype='<u4')
+        return np.memmap(sidecar_filename, dtype='<u4', mode='r', offset=4 * offset, shape=(n_rows, ))
+    array = np.load(sidecar_filename, mmap_mode='r')
+    if n_rows is None:
+        n_rows = array.shape[0] - offset
+    if offset + n_rows > array.shape[0]:
+        return None
+    return array[offset:offset + n_rows]
+
+
+class Attributes(dict):
+    ''' meta_data attributes of all segments, the ones of the first segment (e.g. status at the end of the run) take precedence
+    '''
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def get_attr(self, name):
+        return self[name]
+
+    def _f_list(self):
+        return list(self.keys())
+
+
+class VirtualRawData(object):
+    ''' raw_data arrays of the segments as one array, supports slicing with step 1
+    '''
+
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.starts = np.cumsum([0] + [array.nrows for array in arrays])
+        self.dtype = arrays[0].dtype if arrays else np.dtype(np.uint32)
+
+    @property
+    def nrows(self):
+        return int(self.starts[-1])
+
+    @property
+    def shape(self):
+        return (self.nrows, )
+
+    def __len__(self):
+        return self.nrows
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            key = int(key)
+            if key < 0:
+                key += self.nrows
+            if not 0 <= key < self.nrows:
+                raise IndexError('Index %d out of range' % key)
+            segment = np.searchsorted(self.starts, key, side='right') - 1
+            return self.arrays[segment][key - self.starts[segment]]
+        start, stop, step = key.indices(self.nrows)
+        if step != 1:
+            raise IndexError('Only slices with step 1 are supported')
+        parts = []
+        for segment, array in enumerate(self.arrays):
+            segment_start, segment_stop = max(start, self.starts[segment]), min(stop, self.starts[segment + 1])
+            if segment_start < segment_stop:
+                parts.append(array[segment_start - self.starts[segment]:segment_stop - self.starts[segment]])
+        if len(parts) == 1:
+            return parts[0]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=self.dtype)
+
+
+class VirtualMetaData(object):
+    ''' meta_data tables of the segments in memory, indices relative to the first raw data word of the view
+    '''
+
+    def __init__(self, tables):
+        self.attrs = Attributes()
+        meta_data = []
+        offset = get_raw_data_offset(tables[0]) if tables else 0
+        for table in reversed(tables):
+            self.attrs.update((name, table.attrs[name]) for name in table.attrs._f_list())
+        for table in tables:
+            meta_data.append(table[:])
+            meta_data[-1]['index_start'] -= offset
+            meta_data[-1]['index_stop'] -= offset
+        self.attrs.pop('raw_data_offset', None)
+        self.data = np.concatenate(meta_data) if meta_data else np.zeros(0)
+
+    @property
+    def nrows(self):
+        return self.data.shape[0]
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    def __len__(self):
+        return self.nrows
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def get_attr(self, name):
+        return self.attrs[name]
+
+
+class Root(object):
+    def __init__(self, raw_data, meta_data, first_file):
+        self.raw_data = raw_data
+        self.meta_data = meta_data
+        self._first_file = first_file
+
+    def __contains__(self, name):
+        return name in ('raw_data', 'meta_data') or (name != 'scan_param_index' and name in self._first_file.root)
+
+    def __getattr__(self, name):  # Further nodes (e.g. mask, kwargs) of the first segment
+        return getattr(self._first_file.root, name)
+
+
+class RawDataFile(object):
+    ''' Read-only view of a rotated run as one file, see module description
+
+        Parameters
+        ----------
+        raw_data_file : str
+            First file of the run (all segments) or one segment
+        all_segments : bool
+            If False only the first file of the run is read
+        mmap : bool
+            Read the raw data from the sidecar file if it contains all words of the view
+    '''
+
+    def __init__(self, raw_data_file, all_segments=True, mmap=False):
+        self.filename = raw_data_file
+        self.segment_files = get_segment_files(raw_data_file) if all_segments else [raw_data_file]
+        self.h5_files = []
+        try:
+            for filename in self.segment_files:
+                self.h5_files.append(tb.open_file(filename))
+        except Exception:
+            self.close()
+            raise
+        raw_data = VirtualRawData([h5_file.root.raw_data for h5_file in self.h5_files])
+        if mmap:
+            sidecar = open_sidecar(raw_data_file, offset=get_raw_data_offset(self.h5_files[0].root.meta_data), n_rows=raw_data.nrows)
+            if sidecar is None:
+                logger.warning('No complete sidecar file %s, read raw data from %s', get_sidecar_filename(raw_data_file), raw_data_file)
+            else:
+                raw_data = sidecar
+        self.root = Root(raw_data, VirtualMetaData([h5_file.root.meta_data for h5_file in self.h5_files]), self.h5_files[0])
+
+    def get_node(self, where, name=None):
+        if where is self.root and name is not None:
+            return getattr(self.root, name)
+        if name is None and isinstance(where, str):
+            return getattr(self.root, where.lstrip('/'))
+        raise tb.NoSuchNodeError('Node %s not found' % name)
+
+    def close(self):
+        for h5_file in self.h5_files:
+            h5_file.close()
+        self.h5_files = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def open_raw_data_file(raw_data_file, all_segments=True, mmap=False):
+    ''' Open a raw data file with all its segments as one read-only file (tables.File like)
+    '''
+    return RawDataFile(raw_data_file, all_segments=all_segments, mmap=mmap)
@@ -1,92 +1,173 @@
-import sys,time,os
+''' Synchronisation of the TLU words (col 0xFF) with the trigger timestamps of the TLU timestamp module (col 0xFC)
+
+    Every trigger gives a TLU word (trigger number and the 19 bit TLU timestamp) and a 64 bit trigger timestamp.
+    The TLU timestamp is later by the handshake, (TRIGGER_HANDSHAKE_ACCEPT_WAIT_CYCLES + 1) * 16 clocks, with a
+    tolerance of SYNC_LOW (earlier) to SYNC_HIGH (later) clocks. If a word of one of the streams is lost the pairs
+    of the following words do not match anymore: the engine searches the numbers of TLU words and timestamps to drop
+    (up to resync_window words of each stream) that give n_check matching pairs and continues there.
+
+    TLUTimestampSynchronizer is used for streaming (BuildEvents of event_builder_basic, the online HitCorrelator)
+    and for files (event_builder_mon.build_h5):
+        python tlu_timestamp_synchronizer.py run.h5 (uses run_hit.h5 of interpreter_idx)
+'''
+from __future__ import print_function
+import logging
+
 import numpy as np
-import matplotlib.pyplot as plt
 from numba import njit
 import tables
 import yaml
 
+from tjmonopix.analysis.analysis_utils import RingBuffer
+
+logger = logging.getLogger('TLUTimestampSynchronizer')
+
+TLU_TIMESTAMP_MASK = 0x7FFFF
+SYNC_LOW = 16
+SYNC_HIGH = 32
+
+sync_dtype = [("trigger_number", "i2"), ("tlu_timestamp", "u8"), ("ts_timestamp", "u8")]
+
+
+def get_offset(WAIT_CYCLES):
+    ''' Delay of the TLU timestamp with respect to the trigger timestamp in clocks
+    '''
+    return (WAIT_CYCLES + 1) * 16
 
-data_out_type=[("tlu_id","i2"),("tlu_timestamp","u8"),("ts_timestamp","u8")]
-hits_type=[('col', 'u1'), ('row', '<u2'), ('le', 'u1'), ('te', 'u1'), ('cnt', '<u4'), ('timestamp', '<u8')]
 
 @njit
-def _sync_tlu_timestamp(tlu,ts,data_out,offset):
-    tlu_i=0
-    ts_i=0
-    i=0
+def _in_sync(tlu_timestamp, ts_timestamp, offset):
+    return (tlu_timestamp - ts_timestamp - np.uint64(offset - SYNC_LOW)) & np.uint64(TLU_TIMESTAMP_MASK) < np.uint64(SYNC_LOW + SYNC_HIGH)
+
+
+@njit
+def _n_in_sync(tlu, ts, tlu_i, ts_i, offset, n_check):
+    n = 0
+    while n < n_check and tlu_i + n < len(tlu) and ts_i + n < len(ts) and _in_sync(tlu[tlu_i + n]["timestamp"], ts[ts_i + n]["timestamp"], offset):
+        n += 1
+    return n
+
+
+@njit
+def _find_resync(tlu, ts, tlu_i, ts_i, offset, resync_window, n_check):
+    ''' Numbers of TLU words and timestamps to drop (fewest words first) for n_check matching pairs,
+        the best match if no candidate gives n_check pairs and (-1, -1) if none matches
+    '''
+    best_tlu, best_ts, best_n = -1, -1, 0
+    for n_skip in range(1, 2 * resync_window + 1):
+        for skip_tlu in range(max(0, n_skip - resync_window), min(n_skip, resync_window) + 1):
+            skip_ts = n_skip - skip_tlu
+            n = _n_in_sync(tlu, ts, tlu_i + skip_tlu, ts_i + skip_ts, offset, n_check)
+            if n == n_check:
+                return skip_tlu, skip_ts
+            if n > best_n:
+                best_tlu, best_ts, best_n = skip_tlu, skip_ts, n
+    return best_tlu, best_ts
+
+
+@njit
+def _sync_tlu_timestamp(tlu, ts, data_out, offset, resync_window, n_check, flush):
+    ''' Pairs of TLU words and trigger timestamps, drops the words of a stream without partner
+
+        Stops at the end of the data, if data_out is full or (without flush) if a re-sync needs more data.
+        Returns the number of pairs, the numbers of used TLU words and timestamps, the number of re-syncs and
+        the numbers of dropped TLU words and timestamps.
+    '''
+    tlu_i = 0
+    ts_i = 0
+    i = 0
+    n_resyncs = 0
+    n_dropped_tlu = 0
+    n_dropped_ts = 0
     while tlu_i < len(tlu) and ts_i < len(ts) and i < len(data_out):
-        #print tlu_i, hex(tlu[tlu_i]["timestamp"]), ts_i, hex(ts[ts_i]["timestamp"]), 
-        #print hex((tlu[tlu_i]["timestamp"] - ts[ts_i]["timestamp"]) & np.uint64(0x7FFFF)),
-        if (tlu[tlu_i]["timestamp"] - ts[ts_i]["timestamp"] - np.uint64(offset+16*2)) & np.uint64(0x7FFFF)  <= 0x40000:
-            #ts_i =ts_i+1
-            #print "next ts"
-            print "tlu and tlu_ts is not synchronized, synchronize data manually",tlu_i,ts_i
-            return 1, i, tlu_i, ts_i, data_out
-        elif ((tlu[tlu_i]["timestamp"] - ts[ts_i]["timestamp"]- np.uint64(offset-16)) & np.uint64(0x7FFFF) ) > 0x40000:
-            #tlu_i=tlu_i+1
-            #print "next tlu"
-            print "tlu and tlu_ts is not synchronized, synchronize data manually",tlu_i,ts_i
-            return 2, i, tlu_i, ts_i, data_out
-        else:
-            data_out[i]["tlu_id"]=tlu[tlu_i]["cnt"] 
-            data_out[i]["tlu_timestamp"]=tlu[tlu_i]["timestamp"]
-            data_out[i]["ts_timestamp"]=ts[ts_i]["timestamp"]
-            ts_i=ts_i+1
-            tlu_i=tlu_i+1
-            i=i+1
-    return 0, i, tlu_i, ts_i, data_out
+        if _in_sync(tlu[tlu_i]["timestamp"], ts[ts_i]["timestamp"], offset):
+            data_out[i]["trigger_number"] = tlu[tlu_i]["cnt"]
+            data_out[i]["tlu_timestamp"] = tlu[tlu_i]["timestamp"]
+            data_out[i]["ts_timestamp"] = ts[ts_i]["timestamp"]
+            ts_i = ts_i + 1
+            tlu_i = tlu_i + 1
+            i = i + 1
+            continue
+        if not flush and (len(tlu) - tlu_i < resync_window + n_check or len(ts) - ts_i < resync_window + n_check):
+            break  # Wait for the following words
+        skip_tlu, skip_ts = _find_resync(tlu, ts, tlu_i, ts_i, offset, resync_window, n_check)
+        if skip_tlu < 0:  # No match in the window, drop both words and search again
+            skip_tlu, skip_ts = 1, 1
+        n_resyncs = n_resyncs + 1
+        n_dropped_tlu = n_dropped_tlu + skip_tlu
+        n_dropped_ts = n_dropped_ts + skip_ts
+        tlu_i = tlu_i + skip_tlu
+        ts_i = ts_i + skip_ts
+    return i, tlu_i, ts_i, n_resyncs, n_dropped_tlu, n_dropped_ts
+
 
 class TLUTimestampSynchronizer():
-    def __init__(self,WAIT_CYCLES=20):
-        self.reset(WAIT_CYCLES)
-    def reset(self,WAIT_CYCLES, n=1000000):
-        self.tlu=np.empty(0,dtype=[('cnt', '<u4'), ('timestamp', '<u8')])
-        self.ts=np.empty(0,dtype=[('timestamp', '<u8')])
-        self.data_out=np.empty(n,dtype=data_out_type)
-        self.offset=(WAIT_CYCLES+1) * 16
-    def check_fist_data(self,tlu_e,ts_e):
-        if (tlu_e["timestamp"]-ts_e["timestamp"]) & np.uint64(0x7FFFF) > np.uint64(self.offset-16) \
-           and (tlu_e["timestamp"]-ts_e["timestamp"]) & np.uint64(0x7FFFF)< np.uint64(self.offset+16*2) :
-                print "tlu and tlu_ts is synchronized"
-                return 0
-        else:
-            print "tlu and tlu_ts is not synchronized, synchronize data manually"
-            return -1
-    def run(self,hits):
-        self.tlu=np.append(self.tlu,hits[hits["col"]==255][["timestamp","cnt"]])
-        self.ts=np.append(self.ts,hits[hits["col"]==252][["timestamp"]])
-        if len(self.tlu) >0 and len(self.ts) > 0:
-            self.check_fist_data(self.tlu[0],self.ts[0])
-        else:
-            return np.empty(0,dtype=data_out_type)
-        err, i, tlu_i, ts_i, self.data_out = _sync_tlu_timestamp(self.tlu,self.ts,self.data_out,self.offset)
-        if err !=0:
-            print "tlu and tlu_ts is not synchronized, data broken err=%d, at tlu_index=%d ts_index=%d"%(err,tlu_i,ts_i)
-            return np.empty(0,dtype=data_out_type)
-        self.tlu=self.tlu[tlu_i:]
-        self.ts=self.ts[ts_i:]
+    ''' Streaming synchronisation of the TLU words with the trigger timestamps, see module description
+
+        The pending words are kept in ring buffers, get_status() gives the counters and the buffer statistics.
+        run(hits, flush=True) for the last chunk re-syncs with the remaining words.
+    '''
+    def __init__(self, WAIT_CYCLES=20, resync_window=16, n_check=4, n=1000000, capacity=1000000):
+        self.resync_window = resync_window
+        self.n_check = n_check
+        self.reset(WAIT_CYCLES, n=n, capacity=capacity)
+
+    def reset(self, WAIT_CYCLES=20, n=1000000, capacity=1000000):
+        self.tlu = RingBuffer(capacity, [('cnt', '<u4'), ('timestamp', '<u8')], name="tlu")
+        self.ts = RingBuffer(capacity, [('timestamp', '<u8')], name="ts")
+        self.data_out = np.empty(n, dtype=sync_dtype)
+        self.WAIT_CYCLES = WAIT_CYCLES
+        self.offset = get_offset(WAIT_CYCLES)
+        self.n_synced = 0
+        self.n_resyncs = 0
+        self.n_dropped_tlu = 0
+        self.n_dropped_ts = 0
+
+    def get_status(self):
+        return {'wait_cycles': self.WAIT_CYCLES, 'synced': self.n_synced, 'resyncs': self.n_resyncs,
+                'dropped_tlu': self.n_dropped_tlu, 'dropped_ts': self.n_dropped_ts,
+                'buffers': [self.tlu.get_status(), self.ts.get_status()]}
+
+    def run(self, hits, flush=False):
+        self.tlu.append(hits[hits["col"] == 255])
+        self.ts.append(hits[hits["col"] == 252])
+        sync = self._sync(flush)
+        if not flush or sync.shape[0] < self.data_out.shape[0]:
+            return sync
+        sync = [sync.copy()]
+        while sync[-1].shape[0] == self.data_out.shape[0]:  # data_out was full, sync the remaining words
+            sync.append(self._sync(flush).copy())
+        return np.concatenate(sync)
+
+    def _sync(self, flush):
+        i, tlu_i, ts_i, n_resyncs, n_dropped_tlu, n_dropped_ts = _sync_tlu_timestamp(
+            self.tlu.data, self.ts.data, self.data_out, self.offset, self.resync_window, self.n_check, flush)
+        self.tlu.consume(tlu_i)
+        self.ts.consume(ts_i)
+        if n_resyncs:
+            logger.warning('TLU words and trigger timestamps re-synchronized %d times, dropped %d TLU words and %d timestamps',
+                           n_resyncs, n_dropped_tlu, n_dropped_ts)
+        self.n_synced += i
+        self.n_resyncs += n_resyncs
+        self.n_dropped_tlu += n_dropped_tlu
+        self.n_dropped_ts += n_dropped_ts
         return self.data_out[:i]
-        
+
+
 if __name__ == "__main__":
     import sys
 
-    fraw=sys.argv[1]
-    
-    fhit=fraw[:-3]+"_hit.h5"
-    
+    fraw = sys.argv[1]
+    fhit = fraw[:-3] + "_hit.h5"
+
     with tables.open_file(fhit) as f_i:
-        hits=f_i.root.Hits[:]
+        hits = f_i.root.Hits[:]
     with tables.open_file(fraw) as f_i:
-        conf_s=f_i.root.meta_data.get_attr("status")
-        
-    conf=yaml.safe_load(conf_s)
-    WAIT_CYCLES=conf['tlu']["TRIGGER_HANDSHAKE_ACCEPT_WAIT_CYCLES"]
-    
-    tlu_synchronizer=TLUTimestampSynchronizer(WAIT_CYCLES=WAIT_CYCLES)
-    tlu_synchronizer.run(hits)
-    
-    #offset=(WAIT_CYCLES+1)*16
-    #plt.hist((sync["tlu_timestamp"]-sync["ts_timestamp"]) & 0x7FFFF, bins=np.arange(offset-3*16,offset+3*16,1));
-    #plt.xlabel("TLU - TS [640MHz clk]")
-    #plt.ylabel("#")
-    #plt.savefig('tlu_timestamp_synchronizer.png')
\ No newline at end of file
+        conf_s = f_i.root.meta_data.get_attr("status")
+
+    conf = yaml.safe_load(conf_s)
+    WAIT_CYCLES = conf['tlu']["TRIGGER_HANDSHAKE_ACCEPT_WAIT_CYCLES"]
+
+    tlu_synchronizer = TLUTimestampSynchronizer(WAIT_CYCLES=WAIT_CYCLES, n=hits.shape[0], capacity=hits.shape[0])
+    sync = tlu_synchronizer.run(hits, flush=True)
+    print(tlu_synchronizer.get_status())
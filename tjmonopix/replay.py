@@ -0,0 +1,139 @@
+''' Replay of a recorded run for load tests of the data writing and the online monitor without hardware
+
+    ReplayDut can be used instead of TJMonoPix with FifoReadout and ScanBase. It puts the recorded raw data chunks
+    into its FIFO at the time they were originally read out (scaled by speed) or as fast as the readout takes them
+    (speed=None). Thus the data take the same readout, writing and send_data path as live data:
+        python -m tjmonopix.replay run.h5 [--speed 10] [--send_data tcp://127.0.0.1:5500]
+'''
+import argparse
+import logging
+import os
+from collections import deque
+from time import time, sleep
+
+import numpy as np
+
+from tjmonopix.analysis.raw_data_files import open_raw_data_file
+from tjmonopix.sim_dut import SimulatedDut
+from tjmonopix.scan_base import ScanBase
+
+logger = logging.getLogger('Replay')
+
+
+class ReplayDut(SimulatedDut):
+    ''' Simulated DUT whose FIFO is filled with the raw data of a recorded run
+
+        Parameters
+        ----------
+        raw_data_file : str
+            Recorded run with raw_data and meta_data
+        speed : float
+            Replay speed relative to the original timing, None to replay as fast as possible
+        fifo_depth : int
+            SRAM FIFO depth in words. In timed replay, chunks not fitting into the FIFO are lost. At maximum speed
+            the chunks wait for the readout, chunks larger than the FIFO are put into the empty FIFO.
+        read_bandwidth : float
+            Maximum read out rate in words/s (None is unlimited)
+    '''
+
+    def __init__(self, raw_data_file, speed=1., fifo_depth=1 << 21, read_bandwidth=None):
+        super(ReplayDut, self).__init__(hit_rate=0., fifo_depth=fifo_depth, read_bandwidth=read_bandwidth)
+        self.raw_data_file = raw_data_file
+        self.speed = speed
+        self._in_file = open_raw_data_file(raw_data_file)  # All segments of a rotated run
+        self.meta_data = self._in_file.root.meta_data[:]
+        self._chunks = deque()
+        self._replay_start = 0.
+        self._timestamp_start = 0.
+
+    def init(self, flavor=None):
+        logger.info('Replay of %s (%d words, %d chunks) at %s', self.raw_data_file, self._in_file.root.raw_data.shape[0],
+                    self.meta_data.shape[0], 'maximum speed' if not self.speed else '{:g}x speed'.format(self.speed))
+
+    def close(self):
+        self._in_file.close()
+
+    def get_scan_param_chunks(self):
+        ''' Meta data of the recorded run for every scan parameter (consecutive chunks with same scan_param_id)
+        '''
+        if self.meta_data.shape[0] == 0:
+            return
+        split = np.nonzero(np.diff(self.meta_data['scan_param_id']))[0] + 1
+        for meta_data in np.split(self.meta_data, split):
+            yield int(meta_data[0]['scan_param_id']), meta_data
+
+    def replay(self, meta_data=None):
+        ''' Start the replay of the chunks in meta_data (all chunks if None), the timing starts now
+        '''
+        if meta_data is None:
+            meta_data = self.meta_data
+        with self._lock:
+            self._chunks.extend(meta_data)
+            self._replay_start = time()
+            if meta_data.shape[0]:
+                self._timestamp_start = meta_data[0]['timestamp_start']
+
+    def is_done(self):
+        ''' All chunks are in the FIFO (or lost)
+        '''
+        with self._lock:
+            self._update()
+            return not self._chunks
+
+    def _update(self):
+        ''' Move the chunks that are due into the FIFO '''
+        elapsed = time() - self._replay_start
+        while self._chunks:
+            chunk = self._chunks[0]
+            if self.speed and elapsed * self.speed < chunk['timestamp_stop'] - self._timestamp_start:
+                break
+            n_words = int(chunk['index_stop'] - chunk['index_start'])
+            if self._fifo_size + n_words > self.fifo_depth and self.speed:
+                self['data_rx'].count_lost(1)
+                self.n_lost_words += n_words
+            elif self._fifo_size + n_words > self.fifo_depth and self._fifo_size:  # Wait for the readout
+                break
+            elif n_words:  # At maximum speed a chunk larger than the FIFO is put into the empty FIFO at once
+                self._fifo.append(self._in_file.root.raw_data[chunk['index_start']:chunk['index_stop']])
+                self._fifo_size += n_words
+                self.n_words += n_words
+            self._chunks.popleft()
+
+
+class ReplayScan(ScanBase):
+    ''' Replay of a recorded run scan parameter by scan parameter, writing a new raw data file
+    '''
+    scan_id = "replay"
+
+    def scan(self, **kwargs):
+        readout_interval = kwargs.pop('readout_interval', 0.003)
+        start_time = time()
+        for scan_param_id, meta_data in self.dut.get_scan_param_chunks():
+            with self.readout(scan_param_id=scan_param_id, readout_interval=readout_interval):
+                self.dut.replay(meta_data)
+                while not self.dut.is_done():
+                    sleep(0.01)
+        duration = time() - start_time
+        recorded_duration = self.dut.meta_data['timestamp_stop'][-1] - self.dut.meta_data['timestamp_start'][0] if self.dut.meta_data.shape[0] else 0.
+        self.logger.info('Replayed %d words in %.1f s (%.1fx original speed), lost %d words',
+                         self.dut.n_words, duration, recorded_duration / duration if duration else 0., self.dut.n_lost_words)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('raw_data_file')
+    parser.add_argument('--speed', type=float, default=1., help='Speed-up of the original timing, 0 for maximum speed')
+    parser.add_argument('--send_data', default='tcp://127.0.0.1:5500', help='Online monitor address')
+    parser.add_argument('--output_directory', default=None)
+    parser.add_argument('--fifo_depth', type=int, default=1 << 21)
+    args = parser.parse_args()
+
+    bench = {'general': {'output_directory': args.output_directory or os.path.join(os.getcwd(), "output_data")},
+             'dut': {'send_data': args.send_data}}
+    dut = ReplayDut(args.raw_data_file, speed=args.speed or None, fifo_depth=args.fifo_depth)
+    dut.init()
+    try:
+        scan = ReplayScan(bench_config=bench, dut=dut)
+        scan.start()
+    finally:
+        dut.close()
@@ -2,12 +2,18 @@ import time
 import os
 import logging
 import yaml
+import numpy as np
 import tables as tb
 import zmq
 from online_monitor.utils import utils
 
 from contextlib import contextmanager
+from threading import RLock
 from tjmonopix.tjmonopix import TJMonoPix
+from tjmonopix.sim_dut import SimulatedDut
+from tjmonopix.analysis.interpreter import StreamingInterpreter
+from tjmonopix.analysis import analysis_utils as au
+from tjmonopix.analysis.raw_data_files import get_segment_filename, get_sidecar_filename
 from fifo_readout import FifoReadout
 
 
@@ -55,8 +61,12 @@ class ScanBase(object):
     def start(self, **kwargs):
 
         # If DUT instance is not passed as argument, initialize it
-        if isinstance(self.dut, TJMonoPix):
+        if isinstance(self.dut, (TJMonoPix, SimulatedDut)):
             pass
+        elif "dut" in self.bench.keys() and self.bench["dut"].get("simulation") is not None:
+            # Software stand-in for load tests without hardware, parameters see SimulatedDut
+            self.dut = SimulatedDut(**self.bench["dut"]["simulation"])
+            self.dut.init()
         elif "dut" in self.bench.keys():
             chip_cfg = self._load_chip_cfg(self.bench["dut"])
             self.dut = TJMonoPix()
@@ -70,36 +80,32 @@ class ScanBase(object):
         self.send_addr = self.bench["dut"]["send_data"]
 
         # create and open data file
-        self.h5_file = tb.open_file(self.output_filename + '.h5', mode="w", title="")
-        self.raw_data_earray = self.h5_file.create_earray(
-            self.h5_file.root,
-            name="raw_data",
-            atom=tb.UIntAtom(),
-            shape=(0,),
-            title="Raw data",
-            filters=tb.Filters(complib="blosc", complevel=5, fletcher32=False))
-        self.meta_data_table = self.h5_file.create_table(
-            self.h5_file.root,
-            name='meta_data',
-            description=MetaTable,
-            title='meta_data',
-            filters=tb.Filters(complib='zlib', complevel=5, fletcher32=False))
-        self.meta_data_table.attrs.kwargs = yaml.dump(kwargs)
-        self.meta_data_table.attrs.scan_id = self.scan_id
         status = self.dut.get_power_status()
         self.logger.info('Power status: {:s}'.format(str(status)))
         self.logger.info('Temperature: {:4.1f} C'.format(self.dut.get_temperature()))
-        self.meta_data_table.attrs.power_before = yaml.dump(status)
-        self.meta_data_table.attrs.status_before = yaml.dump(self.dut.get_configuration())
-        self.meta_data_table.attrs.SET_before = yaml.dump(self.dut.SET)
-        self.kwargs = self.h5_file.create_vlarray(
-            self.h5_file.root,
-            name='kwargs',
-            atom=tb.VLStringAtom(),
-            title='kwargs',
-            filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
-        self.kwargs.append("kwargs")
-        self.kwargs.append(yaml.dump(kwargs))
+        self._file_kwargs = kwargs
+        self._file_attrs = {'kwargs': yaml.dump(kwargs), 'scan_id': self.scan_id, 'power_before': yaml.dump(status),
+                            'status_before': yaml.dump(self.dut.get_configuration()), 'SET_before': yaml.dump(self.dut.SET)}
+        mask = self.dut.get_mask()
+        self._file_mask = mask[self.dut.fl_n * 112:(self.dut.fl_n + 1) * 112]
+        self.segment = 0
+        self.h5_file, self.meta_data_table = self._open_raw_data_file()
+        self.kwargs = self.h5_file.root.kwargs
+        self.segment_h5_file = self.h5_file  # File of the actual segment, see _rotate_raw_data_file
+
+        # Buffered writer for raw data and meta data, optionally with uncompressed copy for memory mapped analysis
+        sidecar = get_sidecar_filename(self.output_filename + '.h5') if self.bench.get("general", {}).get("raw_data_sidecar") else None
+        self.raw_data_writer = RawDataWriter(self.h5_file.root.raw_data, self.meta_data_table, sidecar=sidecar,
+                                             **self.bench.get("general", {}).get("raw_data_writer", {}))
+        # Start a new file (segment) after max_words words or max_duration seconds, see analysis.raw_data_files
+        self.rotation = self.bench.get("general", {}).get("raw_data_rotation", {})
+        self._segment_start = time.time()
+
+        # Optional interpretation of the raw data during the run
+        if self.bench.get("general", {}).get("interpret_online", False):
+            self._open_interpreted_data_file()
+        else:
+            self.interpreter = None
 
         # Setup socket for Online Monitor
         socket_addr = self.send_addr
@@ -115,31 +121,33 @@ class ScanBase(object):
         else:
             self.socket = None
 
-        mask = self.dut.get_mask()
-        self.h5_file.create_carray(
-            self.h5_file.root,
-            name='mask',
-            title='Masked pixels',
-            obj=mask[self.dut.fl_n * 112:(self.dut.fl_n + 1) * 112],
-            filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False)
-        )
-
         # Execute scan
         self.fifo_readout = FifoReadout(self.dut)
-        self.scan(**kwargs)
+        telemetry_addr = self.bench.get("general", {}).get("readout", {}).get("telemetry")
+        if telemetry_addr:  # Readout statistics during the run, see ReadoutTelemetry
+            self.fifo_readout.telemetry.start_publishing(telemetry_addr)
+        try:
+            self.scan(**kwargs)
+        finally:
+            self.fifo_readout.telemetry.stop_publishing()
         self.fifo_readout.print_readout_status()
+        self.raw_data_writer.close()
+        self.raw_data_writer.print_status()
 
         # Log and save power status and configuration
         status = self.dut.get_power_status()
         self.logger.info('Power status: {:s}'.format(str(status)))
         self.logger.info('Temperature: {:4.1f} C'.format(self.dut.get_temperature()))
 
-        self.meta_data_table.attrs.power = yaml.dump(status)
-        self.meta_data_table.attrs.status = yaml.dump(self.dut.get_configuration())
-        self.meta_data_table.attrs.SET = yaml.dump(self.dut.SET)
+        with self.raw_data_writer.lock:
+            self.meta_data_table.attrs.power = yaml.dump(status)
+            self.meta_data_table.attrs.status = yaml.dump(self.dut.get_configuration())
+            self.meta_data_table.attrs.SET = yaml.dump(self.dut.SET)
 
         # Close data file
-        self.h5_file.close()
+        self._close_raw_data_file()
+        if self.interpreter:
+            self._close_interpreted_data_file()
 
         # Close socket from Online Monitor
         if self.socket:
@@ -150,58 +158,162 @@ class ScanBase(object):
 
     def stop(self):
         try:
-            self.h5_file.close()
+            self.raw_data_writer.close()
+            self._close_raw_data_file()
+            if self.interpreter:
+                self._close_interpreted_data_file()
         except Exception:
             self.logger.warn("Could not close h5 file manually")
 
+    def _open_raw_data_file(self):
+        ''' Create the raw data file of the actual segment with the run configuration of the start of the scan
+
+            Returns the file and its meta_data table.
+        '''
+        h5_file = tb.open_file(get_segment_filename(self.output_filename + '.h5', self.segment), mode="w", title="")
+        create_raw_data_earray(h5_file, **self.bench.get("general", {}).get("raw_data_storage", {}))
+        meta_data_table = h5_file.create_table(
+            h5_file.root,
+            name='meta_data',
+            description=MetaTable,
+            title='meta_data',
+            filters=tb.Filters(complib='zlib', complevel=5, fletcher32=False))
+        for name, value in self._file_attrs.items():
+            meta_data_table.attrs[name] = value
+        meta_data_table.attrs.segment = self.segment
+        kwargs = h5_file.create_vlarray(
+            h5_file.root,
+            name='kwargs',
+            atom=tb.VLStringAtom(),
+            title='kwargs',
+            filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+        kwargs.append(b"kwargs")
+        kwargs.append(yaml.dump(self._file_kwargs).encode())
+        h5_file.create_carray(
+            h5_file.root,
+            name='mask',
+            title='Masked pixels',
+            obj=self._file_mask,
+            filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False)
+        )
+        return h5_file, meta_data_table
+
+    def _close_raw_data_file(self):
+        for h5_file in set([self.segment_h5_file, self.h5_file]):
+            if h5_file.isopen:
+                # Raw data word range of every scan parameter, see analysis_utils.read_scan_param
+                au.create_scan_param_index(h5_file)
+                h5_file.close()
+
+    def _rotate_raw_data_file(self):
+        ''' Continue writing into the next segment, called with the lock of the raw data writer held
+
+            self.h5_file and self.meta_data_table stay the ones of the first segment (run.h5), the scans
+            store their attributes there. The first segment is closed at the end of the run.
+        '''
+        h5_file = self.segment_h5_file
+        self.segment += 1
+        self.segment_h5_file, meta_data_table = self._open_raw_data_file()
+        self.raw_data_writer.set_output(self.segment_h5_file.root.raw_data, meta_data_table)
+        self._segment_start = time.time()
+        if h5_file is not self.h5_file:
+            au.create_scan_param_index(h5_file)
+            h5_file.close()
+        self.logger.info('Continue run in %s', self.segment_h5_file.filename)
+
+    def _open_interpreted_data_file(self):
+        ''' Create the output file for the hits interpreted during the run (same format as Analysis.analyze_data)
+        '''
+        self.interpreter = StreamingInterpreter()
+        self.interpreted_data_file = self.output_filename + '_interpreted.h5'
+        self.interpreted_h5_file = tb.open_file(self.interpreted_data_file, mode="w", title="")
+        self.hit_table = self.interpreted_h5_file.create_table(
+            self.interpreted_h5_file.root,
+            name="Dut",
+            description=np.dtype(self.interpreter.hit_dtype),
+            title='hit_data',
+            filters=tb.Filters(complib='blosc', complevel=5, fletcher32=False))
+        self.hit_table.attrs.scan_id = self.scan_id
+
+    def _close_interpreted_data_file(self):
+        self.hit_table.flush()
+        au.create_scan_param_index(self.interpreted_h5_file, node='Dut')
+        self.interpreted_h5_file.close()
+        self.logger.info('Interpreted %d words online: %d hits, %d errors', self.interpreter.n_words,
+                         self.interpreter.n_hits, self.interpreter.get_error_count())
+        self.interpreter = None
+
     @contextmanager
     def readout(self, *args, **kwargs):
         timeout = kwargs.pop('timeout', 10.0)
         self.fifo_readout.readout_interval = kwargs.pop('readout_interval', 0.003)
 
         self._start_readout(*args, **kwargs)
-        yield
-        self._stop_readout(timeout)
+        try:
+            yield
+        finally:
+            self._stop_readout(timeout)
 
     def _start_readout(self, *args, **kwargs):
-        callback = kwargs.pop('callback', self._handle_data)
+        ''' Start the FIFO readout, by default every chunk is written and sent from the worker thread
+
+            With pipelined=True (or pipelined in general/readout of the bench config) the chunks are
+            written to disk from a separate writer thread and only sent from the worker thread.
+            A callback given by the caller replaces writing and sending, as without pipelining.
+        '''
+        readout_cfg = self.bench.get("general", {}).get("readout", {})
+        pipelined = kwargs.pop('pipelined', readout_cfg.get('pipelined', False))
+        callback = kwargs.pop('callback', None)
+        writer = kwargs.pop('writer', self._write_data if pipelined and callback is None else None)
+        if callback is None:
+            callback = self._send_data if writer else self._handle_data
+        high_water = kwargs.pop('high_water', readout_cfg.get('high_water', 50000000))
+        policy = kwargs.pop('policy', readout_cfg.get('policy', 'block'))
         clear_buffer = kwargs.pop('clear_buffer', False)
         fill_buffer = kwargs.pop('fill_buffer', False)
         reset_sram_fifo = kwargs.pop('reset_sram_fifo', False)
         errback = kwargs.pop('errback', self._handle_err)
         no_data_timeout = kwargs.pop('no_data_timeout', None)
         self.scan_param_id = kwargs.pop('scan_param_id', 0)
+        self.fifo_readout.configure_polling(**kwargs.pop('polling', readout_cfg.get('polling', {})))
         self.fifo_readout.start(reset_sram_fifo=reset_sram_fifo,
                                 fill_buffer=fill_buffer,
                                 clear_buffer=clear_buffer,
                                 callback=callback,
                                 errback=errback,
-                                no_data_timeout=no_data_timeout)
+                                no_data_timeout=no_data_timeout,
+                                writer=writer,
+                                high_water=high_water,
+                                policy=policy,
+                                spill_dir=self.working_dir)
 
     def _stop_readout(self, timeout):
-        self.fifo_readout.stop(timeout=timeout)
+        try:
+            self.fifo_readout.stop(timeout=timeout)
+        finally:
+            self.raw_data_writer.flush()
 
     def _handle_data(self, data_tuple):
+        ''' Write and send readout chunk from one thread (readout without writer thread)
+        '''
+        self._write_data(data_tuple)
+        self._send_data(data_tuple)
 
-        total_words = self.raw_data_earray.nrows
-        len_raw_data = data_tuple[0].shape[0]
-
-        self.raw_data_earray.append(data_tuple[0])
-        self.raw_data_earray.flush()
+    def _write_data(self, data_tuple):
+        # PyTables is not thread safe, all HDF5 accesses during the readout hold the lock of the raw data writer
+        with self.raw_data_writer.lock:
+            if self.rotation and (self.raw_data_writer.segment_words >= self.rotation.get('max_words', np.inf) or
+                                  time.time() - self._segment_start >= self.rotation.get('max_duration', np.inf)):
+                self._rotate_raw_data_file()  # Here and not after writing to not end with an empty file
+            self.raw_data_writer.append(data_tuple, self.scan_param_id)
 
-        self.meta_data_table.row['timestamp_start'] = data_tuple[1]
-        self.meta_data_table.row['timestamp_stop'] = data_tuple[2]
-        self.meta_data_table.row['error'] = data_tuple[3]
-        self.meta_data_table.row['data_length'] = len_raw_data
-        self.meta_data_table.row['index_start'] = total_words
-        total_words += len_raw_data
-        self.meta_data_table.row['index_stop'] = total_words
-        self.meta_data_table.row['scan_param_id'] = self.scan_param_id
-        self.meta_data_table.row.append()
-        self.meta_data_table.flush()
+            if self.interpreter:
+                self.hit_table.append(self.interpreter.interpret(data_tuple[0], self.scan_param_id))
 
+    def _send_data(self, data_tuple):
         if self.socket:
-            send_data(self.socket, data=data_tuple, scan_par_id=self.scan_param_id)
+            if not send_data(self.socket, data=data_tuple, scan_par_id=self.scan_param_id):
+                self.fifo_readout.telemetry.dropped_sends += 1
 
     def _handle_err(self, exc):
         msg = str(exc[1])
@@ -209,6 +321,8 @@ class ScanBase(object):
             self.logger.error('%s Aborting run...', msg)
         else:
             self.logger.error("Aborting run...")
+        # Make sure everything received so far ends up on disk
+        self.raw_data_writer.flush()
 
     def _load_testbench_cfg(self, bench_config):
         ''' Load the bench config into the scan
@@ -220,6 +334,8 @@ class ScanBase(object):
         '''
         if bench_config is None:
             bench_config = TESTBENCH_DEFAULT_FILE
+        if isinstance(bench_config, dict):
+            return bench_config
         with open(bench_config) as f:
             bench = yaml.full_load(f)
 
@@ -278,11 +394,42 @@ class ScanBase(object):
             self.logger.warning("No mask information given, chip might be noisy")
 
 
+def create_raw_data_earray(h5_file, complib='blosc', complevel=5, shuffle=True, bitshuffle=False, chunkshape=None):
+    ''' Create the raw_data EArray with the compression settings of the raw_data_storage bench config
+
+        Parameters:
+        ----------
+        complib : str
+                Compression library of PyTables (e.g. 'blosc', 'blosc:lz4', 'blosc:zstd', 'zlib') or 'none'
+        complevel : int
+                Compression level (0 - 9)
+        shuffle, bitshuffle : boolean
+                Byte or bit shuffle filter, bitshuffle is only available for blosc and replaces shuffle
+        chunkshape : int
+                HDF5 chunk size in words, None for the PyTables default
+    '''
+    if complib in (None, 'none') or not complevel:
+        filters = tb.Filters(complevel=0, shuffle=False, fletcher32=False)
+    else:
+        if complib not in tb.filters.all_complibs:
+            raise ValueError("Unknown compression library {}, use 'none' or one of {}".format(complib, ", ".join(tb.filters.all_complibs)))
+        filters = tb.Filters(complib=complib, complevel=complevel, shuffle=shuffle and not bitshuffle, bitshuffle=bitshuffle, fletcher32=False)
+    return h5_file.create_earray(
+        h5_file.root,
+        name="raw_data",
+        atom=tb.UIntAtom(),
+        shape=(0,),
+        title="Raw data",
+        filters=filters,
+        chunkshape=(chunkshape,) if chunkshape else None)
+
+
 def send_data(socket, data, scan_par_id, name='ReadoutData'):
     '''Sends the data of every read out (raw data and meta data)
 
         via ZeroMQ to a specified socket.
         Uses a serialization provided by the online_monitor package
+        Returns False if the data was dropped because the socket was busy.
     '''
 
     data_meta_data = dict(
@@ -300,12 +447,147 @@ def send_data(socket, data, scan_par_id, name='ReadoutData'):
         # socket.send(data[0], flags=zmq.NOBLOCK)
         socket.send(data_ser, flags=zmq.NOBLOCK)
     except zmq.Again:
-        pass
+        return False
+    return True
+
+
+class RawDataWriter(object):
+    ''' Buffered writer for raw data and meta data
+
+        Readout chunks are collected in memory and written to the raw_data EArray and the
+        meta_data table in batches. The buffer is written to disk as soon as it holds more than
+        max_words data words or the oldest buffered chunk is older than max_interval seconds.
+        flush() writes everything that is buffered and can be called from any thread. PyTables is
+        not thread safe, other HDF5 accesses during the readout have to hold lock (reentrant) as well.
+
+        Parameters:
+        ----------
+        raw_data_earray : tables.EArray
+                Raw data array to append the data words to
+        meta_data_table : tables.Table
+                Meta data table (MetaTable) to append one row per readout chunk to
+        max_words : int
+                Maximum number of buffered data words
+        max_interval : float
+                Maximum time in seconds data is kept in the buffer
+        sidecar : str
+                File to write an uncompressed copy of the raw data words to (for memory mapped
+                reading, see analysis.raw_data_files), None for no copy
+    '''
+
+    def __init__(self, raw_data_earray, meta_data_table, max_words=2000000, max_interval=1.0, sidecar=None):
+        self.raw_data_earray = raw_data_earray
+        self.meta_data_table = meta_data_table
+        self.max_words = max_words
+        self.max_interval = max_interval
+        self.sidecar_file = open(sidecar, 'wb') if sidecar else None
+
+        self.lock = RLock()
+        self._raw_data = []
+        self._meta_data = []
+        self._buffered_words = 0
+        self._buffer_time = None
+        self.total_words = raw_data_earray.nrows  # words written and buffered
+        self.segment_offset = 0  # First word of the actual output
+        self.meta_data_table.attrs.raw_data_offset = self.segment_offset
+
+        # Statistics
+        self.n_flushes = 0
+        self.flush_time_last = 0.
+        self.flush_time_max = 0.
+        self.flush_time_total = 0.
+        self.backlog_words_max = 0
+        self.backlog_chunks_max = 0
+
+    @property
+    def backlog_words(self):
+        return self._buffered_words
+
+    @property
+    def backlog_chunks(self):
+        return len(self._raw_data)
+
+    @property
+    def segment_words(self):
+        return self.total_words - self.segment_offset
+
+    def set_output(self, raw_data_earray, meta_data_table):
+        ''' Write the buffered data and continue with new output nodes (next file of a rotated run)
+
+            The meta data indices continue, the first word of the new output is stored in the
+            raw_data_offset attribute of the meta_data table.
+        '''
+        with self.lock:
+            self._flush()
+            self.raw_data_earray = raw_data_earray
+            self.meta_data_table = meta_data_table
+            self.segment_offset = self.total_words
+            self.meta_data_table.attrs.raw_data_offset = self.segment_offset
+
+    def append(self, data_tuple, scan_param_id):
+        ''' Add one readout chunk (data, timestamp_start, timestamp_stop, error) to the buffer
+        '''
+        len_raw_data = data_tuple[0].shape[0]
+        with self.lock:
+            if not self._raw_data:
+                self._buffer_time = time.time()
+            self._raw_data.append(data_tuple[0])
+            self._meta_data.append((self.total_words, self.total_words + len_raw_data, len_raw_data,
+                                    data_tuple[1], data_tuple[2], scan_param_id, data_tuple[3]))
+            self.total_words += len_raw_data
+            self._buffered_words += len_raw_data
+            self.backlog_words_max = max(self.backlog_words_max, self._buffered_words)
+            self.backlog_chunks_max = max(self.backlog_chunks_max, len(self._raw_data))
+
+            if self._buffered_words >= self.max_words or time.time() - self._buffer_time >= self.max_interval:
+                self._flush()
+
+    def flush(self):
+        ''' Write all buffered data to disk
+        '''
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self._raw_data:
+            return
+        start = time.time()
+        raw_data = self._raw_data[0] if len(self._raw_data) == 1 else np.concatenate(self._raw_data)
+        self.raw_data_earray.append(raw_data)
+        self.raw_data_earray.flush()
+        if self.sidecar_file:
+            raw_data.astype('<u4', copy=False).tofile(self.sidecar_file)
+            self.sidecar_file.flush()
+        self.meta_data_table.append(self._meta_data)
+        self.meta_data_table.flush()
+        self._raw_data = []
+        self._meta_data = []
+        self._buffered_words = 0
+
+        self.flush_time_last = time.time() - start
+        self.flush_time_max = max(self.flush_time_max, self.flush_time_last)
+        self.flush_time_total += self.flush_time_last
+        self.n_flushes += 1
+
+    def close(self):
+        ''' Write all buffered data to disk and close the sidecar file
+        '''
+        with self.lock:
+            self._flush()
+            if self.sidecar_file:
+                self.sidecar_file.close()
+                self.sidecar_file = None
+
+    def print_status(self):
+        logging.info('Raw data writer: %d words in %d flushes', self.total_words, self.n_flushes)
+        if self.n_flushes:
+            logging.info('Flush time: mean %.1f ms, max %.1f ms', 1e3 * self.flush_time_total / self.n_flushes, 1e3 * self.flush_time_max)
+        logging.info('Max. backlog: %d words in %d chunks', self.backlog_words_max, self.backlog_chunks_max)
 
 
 class MetaTable(tb.IsDescription):
-    index_start = tb.UInt32Col(pos=0)
-    index_stop = tb.UInt32Col(pos=1)
+    index_start = tb.UInt64Col(pos=0)
+    index_stop = tb.UInt64Col(pos=1)
     data_length = tb.UInt32Col(pos=2)
     timestamp_start = tb.Float64Col(pos=3)
     timestamp_stop = tb.Float64Col(pos=4)
@@ -204,12 +204,14 @@ class NoiseOccupancyScan(ScanBase):
         # stop readout
         if with_timestamp:
             self.dut.stop_timestamp()
-            self.meta_data_table.attrs.timestamp_status = yaml.dump(
-                self.dut["timestamp"].get_configuration())
+            with self.raw_data_writer.lock:  # Writer thread may access the file
+                self.meta_data_table.attrs.timestamp_status = yaml.dump(
+                    self.dut["timestamp"].get_configuration())
         if with_tlu:
             self.dut.stop_tlu()
-            self.meta_data_table.attrs.tlu_status = yaml.dump(
-                self.dut["tlu"].get_configuration())
+            with self.raw_data_writer.lock:  # Writer thread may access the file
+                self.meta_data_table.attrs.tlu_status = yaml.dump(
+                    self.dut["tlu"].get_configuration())
         if with_tdc:
             self.dut.stop_tdc()
         self.dut.stop_monoread()
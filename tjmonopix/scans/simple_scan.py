@@ -73,12 +73,14 @@ class SimpleScan(ScanBase):
         # Stop FIFO readout
         if with_timestamp:
             self.dut.stop_all()
-            self.meta_data_table.attrs.timestamp_status = yaml.dump(
-                self.dut["timestamp_rx1"].get_configuration())
+            with self.raw_data_writer.lock:  # Writer thread may access the file
+                self.meta_data_table.attrs.timestamp_status = yaml.dump(
+                    self.dut["timestamp_rx1"].get_configuration())
         if with_tlu:
             self.dut.stop_tlu()
-            self.meta_data_table.attrs.tlu_status = yaml.dump(
-                self.dut["tlu"].get_configuration())
+            with self.raw_data_writer.lock:  # Writer thread may access the file
+                self.meta_data_table.attrs.tlu_status = yaml.dump(
+                    self.dut["tlu"].get_configuration())
         if with_tdc:
             self.dut.stop_tdc()
         if with_tj:
@@ -0,0 +1,340 @@
+''' Simulated TJ-Monopix readout hardware for load tests without a MIO3 board
+
+    SimulatedDut can be used instead of TJMonoPix with FifoReadout and ScanBase (pass it as dut or set
+    'simulation' in the dut section of the testbench configuration). It generates correctly encoded raw data
+    words for the elapsed (wall clock) time: 4-word TJ hit blocks, TLU words and 3-word timestamp blocks
+    (with ToT for the HitOr timestamp). The words are stored in a FIFO of limited depth that is read out with
+    limited bandwidth; hit blocks that do not fit into the FIFO are lost and counted in LOST_COUNT.
+'''
+import logging
+import threading
+from collections import deque
+from time import time
+
+import numpy as np
+
+logger = logging.getLogger('SimulatedDut')
+
+# Header of the 3-word timestamp blocks (third word first) and the module enabling them
+TIMESTAMP_SOURCES = {'rx1': 0x40, 'inj': 0x50, 'mon': 0x60, 'tlu': 0x70}
+
+
+class SimModule(object):
+    ''' Firmware module, registers are stored only
+
+        Registers are accessed as items or as upper case attributes like basil modules.
+    '''
+
+    def __init__(self, name):
+        object.__setattr__(self, 'name', name)
+        object.__setattr__(self, '_registers', {})
+
+    def __getitem__(self, name):
+        return self._registers.get(name, 0)
+
+    def __setitem__(self, name, value):
+        if name == 'RESET':
+            self.reset()
+        else:
+            self._registers[name] = value
+
+    def __getattr__(self, name):
+        if name.isupper():
+            return self[name]
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        if name.isupper():
+            self[name] = value
+        else:
+            object.__setattr__(self, name, value)
+
+    def reset(self):
+        self._registers.clear()
+
+    def set_en(self, value):
+        self['ENABLE'] = value
+
+    def get_en(self):
+        return bool(self['ENABLE'])
+
+    def get_lost_count(self):
+        return self['LOST_COUNT']
+
+    def get_configuration(self):
+        return dict(self._registers)
+
+    def count_lost(self, n, register='LOST_COUNT', size=8):
+        ''' Increase lost data counter, saturating like the firmware counters '''
+        self._registers[register] = min(self[register] + n, (1 << size) - 1)
+
+
+class SimFifo(SimModule):
+    ''' SRAM FIFO of the simulated DUT '''
+
+    def __init__(self, name, dut):
+        super(SimFifo, self).__init__(name)
+        object.__setattr__(self, 'dut', dut)
+
+    def __getitem__(self, name):
+        if name == 'FIFO_SIZE':  # In bytes
+            return 4 * self.dut.get_fifo_size()
+        if name == 'RESET':
+            self.dut.reset_fifo()
+            return 0
+        return super(SimFifo, self).__getitem__(name)
+
+    def get_data(self):
+        return self.dut.read_fifo()
+
+
+class SimulatedDut(object):
+    ''' Software stand-in for TJMonoPix with the FIFO and the readout related modules
+
+        Parameters
+        ----------
+        hit_rate : float
+            Particle (cluster) rate in 1/s
+        cluster_size : float
+            Mean number of pixels per cluster
+        tot_mean, tot_sigma : float
+            ToT distribution in units of 25 ns
+        noisy_pixels : int
+            Number of randomly chosen noisy pixels
+        noise_rate : float
+            Hit rate of every noisy pixel in 1/s
+        trigger_fraction : float
+            Fraction of clusters with TLU trigger (if TLU is enabled)
+        fifo_depth : int
+            SRAM FIFO depth in words
+        read_bandwidth : float
+            Maximum read out rate in words/s (None is unlimited)
+        time_scale : float
+            Simulated time per wall clock time
+        seed : int
+            Seed of the random generator
+    '''
+
+    def __init__(self, hit_rate=1e5, cluster_size=1.5, tot_mean=20., tot_sigma=5., noisy_pixels=0, noise_rate=1e3,
+                 trigger_fraction=1., fifo_depth=1 << 21, read_bandwidth=None, time_scale=1., seed=None):
+        self.hit_rate = hit_rate
+        self.cluster_size = cluster_size
+        self.tot_mean = tot_mean
+        self.tot_sigma = tot_sigma
+        self.noise_rate = noise_rate
+        self.trigger_fraction = trigger_fraction
+        self.fifo_depth = fifo_depth
+        self.read_bandwidth = read_bandwidth
+        self.time_scale = time_scale
+
+        self.rng = np.random.RandomState(seed)
+        self.noisy_pixels = np.column_stack([self.rng.randint(0, 112, noisy_pixels), self.rng.randint(0, 224, noisy_pixels)])
+        self.fl_n = 1
+        self.SET = {'flavor': 'SIM'}
+
+        self._modules = {'fifo': SimFifo('fifo', self)}
+        self._fifo = deque()
+        self._fifo_size = 0
+        self._lock = threading.Lock()
+        self._sim_time = 0.  # Simulated time in s
+        self._last_update = time()
+        self._last_read = self._last_update
+        self.trigger_number = 0
+        self.n_words = 0
+        self.n_lost_words = 0
+
+    def __getitem__(self, name):
+        if name not in self._modules:
+            self._modules[name] = SimModule(name)
+        return self._modules[name]
+
+    def init(self, flavor=None):
+        logger.info('Simulated DUT: hit rate %.3g 1/s, cluster size %.1f, %d noisy pixels',
+                    self.hit_rate, self.cluster_size, self.noisy_pixels.shape[0])
+
+    # DUT control as in TJMonoPix, only enabling the data sources matters
+    def set_monoread(self, *args, **kwargs):
+        self['data_rx'].set_en(True)
+
+    def stop_monoread(self):
+        self['data_rx'].set_en(False)
+
+    def set_timestamp(self, src='rx1'):
+        self['timestamp_{}'.format(src)]['ENABLE'] = 1
+
+    def stop_timestamp(self, src='rx1'):
+        self['timestamp_{}'.format(src)]['ENABLE'] = 0
+
+    def set_tlu(self, tlu_delay=8):
+        self['tlu']['TRIGGER_ENABLE'] = 1
+        self['timestamp_tlu']['ENABLE'] = 1
+
+    def stop_tlu(self):
+        self['tlu']['TRIGGER_ENABLE'] = 0
+        self['timestamp_tlu']['ENABLE'] = 0
+
+    def stop_tdc(self):
+        self.stop_timestamp('mon')
+
+    def stop_all(self):
+        self.stop_tlu()
+        self.stop_monoread()
+        for src in ('rx1', 'inj', 'mon'):
+            self.stop_timestamp(src)
+
+    def reset_ibias(self):
+        pass
+
+    def get_temperature(self, n=10):
+        return 25.
+
+    def get_power_status(self):
+        return {}
+
+    def get_configuration(self):
+        return dict((name, module.get_configuration()) for name, module in self._modules.items())
+
+    def get_mask(self):
+        return np.zeros((448, 224), dtype=bool)
+
+    # FIFO
+    def reset_fifo(self):
+        with self._lock:
+            self._update()
+            self._fifo.clear()
+            self._fifo_size = 0
+
+    def get_fifo_size(self):
+        with self._lock:
+            self._update()
+            return self._fifo_size
+
+    def read_fifo(self):
+        ''' Read the FIFO content, limited by the read bandwidth '''
+        with self._lock:
+            self._update()
+            now = time()
+            n_words = self._fifo_size
+            if self.read_bandwidth:
+                n_words = min(n_words, int(self.read_bandwidth * (now - self._last_read)))
+            self._last_read = now
+            data = []
+            while n_words > 0:
+                words = self._fifo.popleft()
+                if words.shape[0] > n_words:
+                    self._fifo.appendleft(words[n_words:])
+                    words = words[:n_words]
+                data.append(words)
+                n_words -= words.shape[0]
+                self._fifo_size -= words.shape[0]
+            return np.concatenate(data) if data else np.zeros(0, dtype=np.uint32)
+
+    def _update(self):
+        ''' Generate the data of the time elapsed since the last update and store it in the FIFO '''
+        now = time()
+        duration = (now - self._last_update) * self.time_scale
+        self._last_update = now
+        words, block_sizes, block_sources = self.generate(self._sim_time, duration)
+        self._sim_time += duration
+        if words.shape[0] == 0:
+            return
+
+        # Blocks that do not fit into the FIFO are lost
+        free = self.fifo_depth - self._fifo_size
+        n_blocks = np.searchsorted(np.cumsum(block_sizes), free, side='right')
+        n_words = int(block_sizes[:n_blocks].sum())
+        if n_blocks < block_sizes.shape[0]:
+            lost_sources = block_sources[n_blocks:]
+            self['data_rx'].count_lost(int(np.count_nonzero(lost_sources == 0)))
+            self['tlu'].count_lost(int(np.count_nonzero(lost_sources == 1)), register='LOST_DATA_COUNTER')
+            self['timestamp'].count_lost(int(np.count_nonzero(lost_sources > 1)))
+            self.n_lost_words += words.shape[0] - n_words
+        if n_words:
+            self._fifo.append(words[:n_words])
+            self._fifo_size += n_words
+            self.n_words += n_words
+
+    def generate(self, start, duration):
+        ''' Raw data of the enabled data sources for the time interval [start, start + duration) in s
+
+            Returns the raw data words, the size of every data block and its source
+            (0: TJ hit, 1: TLU word, 2: timestamp block)
+        '''
+        rng = self.rng
+        blocks = []  # (timestamp in 640 MHz clock cycles, order within same time, source, words per block)
+
+        n_clusters = rng.poisson(self.hit_rate * duration)
+        cluster_ts = np.sort(((start + rng.uniform(0., duration, n_clusters)) * 640e6).astype(np.int64))
+        tot = np.clip(np.round(rng.normal(self.tot_mean, self.tot_sigma, n_clusters)), 1, 63).astype(np.int64)
+
+        if self['data_rx'].get_en():
+            # Clusters: hits around a seed pixel, noisy pixels hit independently
+            sizes = 1 + rng.poisson(max(self.cluster_size - 1., 0.), n_clusters)
+            hit_ts, hit_tot = np.repeat(cluster_ts, sizes), np.repeat(tot, sizes)
+            col = np.repeat(rng.randint(0, 112, n_clusters), sizes)
+            row = np.repeat(rng.randint(0, 224, n_clusters), sizes)
+            neighbour = np.arange(hit_ts.shape[0]) != np.repeat(np.cumsum(sizes) - sizes, sizes)
+            col = np.clip(col + neighbour * rng.randint(-1, 2, col.shape[0]), 0, 111)
+            row = np.clip(row + neighbour * rng.randint(-1, 2, row.shape[0]), 0, 223)
+            n_noise = rng.poisson(self.noise_rate * self.noisy_pixels.shape[0] * duration)
+            if n_noise:
+                pixels = self.noisy_pixels[rng.randint(0, self.noisy_pixels.shape[0], n_noise)]
+                col, row = np.r_[col, pixels[:, 0]], np.r_[row, pixels[:, 1]]
+                hit_ts = np.r_[hit_ts, ((start + rng.uniform(0., duration, n_noise)) * 640e6).astype(np.int64)]
+                hit_tot = np.r_[hit_tot, np.clip(np.round(rng.normal(self.tot_mean, self.tot_sigma, n_noise)), 1, 63).astype(np.int64)]
+            blocks.append((hit_ts, 4, 0, encode_tj_hits(col, row, hit_ts, hit_tot)))
+
+        if self['tlu']['TRIGGER_ENABLE']:
+            triggered = rng.uniform(size=n_clusters) < self.trigger_fraction
+            trigger_ts = cluster_ts[triggered]
+            trigger_number = (self.trigger_number + np.arange(trigger_ts.shape[0])) & 0xFFFF
+            self.trigger_number += trigger_ts.shape[0]
+            words = (0x80000000 | (((trigger_ts >> 4) & 0x7FFF) << 16) | trigger_number).astype(np.uint32)
+            blocks.append((trigger_ts, 0, 1, words[:, np.newaxis]))
+            if self['timestamp_tlu']['ENABLE']:
+                blocks.append((trigger_ts, 1, 2, encode_timestamps(trigger_ts, TIMESTAMP_SOURCES['tlu'])))
+
+        for order, src in enumerate(('mon', 'rx1', 'inj')):
+            if self['timestamp_{}'.format(src)]['ENABLE']:
+                charge = tot * 16 if src == 'mon' else None  # ToT of the HitOr signal in 640 MHz clock cycles
+                blocks.append((cluster_ts, 2 + order, 2, encode_timestamps(cluster_ts, TIMESTAMP_SOURCES[src], charge)))
+
+        if not blocks:
+            return np.zeros(0, dtype=np.uint32), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+        # Merge the blocks of all sources in time order
+        block_ts = np.concatenate([b[0] for b in blocks])
+        block_order = np.concatenate([np.full(b[0].shape[0], b[1]) for b in blocks])
+        block_sizes = np.concatenate([np.full(b[0].shape[0], b[3].shape[1]) for b in blocks])
+        block_sources = np.concatenate([np.full(b[0].shape[0], b[2]) for b in blocks])
+        block_words = np.concatenate([b[3].ravel() for b in blocks])
+        block_start = np.cumsum(block_sizes) - block_sizes
+        sort = np.lexsort((block_order, block_ts))
+        sizes = block_sizes[sort]
+        index = np.repeat(block_start[sort] - (np.cumsum(sizes) - sizes), sizes) + np.arange(sizes.sum())
+        return block_words[index], sizes, block_sources[sort]
+
+
+def encode_tj_hits(col, row, timestamp, tot):
+    ''' 4-word TJ data blocks of hits (timestamp in 640 MHz clock cycles, ToT in 40 MHz clock cycles) '''
+    ts_40 = timestamp >> 4
+    le = ts_40 & 0x3F
+    te = (le + tot) & 0x3F
+    words = np.empty((col.shape[0], 4), dtype=np.uint32)
+    words[:, 0] = (col // 2) | ((row + 256 * (col % 2)) << 6) | (te << 15) | (le << 21)
+    words[:, 1] = 0x10000000 | (ts_40 & 0xFFFFFFF)
+    words[:, 2] = 0x20000000 | ((ts_40 >> 28) & 0xFFFFFF)
+    words[:, 3] = 0x30000000
+    return words
+
+
+def encode_timestamps(timestamp, header, charge=None):
+    ''' 3-word timestamp blocks (third word first), header 0x40 (rx1), 0x50 (inj), 0x60 (mon), 0x70 (tlu) '''
+    words = np.empty((timestamp.shape[0], 3), dtype=np.uint32)
+    if charge is None:
+        words[:, 0] = ((header | 3) << 24) | ((timestamp >> 48) & 0xFFFFFF)
+    else:  # HitOr timestamp: 8 bit timestamp and 16 bit charge
+        words[:, 0] = ((header | 3) << 24) | ((charge & 0xFFFF) << 8) | ((timestamp >> 48) & 0xFF)
+    words[:, 1] = ((header | 2) << 24) | ((timestamp >> 24) & 0xFFFFFF)
+    words[:, 2] = ((header | 1) << 24) | (timestamp & 0xFFFFFF)
+    return words